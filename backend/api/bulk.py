@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from core.enums import OperationStatus, OperationType
+from core.async_gcloud import AsyncGCloud
+
+if TYPE_CHECKING:
+    from api.dedup import OperationCoalescer
+    from api.tenants import Tenant
+
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", 32))
+
+# Streamed bulk runs, kept referenced until they finish even if their client went away.
+_detached: set[asyncio.Task] = set()
+
+
+class InstanceRef(BaseModel):
+    zone: str
+    instance_name: str
+
+
+class BulkRequestBody(BaseModel):
+    instances: List[InstanceRef] = []
+    labels: Dict[str, str] = {}
+    receiver: str
+    stream: bool = False
+
+
+class BulkResult(BaseModel):
+    zone: str
+    instance_name: str
+    operation: Optional[str] = None
+    status: Optional[OperationStatus] = None
+    job_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BulkSummary(BaseModel):
+    total: int
+    succeeded: int
+    failed: int
+    job_ids: Dict[str, int]
+
+
+async def resolve_targets(agcloud: AsyncGCloud, body: BulkRequestBody) -> List[InstanceRef]:
+    """Returns the explicitly listed instances plus every instance matching the label selector."""
+    targets = {(ref.zone, ref.instance_name): ref for ref in body.instances}
+
+    if body.labels:
+        for zone, instances in (await agcloud.list_all_instances(labels=body.labels)).items():
+            for instance in instances:
+                targets.setdefault((zone, instance.name), InstanceRef(zone=zone, instance_name=instance.name))
+
+    return list(targets.values())
+
+
+async def issue_operations(coalescer: "OperationCoalescer", tenant: "Tenant", operation_type: OperationType,
+                           targets: List[InstanceRef], receiver: str,
+                           schedule_id: Optional[int] = None) -> AsyncIterator[BulkResult]:
+    """
+    Starts or stops the targets through the coalescer, `BULK_CONCURRENCY` at a time, and yields each
+    result as soon as its job is recorded and tracked.
+
+    Compute is checked for operations already pending on the targets with one scan per zone and batch
+    of instances, and instances already being started or stopped attach to the existing job.
+    """
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    pending = await coalescer.pending_operations(tenant, operation_type,
+                                                 [(target.zone, target.instance_name) for target in targets])
+
+    async def issue(target: InstanceRef) -> BulkResult:
+        async with semaphore:
+            try:
+                job = await coalescer.run(tenant, target.zone, target.instance_name, operation_type, receiver,
+                                          schedule_id=schedule_id, pending=pending)
+            except Exception as e:
+                logging.warning(f"Bulk {operation_type.value} failed for {target.instance_name} in {target.zone}: {e}")
+                return BulkResult(zone=target.zone, instance_name=target.instance_name, error=str(e))
+        return BulkResult(zone=target.zone, instance_name=target.instance_name,
+                          operation=job.operation, status=job.status, job_id=job.id)
+
+    for future in asyncio.as_completed([issue(target) for target in targets]):
+        yield await future
+
+
+async def execute_bulk(coalescer: "OperationCoalescer", tenant: "Tenant", operation_type: OperationType,
+                       targets: List[InstanceRef], receiver: str,
+                       schedule_id: Optional[int] = None) -> List[BulkResult]:
+    """
+    Starts or stops the targets through the coalescer, `BULK_CONCURRENCY` at a time, and writes all the
+    new ParentJobs and their tracking tasks in one transaction once every call has completed.
+    """
+    outcomes = await coalescer.run_many(tenant, operation_type,
+                                        [(target.zone, target.instance_name) for target in targets],
+                                        receiver, schedule_id, concurrency=BULK_CONCURRENCY)
+    results = []
+    for target in targets:
+        outcome = outcomes[(target.zone, target.instance_name)]
+        if isinstance(outcome, Exception):
+            logging.warning(f"Bulk {operation_type.value} failed for {target.instance_name} in {target.zone}: "
+                            f"{outcome}")
+            results.append(BulkResult(zone=target.zone, instance_name=target.instance_name, error=str(outcome)))
+        else:
+            results.append(BulkResult(zone=target.zone, instance_name=target.instance_name,
+                                      operation=outcome.operation, status=outcome.status, job_id=outcome.id))
+    return results
+
+
+async def run_bulk(coalescer: "OperationCoalescer", tenant: "Tenant", operation_type: OperationType,
+                   body: BulkRequestBody):
+    """
+    Starts or stops many instances at once.
+
+    Without streaming, the per-instance results are returned once every call has completed and
+    all the new jobs are recorded in one transaction. With streaming, each job is recorded and
+    tracked as soon as its call completes, so a client that disconnects half way does not
+    leave issued operations unrecorded, and is sent as an NDJSON row carrying its ParentJob id;
+    a summary row follows the last one. The calls run in a task of their own, so the
+    disconnect does not stop the run either.
+    """
+    targets = await resolve_targets(tenant.agcloud, body)
+    logging.info(f"Bulk {operation_type.value} of {len(targets)} instance(s)")
+
+    if not body.stream:
+        return await execute_bulk(coalescer, tenant, operation_type, targets, body.receiver)
+
+    rows: asyncio.Queue = asyncio.Queue()
+
+    async def issue():
+        try:
+            async for result in issue_operations(coalescer, tenant, operation_type, targets, body.receiver):
+                rows.put_nowait(result)
+        finally:
+            rows.put_nowait(None)
+
+    task = asyncio.create_task(issue())
+    _detached.add(task)
+    task.add_done_callback(_detached.discard)
+
+    async def stream():
+        results = []
+        while (result := await rows.get()) is not None:
+            results.append(result)
+            yield result.model_dump_json() + "\n"
+
+        summary = BulkSummary(
+            total=len(results),
+            succeeded=sum(result.job_id is not None for result in results),
+            failed=sum(result.error is not None for result in results),
+            job_ids={f"{result.zone}/{result.instance_name}": result.job_id
+                     for result in results if result.job_id is not None})
+        yield json.dumps({"summary": summary.model_dump()}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
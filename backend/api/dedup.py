@@ -0,0 +1,346 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+from api.schema import ParentJobPublic, utcnow
+from api.tenants import Tenant
+from api.tracker import OperationTracker
+from api.utils import (bind_idempotency_key, claim_idempotency_key, create_parent_job, create_parent_jobs,
+                       find_parent_job, purge_idempotency_keys, release_idempotency_key)
+from core.enums import OperationStatus, OperationType
+from core.models import OperationData
+
+# Whether a request that misses the tracker checks Compute for an operation already pending on the instance.
+DEDUP_PRECHECK = os.environ.get("DEDUP_PRECHECK", "true").lower() in ("1", "true", "yes")
+# Seconds an idempotency key identifies its request. Expired keys are swept and can be sent again.
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", 86400))
+# Seconds after which a key whose request never got a job, e.g. because the worker died, is given up.
+IDEMPOTENCY_KEY_ABANDONED = float(os.environ.get("IDEMPOTENCY_KEY_ABANDONED", 300))
+
+Target = Tuple[str, str, str, OperationType]
+# Operations pending in Compute found by a batched precheck, keyed by (zone, instance name).
+Pending = Dict[Tuple[str, str], OperationData]
+
+
+class OperationCoalescer:
+    """
+    Issues start/stop operations at most once per instance and operation type at a time.
+
+    A request for `(project, zone, instance, operation type)` resolves, in order, to:
+
+    - the job recorded for its `Idempotency-Key`, when the client is retrying a request;
+    - the job of an identical request still being issued, by awaiting it;
+    - the job whose operation the tracker is already following;
+    - the job of an operation Compute already has pending on the instance, which is
+      recorded and tracked without a new call when it was started outside the API;
+    - a new operation.
+
+    Only the last one calls `instances.start` or `instances.stop`, so double clicks and
+    retrying scripts share one operation, one ParentJob and one tracking task. Bulk requests
+    and schedules go through `run_many`, which checks Compute for pending operations with one
+    scan per zone and batch of instances and records all the new jobs in one transaction.
+
+    An idempotency key is recorded with its request before anything else happens, and
+    pointed at the job the request ends up with, whichever path that job came from. A key
+    is forgotten `key_ttl` seconds after it was recorded, and expired keys are swept every
+    so often.
+    """
+
+    def __init__(self, tracker: OperationTracker, precheck: bool = DEDUP_PRECHECK,
+                 key_ttl: float = IDEMPOTENCY_KEY_TTL):
+        self.tracker = tracker
+        self.precheck = precheck
+        self.key_ttl = key_ttl
+        self._inflight: Dict[Target, asyncio.Future] = {}
+        self._next_purge = 0.0
+
+        self._issued = 0
+        self._replayed = 0
+        self._coalesced = 0
+        self._attached_tracked = 0
+        self._attached_upstream = 0
+        self._precheck_failures = 0
+        self._keys_purged = 0
+
+    async def run(self, tenant: Tenant, zone: str, instance_name: str, operation_type: OperationType,
+                  receiver: str, idempotency_key: Optional[str] = None, schedule_id: Optional[int] = None,
+                  pending: Optional[Pending] = None) -> ParentJobPublic:
+        """
+        Starts or stops an instance, or attaches to the job already doing it.
+
+        Args:
+            tenant (Tenant): The tenant owning the instance.
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+            operation_type (OperationType): START or STOP.
+            receiver (str): Who is notified when a new job settles.
+            idempotency_key (Optional[str]): A client key identifying the request across retries.
+            schedule_id (Optional[int]): The schedule a new job is recorded for.
+            pending (Optional[Pending]): The result of `pending_operations` for the instance, so Compute is
+                not checked again.
+
+        Returns:
+            ParentJobPublic: The job carrying out the request.
+
+        Raises:
+            HTTPException: 409 if a request with the same idempotency key is still in flight, 422 if the
+                key was used for a different request.
+        """
+        project_id = tenant.project_id
+        claimed = False
+        if idempotency_key:
+            await self._purge_keys()
+            now = utcnow()
+            try:
+                record, claimed = await asyncio.to_thread(
+                    claim_idempotency_key, project_id, idempotency_key, zone, instance_name, operation_type,
+                    now - timedelta(seconds=self.key_ttl), now - timedelta(seconds=IDEMPOTENCY_KEY_ABANDONED))
+            except IntegrityError:
+                raise HTTPException(status_code=409, detail="Idempotency key is being used by another request")
+            if (record.zone, record.instance_name, record.type) != (zone, instance_name, operation_type):
+                raise HTTPException(status_code=422, detail="Idempotency key was used for a different request")
+            if record.job_id is not None:
+                parentjob = await asyncio.to_thread(find_parent_job, project_id, job_id=record.job_id)
+                if parentjob is not None:
+                    self._replayed += 1
+                    return parentjob
+            elif not claimed:
+                raise HTTPException(status_code=409, detail="Idempotency key is being used by another request")
+
+        parentjob = None
+        try:
+            parentjob = await self._coalesce(tenant, zone, instance_name, operation_type, receiver, schedule_id,
+                                             pending)
+            return parentjob
+        finally:
+            if idempotency_key and parentjob is not None:
+                await asyncio.to_thread(bind_idempotency_key, project_id, idempotency_key, parentjob.id)
+            elif claimed:
+                await asyncio.to_thread(release_idempotency_key, project_id, idempotency_key)
+
+    async def pending_operations(self, tenant: Tenant, operation_type: OperationType,
+                                 instances: List[Tuple[str, str]]) -> Pending:
+        """
+        Finds the operations of a type pending or running in Compute on many instances.
+
+        Args:
+            tenant (Tenant): The tenant owning the instances.
+            operation_type (OperationType): START or STOP.
+            instances (List[Tuple[str, str]]): The (zone, instance name) of the instances.
+
+        Returns:
+            Pending: The newest such operation per instance. Empty when prechecks are off or the scan failed.
+        """
+        if not self.precheck or not instances:
+            return {}
+        zone_instances: Dict[str, List[str]] = {}
+        for zone, instance_name in dict.fromkeys(instances):
+            zone_instances.setdefault(zone, []).append(instance_name)
+        try:
+            operations = await tenant.agcloud.scan_instances_operations(
+                zone_instances, status=[OperationStatus.PENDING, OperationStatus.RUNNING],
+                operation_types=[operation_type], max_per_instance=1)
+        except Exception:
+            logging.warning(f"Could not check pending operations of {len(instances)} instance(s)", exc_info=True)
+            self._precheck_failures += 1
+            return {}
+        return {key: found[0] for key, found in operations.items() if found}
+
+    async def _coalesce(self, tenant: Tenant, zone: str, instance_name: str, operation_type: OperationType,
+                        receiver: str, schedule_id: Optional[int], pending: Optional[Pending]) -> ParentJobPublic:
+        project_id = tenant.project_id
+        target = (project_id, zone, instance_name, operation_type)
+        inflight = self._inflight.get(target)
+        if inflight is not None:
+            self._coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = self._claim(target)
+        try:
+            parentjob = await self._resolve(tenant, zone, instance_name, operation_type, receiver, schedule_id,
+                                            pending)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(parentjob)
+            return parentjob
+        finally:
+            del self._inflight[target]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "issued": self._issued,
+            "replayed": self._replayed,
+            "coalesced": self._coalesced,
+            "attached_tracked": self._attached_tracked,
+            "attached_upstream": self._attached_upstream,
+            "precheck_failures": self._precheck_failures,
+            "keys_purged": self._keys_purged,
+        }
+
+    async def _purge_keys(self):
+        now = time.monotonic()
+        if now < self._next_purge:
+            return
+        # Hourly at most, and often enough for short TTLs.
+        self._next_purge = now + min(self.key_ttl / 10, 3600)
+        try:
+            self._keys_purged += await asyncio.to_thread(purge_idempotency_keys,
+                                                         utcnow() - timedelta(seconds=self.key_ttl))
+        except Exception:
+            logging.warning("Could not purge expired idempotency keys", exc_info=True)
+
+    async def run_many(self, tenant: Tenant, operation_type: OperationType, instances: List[Tuple[str, str]],
+                       receiver: str, schedule_id: Optional[int] = None,
+                       concurrency: Optional[int] = None) -> Dict[Tuple[str, str], Union[ParentJobPublic, Exception]]:
+        """
+        Starts or stops many instances, each resolved like `run`, and records all the new jobs in one transaction.
+
+        Compute is checked for pending operations once for all the instances, then the instances are
+        resolved `concurrency` at a time. Concurrent requests for one of the instances wait until its
+        job is recorded.
+
+        Args:
+            tenant (Tenant): The tenant owning the instances.
+            operation_type (OperationType): START or STOP.
+            instances (List[Tuple[str, str]]): The (zone, instance name) of the instances.
+            receiver (str): Who is notified when a new job settles.
+            schedule_id (Optional[int]): The schedule the new jobs are recorded for.
+            concurrency (Optional[int]): How many instances are resolved at once, all of them when None.
+
+        Returns:
+            Dict[Tuple[str, str], Union[ParentJobPublic, Exception]]: The job carrying out each instance's request,
+            or the error that prevented it.
+        """
+        project_id = tenant.project_id
+        instances = list(dict.fromkeys(instances))
+        pending = await self.pending_operations(tenant, operation_type, instances)
+        semaphore = asyncio.Semaphore(concurrency or max(len(instances), 1))
+        results: Dict[Tuple[str, str], Union[ParentJobPublic, Exception]] = {}
+        owned: Dict[Tuple[str, str], asyncio.Future] = {}
+        issued: List[Tuple[Tuple[str, str], OperationData]] = []
+
+        async def prepare(key: Tuple[str, str]):
+            inflight = self._inflight.get((project_id, *key, operation_type))
+            if inflight is not None:
+                self._coalesced += 1
+                try:
+                    results[key] = await asyncio.shield(inflight)
+                except Exception as e:
+                    results[key] = e
+                return
+            owned[key] = self._claim((project_id, *key, operation_type))
+            try:
+                async with semaphore:
+                    found = await self._find(tenant, *key, operation_type, pending)
+            except Exception as e:
+                results[key] = e
+                return
+            if isinstance(found, ParentJobPublic):
+                results[key] = found
+            else:
+                issued.append((key, found))
+
+        try:
+            await asyncio.gather(*(prepare(key) for key in instances))
+            if issued:
+                try:
+                    parentjobs = await asyncio.to_thread(
+                        create_parent_jobs, [(instance_name, zone, operation) for (zone, instance_name), operation
+                                             in issued], operation_type, project_id, receiver, schedule_id)
+                except Exception as e:
+                    logging.exception(f"Failed to record {len(issued)} {operation_type.value} job(s) of {project_id}")
+                    for key, _ in issued:
+                        results[key] = RuntimeError("Operation issued, but its job could not be recorded")
+                else:
+                    for ((zone, instance_name), operation), parentjob in zip(issued, parentjobs):
+                        self._track(tenant, parentjob, receiver)
+                        results[(zone, instance_name)] = parentjob
+        finally:
+            for key, future in owned.items():
+                outcome = results.get(key)
+                if outcome is None:
+                    future.cancel()
+                elif isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+                del self._inflight[(project_id, *key, operation_type)]
+        return results
+
+    def _claim(self, target: Target) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting on a failed issue, which must not be reported as an unretrieved exception.
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._inflight[target] = future
+        return future
+
+    async def _resolve(self, tenant: Tenant, zone: str, instance_name: str, operation_type: OperationType,
+                       receiver: str, schedule_id: Optional[int], pending: Optional[Pending]) -> ParentJobPublic:
+        found = await self._find(tenant, zone, instance_name, operation_type, pending)
+        if isinstance(found, ParentJobPublic):
+            return found
+        parentjob = await asyncio.to_thread(create_parent_job, instance_name, zone, found, operation_type,
+                                            tenant.project_id, receiver, schedule_id)
+        self._track(tenant, parentjob, receiver)
+        return parentjob
+
+    async def _find(self, tenant: Tenant, zone: str, instance_name: str, operation_type: OperationType,
+                    pending: Optional[Pending]) -> Union[ParentJobPublic, OperationData]:
+        """The job already carrying out the request, or the operation a new job has to be recorded for."""
+        project_id = tenant.project_id
+        job_id = self.tracker.active_job(project_id, zone, instance_name, operation_type)
+        if job_id is not None:
+            parentjob = await asyncio.to_thread(find_parent_job, project_id, job_id=job_id)
+            if parentjob is not None:
+                self._attached_tracked += 1
+                return parentjob
+
+        if pending is None:
+            operation = await self._pending_operation(tenant, zone, instance_name, operation_type)
+        else:
+            operation = pending.get((zone, instance_name))
+        if operation is not None:
+            self._attached_upstream += 1
+            parentjob = await asyncio.to_thread(find_parent_job, project_id, operation=operation.name)
+            if parentjob is not None:
+                # Recorded but not tracked here yet, the tracking queue resumes it.
+                return parentjob
+            return operation
+
+        if operation_type == OperationType.START:
+            operation = await tenant.agcloud.start_instance(zone, instance_name)
+        else:
+            operation = await tenant.agcloud.stop_instance(zone, instance_name)
+        self._issued += 1
+        return operation
+
+    def _track(self, tenant: Tenant, parentjob: ParentJobPublic, receiver: str):
+        self.tracker.track(tenant.gcloud, parentjob.zone, parentjob.name, parentjob.operation, parentjob.id,
+                           parentjob.type, receiver, agcloud=tenant.agcloud)
+
+    async def _pending_operation(self, tenant: Tenant, zone: str, instance_name: str, operation_type: OperationType):
+        """The newest operation of the type pending or running on the instance in Compute, if any."""
+        if not self.precheck:
+            return None
+        try:
+            operations = await tenant.agcloud.scan_operations(
+                zone, [instance_name], status=[OperationStatus.PENDING, OperationStatus.RUNNING],
+                operation_types=[operation_type], max_results=1)
+        except Exception:
+            # A failed read must not block the mutation, which reports its own errors.
+            logging.warning(f"Could not check pending operations of {zone}/{instance_name}", exc_info=True)
+            self._precheck_failures += 1
+            return None
+        return operations[0] if operations else None
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncIterator, Deque, Optional, Set
+
+from core.enums import InstanceStatus, OperationStatus, OperationType
+from core.models import InstanceData, OperationData
+
+if TYPE_CHECKING:
+    from api.tracker import TrackedOperation
+
+EVENT_HISTORY = int(os.environ.get("EVENT_HISTORY", 1000))
+EVENT_HEARTBEAT = float(os.environ.get("EVENT_HEARTBEAT", 15))
+
+# The status an instance moves through while one of our operations on it is in flight,
+# and the one it ends up in once the operation succeeded.
+TRANSITIONAL_STATUS = {OperationType.START: InstanceStatus.STARTING, OperationType.STOP: InstanceStatus.STOPPING}
+FINAL_STATUS = {OperationType.START: InstanceStatus.RUNNING, OperationType.STOP: InstanceStatus.TERMINATED}
+
+
+@dataclass
+class Event:
+    id: int
+    type: str
+    project_id: str
+    data: dict
+    timestamp: float = field(default_factory=time.time)
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data, default=str)}\n\n"
+
+
+class EventBus:
+    """
+    Fans instance and job state changes out to stream subscribers.
+
+    The last `history` events are kept so a client that reconnects with the id of the
+    last event it saw gets everything it missed. When that id is older than the history,
+    the client gets a `reset` event and should reload its state. Event ids start from the
+    current time in milliseconds, so they keep increasing across backend restarts.
+
+    Events are published from tracker and inventory listeners, so always on the event loop.
+    """
+
+    def __init__(self, history: int = EVENT_HISTORY):
+        self._history: Deque[Event] = deque(maxlen=history)
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._next_id = int(time.time() * 1000)
+        self._published = 0
+        self._dropped = 0
+
+    def publish(self, type: str, project_id: str, data: dict) -> Event:
+        self._next_id += 1
+        event = Event(id=self._next_id, type=type, project_id=project_id, data=data)
+        self._history.append(event)
+        self._published += 1
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                # A subscriber that stopped reading is cut off, it resumes from the history.
+                self._subscribers.discard(subscriber)
+                self._dropped += 1
+        return event
+
+    async def subscribe(self, project_id: str, last_event_id: Optional[int] = None,
+                        heartbeat: float = EVENT_HEARTBEAT) -> AsyncIterator[str]:
+        """
+        Yields the project's events as SSE frames, starting after `last_event_id`.
+
+        A comment frame is sent every `heartbeat` seconds without events so proxies keep
+        the connection open. The stream ends if the subscriber falls `history` events behind.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self._history.maxlen)
+        self._subscribers.add(queue)
+        try:
+            if last_event_id is not None:
+                oldest = self._history[0].id if self._history else self._next_id + 1
+                if last_event_id < oldest - 1:
+                    # Resuming from the reset event replays the whole history.
+                    yield Event(id=oldest - 1, type="reset", project_id=project_id, data={}).to_sse()
+                for event in list(self._history):
+                    if event.id > last_event_id and event.project_id == project_id:
+                        yield event.to_sse()
+
+            while queue in self._subscribers or not queue.empty():
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event.project_id == project_id and (last_event_id is None or event.id > last_event_id):
+                    yield event.to_sse()
+        finally:
+            self._subscribers.discard(queue)
+
+    def on_operation_status(self, operation: "TrackedOperation"):
+        """Tracker status listener, publishes the job's progress and the instance's transition."""
+        project_id = operation.gcloud.credentials.project_id
+        self.publish("job", project_id, _job_data(operation, operation.status, is_successful=False))
+        if operation.status == OperationStatus.PENDING:
+            self.publish("instance", project_id, _instance_data(operation.zone, operation.instance_name,
+                                                               TRANSITIONAL_STATUS[operation.job_type]))
+
+    def on_operation_done(self, operation: "TrackedOperation", operation_data: OperationData):
+        """Tracker listener, publishes the settled job and the instance's new status."""
+        project_id = operation.gcloud.credentials.project_id
+        successful = operation_data.type == operation.job_type
+        self.publish("job", project_id, _job_data(operation, operation_data.status, is_successful=successful))
+        if successful:
+            self.publish("instance", project_id, _instance_data(operation.zone, operation.instance_name,
+                                                               FINAL_STATUS[operation.job_type]))
+
+    def on_instance_changed(self, project_id: str, instance: InstanceData):
+        """Inventory listener, publishes status changes seen when the inventory is refreshed."""
+        self.publish("instance", project_id, _instance_data(instance.zone, instance.name, instance.status))
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self._published,
+            "dropped": self._dropped,
+            "history": len(self._history),
+            "last_event_id": self._next_id,
+        }
+
+
+def _job_data(operation: "TrackedOperation", status: OperationStatus, is_successful: bool) -> dict:
+    return {
+        "id": operation.job_id,
+        "name": operation.instance_name,
+        "zone": operation.zone,
+        "type": operation.job_type.value,
+        "status": status.value,
+        "is_successful": is_successful,
+        "operation": operation.operation_name,
+        "attempt": operation.attempt,
+    }
+
+
+def _instance_data(zone: str, instance_name: str, status: InstanceStatus) -> dict:
+    return {"zone": zone, "instance_name": instance_name, "status": status.value}
@@ -0,0 +1,236 @@
+import sys
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import orjson
+
+from core.enums import InstanceStatus
+from core.models import InstanceData
+
+# Label sets are shared between the instances carrying them, fleets tend to reuse a handful.
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def list_row(zone: str, name: str, status: InstanceStatus) -> dict:
+    """Returns the `/list-server` row of an instance."""
+    return {"Instance Name": name, "Instance Status": status.value, "Zone": zone}
+
+
+class IndexedInstance:
+    """
+    Compact, mutable record of one instance.
+
+    `row` is the instance's `/list-server` row, serialized once when the instance changes
+    so listings are a concatenation of strings rather than a walk over models. It is kept
+    as `str`, which is sized exactly, where the bytes orjson returns may carry slack.
+    """
+
+    __slots__ = ("zone", "name", "status", "machine_type", "labels", "row")
+
+    def __init__(self, zone: str, name: str, status: InstanceStatus, machine_type: str, labels: Labels):
+        self.zone = zone
+        self.name = name
+        self.status = status
+        self.machine_type = machine_type
+        self.labels = labels
+        self.row = ""
+        self.serialize()
+
+    def serialize(self):
+        self.row = orjson.dumps(list_row(self.zone, self.name, self.status)).decode()
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "zone": self.zone, "status": self.status.value,
+                "machineType": self.machine_type, "labels": dict(self.labels)}
+
+
+class InstanceIndex:
+    """
+    In-memory index of a project's instances.
+
+    Instances are looked up by zone and name in O(1), and selected by status, machine type
+    and labels through secondary indexes, intersecting from the most selective one. The
+    index is updated in place: `sync` applies an inventory listing, skipping the zones whose
+    listing is the very same list as last time (incremental syncs reuse the lists of the
+    zones that did not change), and `set_status` applies what our own operations did.
+
+    The JSON body of the full listing is kept until the next change, so repeated
+    `/list-server` calls cost a dictionary lookup.
+    """
+
+    def __init__(self, project_id: str):
+        self.project_id = project_id
+        self._zones: Dict[str, Dict[str, IndexedInstance]] = {}
+        self._sources: Dict[str, List[InstanceData]] = {}
+        self._by_status: Dict[InstanceStatus, Set[IndexedInstance]] = {}
+        self._by_machine_type: Dict[str, Set[IndexedInstance]] = {}
+        self._by_label: Dict[Tuple[str, str], Set[IndexedInstance]] = {}
+        self._label_sets: Dict[Labels, Labels] = {}
+        self._size = 0
+        self._body: Optional[bytes] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def sync(self, instances: Dict[str, List[InstanceData]]) -> List[InstanceData]:
+        """
+        Brings the index in line with an inventory listing.
+
+        Args:
+            instances (Dict[str, List[InstanceData]]): A listing with zones as keys and a list of instances as values.
+
+        Returns:
+            List[InstanceData]: The instances that are new or whose status changed.
+        """
+        changed = []
+        for zone in [zone for zone in self._zones if zone not in instances]:
+            for record in list(self._zones[zone].values()):
+                self._remove(record)
+            del self._zones[zone]
+            self._sources.pop(zone, None)
+
+        for zone, zone_instances in instances.items():
+            if self._sources.get(zone) is zone_instances:
+                continue
+            self._sources[zone] = zone_instances
+            records = self._zones.setdefault(zone, {})
+            listed = set()
+            for instance in zone_instances:
+                listed.add(instance.name)
+                if self._upsert(zone, records, instance):
+                    changed.append(instance)
+            for name in [name for name in records if name not in listed]:
+                self._remove(records[name])
+        return changed
+
+    def set_status(self, zone: str, name: str, status: InstanceStatus) -> bool:
+        """Updates the status of an indexed instance. Returns whether it changed."""
+        record = self.get(zone, name)
+        if record is None or record.status == status:
+            return False
+        self._discard(self._by_status, record.status, record)
+        record.status = status
+        self._by_status.setdefault(status, set()).add(record)
+        record.serialize()
+        self._body = None
+        return True
+
+    def get(self, zone: str, name: str) -> Optional[IndexedInstance]:
+        records = self._zones.get(zone)
+        return records.get(name) if records is not None else None
+
+    def find(self, zone: Optional[str] = None, name: Optional[str] = None, status: Optional[InstanceStatus] = None,
+             machine_type: Optional[str] = None, labels: Optional[Dict[str, str]] = None) -> List[IndexedInstance]:
+        """
+        Selects the instances matching every given filter.
+
+        Without filters, returns every instance in listing order. Otherwise the matches are
+        sorted by zone and name.
+
+        Args:
+            zone (Optional[str]): Only instances in this zone.
+            name (Optional[str]): Only instances with this name.
+            status (Optional[InstanceStatus]): Only instances in this status.
+            machine_type (Optional[str]): Only instances of this machine type.
+            labels (Optional[Dict[str, str]]): Only instances carrying all of these labels.
+
+        Returns:
+            List[IndexedInstance]: The matching instances.
+        """
+        candidates: List[Iterable[IndexedInstance]] = []
+        if zone is not None:
+            candidates.append(self._zones.get(zone, {}).values())
+        if name is not None:
+            candidates.append([records[name] for records in self._zones.values() if name in records])
+        if status is not None:
+            candidates.append(self._by_status.get(status, ()))
+        if machine_type is not None:
+            candidates.append(self._by_machine_type.get(machine_type, ()))
+        for item in (labels or {}).items():
+            candidates.append(self._by_label.get(item, ()))
+
+        if not candidates:
+            return [record for records in self._zones.values() for record in records.values()]
+
+        candidates.sort(key=len)
+        smallest = candidates[0]
+        others = [other if isinstance(other, set) else set(other) for other in candidates[1:]]
+        matches = [record for record in smallest if all(record in other for other in others)]
+        matches.sort(key=lambda record: (record.zone, record.name))
+        return matches
+
+    def to_json(self, records: Optional[List[IndexedInstance]] = None) -> bytes:
+        """Serializes instances, by default all of them, as the JSON array `/list-server` returns."""
+        if records is None:
+            if self._body is None:
+                self._body = self._join(record for records in self._zones.values() for record in records.values())
+            return self._body
+        return self._join(records)
+
+    def stats(self) -> dict:
+        return {
+            "instances": self._size,
+            "zones": len(self._zones),
+            "statuses": {status.value: len(records) for status, records in self._by_status.items()},
+            "machine_types": len(self._by_machine_type),
+            "labels": len(self._by_label),
+            "label_sets": len(self._label_sets),
+        }
+
+    @staticmethod
+    def _join(records: Iterable[IndexedInstance]) -> bytes:
+        return ("[" + ",".join([record.row for record in records]) + "]").encode()
+
+    def _upsert(self, zone: str, records: Dict[str, IndexedInstance], instance: InstanceData) -> bool:
+        labels = self._labels(instance.labels)
+        record = records.get(instance.name)
+        if record is None:
+            record = IndexedInstance(sys.intern(zone), sys.intern(instance.name), instance.status,
+                                     sys.intern(instance.machineType), labels)
+            records[record.name] = record
+            self._by_status.setdefault(record.status, set()).add(record)
+            self._by_machine_type.setdefault(record.machine_type, set()).add(record)
+            for item in labels:
+                self._by_label.setdefault(item, set()).add(record)
+            self._size += 1
+            self._body = None
+            return True
+
+        status_changed = record.status != instance.status
+        if status_changed:
+            self._discard(self._by_status, record.status, record)
+            record.status = instance.status
+            self._by_status.setdefault(record.status, set()).add(record)
+            record.serialize()
+            self._body = None
+        if record.machine_type != instance.machineType:
+            self._discard(self._by_machine_type, record.machine_type, record)
+            record.machine_type = sys.intern(instance.machineType)
+            self._by_machine_type.setdefault(record.machine_type, set()).add(record)
+        if record.labels is not labels:
+            for item in record.labels:
+                self._discard(self._by_label, item, record)
+            record.labels = labels
+            for item in labels:
+                self._by_label.setdefault(item, set()).add(record)
+        return status_changed
+
+    def _remove(self, record: IndexedInstance):
+        del self._zones[record.zone][record.name]
+        self._discard(self._by_status, record.status, record)
+        self._discard(self._by_machine_type, record.machine_type, record)
+        for item in record.labels:
+            self._discard(self._by_label, item, record)
+        self._size -= 1
+        self._body = None
+
+    def _labels(self, labels: Dict[str, str]) -> Labels:
+        key = tuple(sorted(labels.items()))
+        return self._label_sets.setdefault(key, key)
+
+    @staticmethod
+    def _discard(index: dict, key, record: IndexedInstance):
+        records = index.get(key)
+        if records is not None:
+            records.discard(record)
+            if not records:
+                del index[key]
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from api.events import FINAL_STATUS, TRANSITIONAL_STATUS
+from api.index import InstanceIndex
+from core.enums import InstanceStatus, OperationStatus
+from core.gcloud import GCloud
+from core.models import InstanceData, OperationData
+
+if TYPE_CHECKING:
+    from api.tracker import TrackedOperation
+
+INVENTORY_TTL = float(os.environ.get("INVENTORY_TTL", 30))
+INVENTORY_STALE_TTL = float(os.environ.get("INVENTORY_STALE_TTL", 300))
+INVENTORY_INCREMENTAL = os.environ.get("INVENTORY_INCREMENTAL", "true").lower() == "true"
+INVENTORY_FULL_SYNC = float(os.environ.get("INVENTORY_FULL_SYNC", 600))
+
+CacheKey = Tuple[str, Optional[InstanceStatus]]
+
+
+@dataclass
+class CacheEntry:
+    instances: Dict[str, List[InstanceData]]
+    fetched_at: float
+    synced_at: str
+    full_synced_at: float
+    invalidated: bool = False
+
+
+class InventoryCache:
+    """
+    In-process cache in front of `GCloud.list_all_instances`.
+
+    Entries are fresh for `ttl` seconds. For a further `stale_ttl` seconds they are still
+    served, while a single background refresh brings them up to date. Concurrent requests
+    for the same entry share one upstream fetch. Entries that contain an instance touched
+    by one of our own operations are invalidated as soon as the operation finishes.
+
+    With `incremental` set, refreshes only re-list the zones that changed since the
+    previous sync, with a full listing every `full_sync_interval` seconds.
+
+    Unfiltered listings also feed an `InstanceIndex` per project, which serves lookups and
+    `/list-server` without walking the models, and is kept current by our own operations.
+    """
+
+    def __init__(self, ttl: float = INVENTORY_TTL, stale_ttl: float = INVENTORY_STALE_TTL,
+                 incremental: bool = INVENTORY_INCREMENTAL, full_sync_interval: float = INVENTORY_FULL_SYNC):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.incremental = incremental
+        self.full_sync_interval = full_sync_interval
+
+        self._entries: Dict[CacheKey, CacheEntry] = {}
+        self._inflight: Dict[CacheKey, asyncio.Task] = {}
+        self._invalidated_at: Dict[str, float] = {}
+        self._indexes: Dict[str, InstanceIndex] = {}
+        self._change_listeners: List[Callable[[str, InstanceData], None]] = []
+
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._refreshes = 0
+        self._full_syncs = 0
+        self._refresh_errors = 0
+
+    async def get(self, gcloud: GCloud, status: Optional[InstanceStatus] = None) -> Dict[str, List[InstanceData]]:
+        """
+        Gets the instance inventory, from the cache when possible.
+
+        Args:
+            gcloud (GCloud): The client to fetch the inventory with.
+            status (Optional[InstanceStatus]): Filter instances by status.
+
+        Returns:
+            Dict[str, List[InstanceData]]: A dictionary with zones as keys and a list of instances as values.
+        """
+        key = (gcloud.credentials.project_id, status)
+        entry = self._entries.get(key)
+
+        if entry is not None and not entry.invalidated:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self._hits += 1
+                return entry.instances
+            if age < self.ttl + self.stale_ttl:
+                self._stale_hits += 1
+                self._refresh(gcloud, key)
+                return entry.instances
+
+        self._misses += 1
+        return await asyncio.shield(self._refresh(gcloud, key))
+
+    async def index(self, gcloud: GCloud) -> InstanceIndex:
+        """
+        Gets the instance index of a project, refreshing the inventory first when it is not fresh.
+
+        Args:
+            gcloud (GCloud): The client to fetch the inventory with.
+
+        Returns:
+            InstanceIndex: The project's instance index.
+        """
+        await self.get(gcloud)
+        return self._indexes[gcloud.credentials.project_id]
+
+    def fresh_index(self, project_id: str) -> Optional[InstanceIndex]:
+        """Returns the instance index of a project if its inventory is fresh, without fetching anything."""
+        entry = self._entries.get((project_id, None))
+        if entry is None or entry.invalidated or time.monotonic() - entry.fetched_at >= self.ttl:
+            return None
+        return self._indexes.get(project_id)
+
+    def add_change_listener(self, listener: Callable[[str, InstanceData], None]):
+        """
+        Registers a callback run with the project id and the instance whenever a refresh
+        finds an instance that is new or whose status changed.
+        """
+        self._change_listeners.append(listener)
+
+    def invalidate(self, project_id: str, zone: str, instance_name: str):
+        """Invalidates the entries of a project that contain the instance or filter on status."""
+        self._invalidated_at[project_id] = time.monotonic()
+        for (entry_project, status), entry in self._entries.items():
+            if entry_project != project_id:
+                continue
+            if status is not None or any(instance.name == instance_name for instance in entry.instances.get(zone, [])):
+                entry.invalidated = True
+
+    def drop(self, project_id: str):
+        """Drops every entry of a project, e.g. once its tenant is evicted."""
+        for key in [key for key in self._entries if key[0] == project_id]:
+            del self._entries[key]
+        self._invalidated_at.pop(project_id, None)
+        self._indexes.pop(project_id, None)
+
+    def on_operation_status(self, operation: "TrackedOperation"):
+        """Tracker status listener, moves the instance to its transitional status in the index."""
+        index = self._indexes.get(operation.gcloud.credentials.project_id)
+        if index is not None and operation.status == OperationStatus.PENDING:
+            index.set_status(operation.zone, operation.instance_name, TRANSITIONAL_STATUS[operation.job_type])
+
+    def on_operation_done(self, operation: "TrackedOperation", operation_data: OperationData):
+        """
+        Tracker listener, invalidates the instance once our operation on it is done, and moves
+        it to its final status in the index right away when the operation succeeded.
+        """
+        project_id = operation.gcloud.credentials.project_id
+        index = self._indexes.get(project_id)
+        if index is not None and operation_data.type == operation.job_type:
+            index.set_status(operation.zone, operation.instance_name, FINAL_STATUS[operation.job_type])
+        self.invalidate(project_id, operation.zone, operation.instance_name)
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and the age of every cached entry."""
+        now = time.monotonic()
+        return {
+            "hits": self._hits,
+            "stale_hits": self._stale_hits,
+            "misses": self._misses,
+            "refreshes": self._refreshes,
+            "full_syncs": self._full_syncs,
+            "refresh_errors": self._refresh_errors,
+            "entries": [
+                {
+                    "project_id": project_id,
+                    "status": status.value if status else None,
+                    "age_seconds": round(now - entry.fetched_at, 3),
+                    "invalidated": entry.invalidated,
+                }
+                for (project_id, status), entry in self._entries.items()
+            ],
+            "indexes": {project_id: index.stats() for project_id, index in self._indexes.items()},
+        }
+
+    def _refresh(self, gcloud: GCloud, key: CacheKey) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(gcloud, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._refreshed(key, done))
+        return task
+
+    def _refreshed(self, key: CacheKey, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Background refreshes have no awaiter, the failure is already logged in `_fetch`.
+            task.exception()
+
+    async def _fetch(self, gcloud: GCloud, key: CacheKey) -> Dict[str, List[InstanceData]]:
+        project_id, status = key
+        started_at = time.monotonic()
+        previous = self._entries.get(key)
+        full = (not self.incremental or previous is None
+                or started_at - previous.full_synced_at >= self.full_sync_interval)
+
+        self._refreshes += 1
+        try:
+            if full:
+                instances, synced_at = await asyncio.to_thread(gcloud.sync_instances, status=status)
+            else:
+                instances, synced_at = await asyncio.to_thread(gcloud.sync_instances, previous.instances,
+                                                               previous.synced_at, status)
+        except Exception:
+            self._refresh_errors += 1
+            logging.exception(f"Failed to refresh the instance inventory for {key}")
+            raise
+
+        if full:
+            self._full_syncs += 1
+
+        # An operation that finished mid-fetch may not be reflected in the response.
+        invalidated = self._invalidated_at.get(project_id, 0.0) > started_at
+        self._entries[key] = CacheEntry(instances=instances, fetched_at=time.monotonic(), synced_at=synced_at,
+                                        full_synced_at=started_at if full else previous.full_synced_at,
+                                        invalidated=invalidated)
+        if status is None:
+            index = self._indexes.get(project_id)
+            if index is None:
+                index = self._indexes[project_id] = InstanceIndex(project_id)
+            changed = index.sync(instances)
+            if previous is not None:
+                self._notify_changes(project_id, changed)
+        return instances
+
+    def _notify_changes(self, project_id: str, changed: List[InstanceData]):
+        for instance in changed:
+            for listener in self._change_listeners:
+                try:
+                    listener(project_id, instance)
+                except Exception:
+                    logging.exception(f"Change listener failed for instance {instance.name}")
@@ -0,0 +1,97 @@
+import base64
+import json
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import tuple_
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from api.schema import ParentJob, ParentJobPublic
+from core.enums import OperationStatus, OperationType
+
+JOBS_PAGE_LIMIT = 500
+
+
+class JobPage(BaseModel):
+    items: List[ParentJobPublic]
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(job: ParentJob) -> str:
+    raw = json.dumps([job.created_at.isoformat(), job.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(job_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def query_jobs(session: Session, project_id: Optional[str], instance: Optional[str] = None,
+               zone: Optional[str] = None, type: Optional[OperationType] = None,
+               status: Optional[OperationStatus] = None, since: Optional[datetime] = None,
+               until: Optional[datetime] = None, limit: int = 50, cursor: Optional[str] = None,
+               schedule_id: Optional[int] = None) -> JobPage:
+    """
+    Pages through the job history of a project, newest first.
+
+    Pagination is keyset based: the cursor is the (created_at, id) of the last row of the
+    previous page, so every page is a range scan on one of the composite indexes no matter
+    how deep it is. Children are loaded with one extra query per page.
+
+    Args:
+        session (Session): The database session.
+        project_id (Optional[str]): The project whose jobs are listed.
+        instance (Optional[str]): Filter by instance name.
+        zone (Optional[str]): Filter by zone.
+        type (Optional[OperationType]): Filter by operation type.
+        status (Optional[OperationStatus]): Filter by operation status.
+        since (Optional[datetime]): Only jobs created at or after this time (UTC).
+        until (Optional[datetime]): Only jobs created before this time (UTC).
+        limit (int): Page size, at most JOBS_PAGE_LIMIT.
+        cursor (Optional[str]): The `next_cursor` of the previous page.
+        schedule_id (Optional[int]): Only jobs issued by this schedule.
+
+    Returns:
+        JobPage: The page of jobs and the cursor of the next page, if any.
+    """
+    limit = max(1, min(limit, JOBS_PAGE_LIMIT))
+
+    statement = select(ParentJob).where(ParentJob.project_id == project_id)
+    if instance is not None:
+        statement = statement.where(ParentJob.name == instance)
+    if zone is not None:
+        statement = statement.where(ParentJob.zone == zone)
+    if type is not None:
+        statement = statement.where(ParentJob.type == type)
+    if status is not None:
+        statement = statement.where(ParentJob.status == status)
+    if since is not None:
+        statement = statement.where(ParentJob.created_at >= _naive_utc(since))
+    if until is not None:
+        statement = statement.where(ParentJob.created_at < _naive_utc(until))
+    if schedule_id is not None:
+        statement = statement.where(ParentJob.schedule_id == schedule_id)
+    if cursor is not None:
+        statement = statement.where(tuple_(ParentJob.created_at, ParentJob.id) < tuple_(*decode_cursor(cursor)))
+
+    statement = (statement
+                 .options(selectinload(ParentJob.children))
+                 .order_by(ParentJob.created_at.desc(), ParentJob.id.desc())
+                 .limit(limit + 1))
+
+    jobs = session.exec(statement).all()
+    next_cursor = encode_cursor(jobs[limit - 1]) if len(jobs) > limit else None
+    return JobPage(items=[ParentJobPublic.model_validate(job) for job in jobs[:limit]], next_cursor=next_cursor)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
@@ -0,0 +1,143 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from api.schema import engine
+from core.telemetry import DB_COMMIT_SECONDS, DB_LAST_COMMIT_SECONDS
+
+JOB_WRITER_BATCH = int(os.environ.get("JOB_WRITER_BATCH", 500))
+JOB_WRITER_DELAY = float(os.environ.get("JOB_WRITER_DELAY", 0.005))
+
+T = TypeVar("T")
+
+
+class JobWriter:
+    """
+    Serializes every ParentJob/ChildJob write through one background thread.
+
+    Callers submit a function that takes a Session and get a Future back. The writer
+    drains whatever has been submitted, up to `max_batch` functions and waiting at most
+    `max_delay` seconds for more, runs the batch in a single transaction and resolves the
+    futures once it is committed. SQLite only ever sees one writer, so there is no lock
+    contention. If a batch fails, its functions are replayed one transaction each so a
+    bad update only fails its own future.
+    """
+
+    def __init__(self, engine: Engine, max_batch: int = JOB_WRITER_BATCH, max_delay: float = JOB_WRITER_DELAY):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._queue: "queue.Queue[Optional[Tuple[Callable[[Session], object], Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        self._batches = 0
+        self._writes = 0
+        self._failures = 0
+
+    def submit(self, fn: Callable[[Session], T]) -> "Future[T]":
+        """Queues `fn` to run in the writer's transaction and returns a future for its result."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def run(self, fn: Callable[[Session], T]) -> T:
+        """Submits `fn` and blocks until its batch is committed."""
+        return self.submit(fn).result()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Commits whatever is queued and stops the writer thread."""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self._batches,
+            "writes": self._writes,
+            "failures": self._failures,
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=self.max_delay)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            if stopping:
+                return
+
+    def _write(self, batch: List[Tuple[Callable[[Session], object], Future]]):
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                results = [fn(session) for fn, _ in batch]
+                self._commit(session)
+        except Exception:
+            logging.exception(f"Job batch of {len(batch)} failed, replaying writes one by one")
+            for fn, future in batch:
+                self._write_one(fn, future)
+            return
+
+        self._batches += 1
+        self._writes += len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    @staticmethod
+    def _commit(session: Session):
+        started = time.perf_counter()
+        session.commit()
+        elapsed = time.perf_counter() - started
+        DB_COMMIT_SECONDS.observe(elapsed)
+        DB_LAST_COMMIT_SECONDS.set(elapsed)
+
+    def _write_one(self, fn: Callable[[Session], object], future: Future):
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                result = fn(session)
+                self._commit(session)
+        except Exception as e:
+            self._failures += 1
+            future.set_exception(e)
+            return
+
+        self._batches += 1
+        self._writes += 1
+        future.set_result(result)
+
+
+job_writer = JobWriter(engine)
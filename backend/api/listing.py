@@ -0,0 +1,81 @@
+import logging
+import os
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, Optional
+
+import orjson
+
+from api.index import InstanceIndex, list_row
+from core.async_gcloud import AsyncGCloud
+from core.enums import InstanceStatus
+from core.models import InstanceData
+
+# Rows per NDJSON chunk when streaming from the instance index.
+LIST_STREAM_CHUNK = int(os.environ.get("LIST_STREAM_CHUNK", 500))
+# Filtered `aggregatedList` pages can come back empty; a page request skips at most this many of them.
+LIST_MAX_EMPTY_PAGES = int(os.environ.get("LIST_MAX_EMPTY_PAGES", 10))
+
+
+def _rows(page: Dict[str, List[InstanceData]]) -> List[dict]:
+    return [list_row(zone, instance.name, instance.status) for zone, instances in page.items() for instance in instances]
+
+
+def _pages(agcloud: AsyncGCloud, zone: Optional[str], name: Optional[str], status: Optional[InstanceStatus],
+           machine_type: Optional[str], labels: Dict[str, str], page_size: int = 500,
+           page_token: Optional[str] = None):
+    return agcloud.iter_instance_pages(status=status, zones=[zone] if zone else None, labels=labels or None,
+                                       name=name, machine_type=machine_type, page_size=page_size,
+                                       page_token=page_token)
+
+
+async def stream_instances(agcloud: AsyncGCloud, index: Optional[InstanceIndex], zone: Optional[str] = None,
+                           name: Optional[str] = None, status: Optional[InstanceStatus] = None,
+                           machine_type: Optional[str] = None,
+                           labels: Optional[Dict[str, str]] = None) -> AsyncIterator[bytes]:
+    """
+    Streams the instances matching the filters as NDJSON `/list-server` rows.
+
+    With a fresh instance index the rows come from it. Otherwise they are sent page by
+    page as `aggregatedList` returns them, so the first rows go out after the first
+    upstream page rather than after the last. A listing that fails half way ends with an
+    `{"error": ...}` row, since the status code has already been sent.
+    """
+    labels = labels or {}
+    if index is not None:
+        records = index.find(zone=zone, name=name, status=status, machine_type=machine_type, labels=labels)
+        for i in range(0, len(records), LIST_STREAM_CHUNK):
+            yield "".join([record.row + "\n" for record in records[i:i + LIST_STREAM_CHUNK]]).encode()
+        return
+
+    try:
+        async for page, _ in _pages(agcloud, zone, name, status, machine_type, labels):
+            rows = _rows(page)
+            if rows:
+                yield b"\n".join(orjson.dumps(row) for row in rows) + b"\n"
+    except Exception as e:
+        logging.exception("Instance listing stream failed")
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+
+
+async def instance_page(agcloud: AsyncGCloud, limit: int, page_token: Optional[str] = None,
+                        zone: Optional[str] = None, name: Optional[str] = None,
+                        status: Optional[InstanceStatus] = None, machine_type: Optional[str] = None,
+                        labels: Optional[Dict[str, str]] = None) -> dict:
+    """
+    Fetches one page of the instances matching the filters, straight from `aggregatedList`.
+
+    Filters are applied by Compute, and the page token is Compute's own, so a client can
+    walk a huge fleet `limit` instances at a time without the backend holding any of it.
+
+    Returns:
+        dict: The page's `items`, as `/list-server` rows, and the `next_page_token`, None on the last page.
+    """
+    skipped = 0
+    async with aclosing(_pages(agcloud, zone, name, status, machine_type, labels or {}, page_size=limit,
+                               page_token=page_token)) as pages:
+        async for page, next_token in pages:
+            rows = _rows(page)
+            if rows or next_token is None or skipped >= LIST_MAX_EMPTY_PAGES:
+                return {"items": rows, "next_page_token": next_token}
+            skipped += 1
+    return {"items": [], "next_page_token": None}
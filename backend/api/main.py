@@ -1,12 +1,39 @@
-import logging
-from fastapi import FastAPI, BackgroundTasks, Depends,  UploadFile, File, HTTPException
-from pydantic import BaseModel
+import os
+from core.timing import StartupTimer
+
+startup_timer = StartupTimer(budget_ms=float(os.environ.get("STARTUP_BUDGET_MS", 1500)))
+
+import asyncio, logging
+import orjson
+from datetime import datetime
+from typing import Optional
+from fastapi import FastAPI, Depends, Header, Query, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sqlmodel import Session
-from api.utils import check_operation_status
-from core.enums import OperationType
-from core.gcloud import GCloud
-from api.schema import create_db_and_tables, ParentJob, ParentJobPublic, get_session
-import tempfile, os
+from pydantic import BaseModel
+from api.tracker import OperationTracker
+from api.bulk import BulkRequestBody, BulkResult, run_bulk
+from api.dedup import OperationCoalescer
+from api.inventory import InventoryCache
+from api.listing import instance_page, stream_instances
+from api.status import InstanceStatusResult, InstanceStatusService, StatusRequestBody
+from api.scheduler import (Scheduler, ScheduleCreate, SchedulePreview, ScheduleRead, ScheduleUpdate,
+                           create_schedule, delete_schedule, get_schedule, list_schedules, schedule_read,
+                           update_schedule)
+from api.events import EventBus
+from core.enums import InstanceStatus, OperationStatus, OperationType
+from core.ratelimit import CircuitOpenError, limiter_stats
+from core.telemetry import JOB_WRITER_QUEUE, TENANT_REGISTER_SECONDS, TRACKED_OPERATIONS, MetricsMiddleware
+from api.tenants import CREDENTIALS_DIR, KeyStore, Tenant, TenantRegistry
+from api.notification import NotificationDispatcher
+from api.schema import create_db_and_tables, ParentJobPublic, get_session
+from api.jobs import JobPage, query_jobs
+from api.jobstore import job_writer
+from api.tracking import tracking_queue
+import tempfile
+
+startup_timer.mark("imports")
 
 class RequestBody(BaseModel):
     zone: str
@@ -14,74 +41,254 @@ class RequestBody(BaseModel):
     receiver: str
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware, skip={"/metrics"})
 
 logging.basicConfig(filename="app.log",level=logging.INFO,
                 format="%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
+tracker = OperationTracker()
+inventory = InventoryCache()
+tenants = TenantRegistry(store=KeyStore(CREDENTIALS_DIR) if CREDENTIALS_DIR else None)
+notifications = NotificationDispatcher.from_env()
+events = EventBus()
+coalescer = OperationCoalescer(tracker)
+scheduler = Scheduler(coalescer, inventory)
+statuses = InstanceStatusService(inventory, tracker)
+tracker.add_listener(inventory.on_operation_done)
+tracker.add_listener(events.on_operation_done)
+tracker.add_status_listener(events.on_operation_status)
+tracker.add_status_listener(inventory.on_operation_status)
+tracker.add_status_listener(statuses.on_operation_status)
+tracker.add_listener(statuses.on_operation_done)
+inventory.add_change_listener(events.on_instance_changed)
+tracker.add_listener(lambda operation, operation_data: notifications.notify(
+    operation.receiver, operation_data.type, operation.instance_name, operation.zone))
+tenants.add_evict_listener(lambda tenant: inventory.drop(tenant.project_id))
+tenants.add_evict_listener(lambda tenant: statuses.drop(tenant.project_id))
+tenants.add_register_listener(tracking_queue.resume)
+tenants.add_retain_check(lambda tenant: scheduler.has_schedules(tenant.project_id))
+TRACKED_OPERATIONS.labels("waiting").set_function(lambda: tracker.stats()["waiting"])
+TRACKED_OPERATIONS.labels("polled").set_function(lambda: tracker.stats()["polled"])
+JOB_WRITER_QUEUE.set_function(lambda: job_writer.stats()["queued"])
+
+async def get_tenant(x_tenant: Optional[str] = Header(None)) -> Tenant:
+    return tenants.get(x_tenant)
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request, exc: CircuitOpenError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(max(1, round(exc.retry_after)))})
+
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    with startup_timer.phase("create_db_and_tables"):
+        create_db_and_tables()
+    with startup_timer.phase("tracker_start"):
+        await tracker.start()
+        await notifications.start()
+        await tracking_queue.start(tracker, tenants.tenants, tenants.restore)
+        await scheduler.start(tenants.restore)
+        await tenants.start()
+    startup_timer.report()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await scheduler.stop()
+    await tracking_queue.stop()
+    await tracker.stop()
+    await notifications.stop()
+    await tenants.close()
+    await asyncio.to_thread(job_writer.stop)
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/startup-report")
+def startup_report():
+    return startup_timer.last_report
 
 @app.get("/hello")
 def Hello():
     return {"status": "success", "message": "Hello World"}
 
-gcloud = None
-
 @app.post("/load_config")
-def load_config(file: UploadFile = File(...)):
-    global gcloud 
-    if gcloud is None:
-        raw = file.file.read()
-        fd, path = tempfile.mkstemp(suffix=".json")
-        try:
-            with os.fdopen(fd, "wb") as f:
-                f.write(raw)
-            gcloud = GCloud(credential_path=path)
-        finally:
-            try: os.remove(path)
-            except OSError: pass
+async def load_config(file: UploadFile = File(...)):
+    raw = await file.read()
+    fd, path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+        with TENANT_REGISTER_SECONDS.time():
+            tenant = await tenants.register(path)
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+    return {"tenant": tenant.token, "project_id": tenant.project_id}
 
 @app.post("/start-server", response_model=ParentJobPublic)
-def start_server(body: RequestBody, background_tasks: BackgroundTasks, session: Session = Depends(get_session)):
-    operation = gcloud.start_instance(body.zone, body.instance_name)
-    parentjob = ParentJob(name=body.instance_name, zone=body.zone,
-                        status=operation.status, type=OperationType.START,
-                        is_successful=False)
-    session.add(parentjob)
-    session.commit()
-    session.refresh(parentjob)
-    background_tasks.add_task(check_operation_status, body.zone, body.receiver, operation.name, parentjob)
-    return ParentJobPublic.model_validate(parentjob)
+async def start_server(body: RequestBody, tenant: Tenant = Depends(get_tenant),
+                       idempotency_key: Optional[str] = Header(None)):
+    return await coalescer.run(tenant, body.zone, body.instance_name, OperationType.START, body.receiver,
+                               idempotency_key)
 
 @app.post("/end-server", response_model=ParentJobPublic) 
-def stop_server(body: RequestBody, background_tasks: BackgroundTasks, session: Session = Depends(get_session)):
-    operation = gcloud.stop_instance(body.zone, body.instance_name)
-    parentjob = ParentJob(name=body.instance_name, zone=body.zone,
-                        status=operation.status, type=OperationType.STOP,
-                        is_successful=False)
-    session.add(parentjob)
-    session.commit()
-    session.refresh(parentjob)
-    
-    background_tasks.add_task(check_operation_status, body.zone, body.receiver, operation.name, parentjob)
-    return parentjob
+async def stop_server(body: RequestBody, tenant: Tenant = Depends(get_tenant),
+                      idempotency_key: Optional[str] = Header(None)):
+    return await coalescer.run(tenant, body.zone, body.instance_name, OperationType.STOP, body.receiver,
+                               idempotency_key)
     
+@app.post("/bulk/start", response_model=list[BulkResult])
+async def bulk_start(body: BulkRequestBody, tenant: Tenant = Depends(get_tenant)):
+    return await run_bulk(coalescer, tenant, OperationType.START, body)
+
+@app.post("/bulk/stop", response_model=list[BulkResult])
+async def bulk_stop(body: BulkRequestBody, tenant: Tenant = Depends(get_tenant)):
+    return await run_bulk(coalescer, tenant, OperationType.STOP, body)
+
+@app.get("/jobs", response_model=JobPage)
+def list_jobs(instance: Optional[str] = None, zone: Optional[str] = None, type: Optional[OperationType] = None,
+              status: Optional[OperationStatus] = None, since: Optional[datetime] = None,
+              until: Optional[datetime] = None, limit: int = 50, cursor: Optional[str] = None,
+              schedule_id: Optional[int] = None,
+              tenant: Tenant = Depends(get_tenant), session: Session = Depends(get_session)):
+    return query_jobs(session, tenant.project_id, instance=instance, zone=zone, type=type, status=status,
+                      since=since, until=until, limit=limit, cursor=cursor, schedule_id=schedule_id)
+
+@app.post("/schedules", response_model=ScheduleRead)
+async def add_schedule(body: ScheduleCreate, tenant: Tenant = Depends(get_tenant)):
+    schedule = await asyncio.to_thread(create_schedule, tenant.project_id, body)
+    scheduler.upsert(schedule)
+    return schedule_read(schedule, scheduler.next_run(schedule.id))
+
+@app.post("/schedules/preview", response_model=SchedulePreview)
+async def preview_new_schedule(body: ScheduleCreate, runs: int = Query(5, ge=1, le=100),
+                               tenant: Tenant = Depends(get_tenant)):
+    """Dry run of a schedule that is not saved: its next run times and the instances it would act on."""
+    return await scheduler.preview(tenant, body, runs)
+
+@app.get("/schedules", response_model=list[ScheduleRead])
+def read_schedules(tenant: Tenant = Depends(get_tenant), session: Session = Depends(get_session)):
+    return [schedule_read(schedule, scheduler.next_run(schedule.id))
+            for schedule in list_schedules(session, tenant.project_id)]
+
+@app.get("/schedules/{schedule_id}", response_model=ScheduleRead)
+def read_schedule(schedule_id: int, tenant: Tenant = Depends(get_tenant), session: Session = Depends(get_session)):
+    return schedule_read(get_schedule(session, tenant.project_id, schedule_id), scheduler.next_run(schedule_id))
+
+@app.get("/schedules/{schedule_id}/preview", response_model=SchedulePreview)
+async def preview_schedule(schedule_id: int, runs: int = Query(5, ge=1, le=100),
+                           tenant: Tenant = Depends(get_tenant), session: Session = Depends(get_session)):
+    schedule = get_schedule(session, tenant.project_id, schedule_id)
+    return await scheduler.preview(tenant, ScheduleCreate(**schedule.model_dump(include=set(ScheduleCreate.model_fields))),
+                                   runs)
+
+@app.patch("/schedules/{schedule_id}", response_model=ScheduleRead)
+async def edit_schedule(schedule_id: int, body: ScheduleUpdate, tenant: Tenant = Depends(get_tenant)):
+    schedule = await asyncio.to_thread(update_schedule, tenant.project_id, schedule_id, body)
+    scheduler.upsert(schedule)
+    return schedule_read(schedule, scheduler.next_run(schedule.id))
+
+@app.delete("/schedules/{schedule_id}")
+async def remove_schedule(schedule_id: int, tenant: Tenant = Depends(get_tenant)):
+    await asyncio.to_thread(delete_schedule, tenant.project_id, schedule_id)
+    scheduler.remove(schedule_id)
+    return {"deleted": schedule_id}
+
+@app.get("/scheduler-stats")
+def scheduler_stats():
+    return scheduler.stats()
+
+@app.get("/events")
+async def stream_events(tenant: Tenant = Depends(get_tenant), last_event_id: Optional[int] = Header(None),
+                        since: Optional[int] = Query(None)):
+    """Server-Sent Events stream of the tenant's instance and job state changes."""
+    resume_from = last_event_id if last_event_id is not None else since
+    return StreamingResponse(events.subscribe(tenant.project_id, resume_from), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/event-stats")
+def event_stats():
+    return events.stats()
+
+@app.get("/tracker-stats")
+def tracker_stats():
+    return tracker.stats()
+
 @app.get("/server-status")
-def server_status(zone: str, instance_name: str):
-    return gcloud.get_instance_status(zone, instance_name)
+async def server_status(zone: str, instance_name: str, tenant: Tenant = Depends(get_tenant)):
+    return await statuses.status(tenant, zone, instance_name)
+
+@app.post("/server-status", response_model=list[InstanceStatusResult])
+async def server_statuses(body: StatusRequestBody, tenant: Tenant = Depends(get_tenant)):
+    return await statuses.statuses(tenant, body.instances)
+
+@app.get("/status-stats")
+def status_stats():
+    return statuses.stats()
+
+@app.get("/jobstore-stats")
+def jobstore_stats():
+    return job_writer.stats()
+
+@app.get("/notification-stats")
+def notification_stats():
+    return notifications.stats()
+
+@app.get("/tracking-stats")
+def tracking_stats():
+    return tracking_queue.stats()
+
+@app.get("/dedup-stats")
+def dedup_stats():
+    return coalescer.stats()
+
+@app.get("/tenant-stats")
+def tenant_stats():
+    return tenants.stats()
+
+@app.get("/inventory-stats")
+def inventory_stats():
+    return inventory.stats()
+
+@app.get("/limiter-stats")
+def limiter_stats_route():
+    return limiter_stats()
 
 @app.get("/list-server")
-def list_server():
+async def list_server(zone: Optional[str] = None, name: Optional[str] = None, status: Optional[InstanceStatus] = None,
+                      machine_type: Optional[str] = None, label: list[str] = Query([]), stream: bool = False,
+                      limit: Optional[int] = Query(None, ge=1, le=500), page_token: Optional[str] = None,
+                      tenant: Tenant = Depends(get_tenant)):
+    """
+    Lists the instances of the project.
+
+    By default the whole listing is returned as one JSON array. With `stream`, rows are sent
+    as NDJSON as they are listed. With `limit` (and then `page_token`), one page is returned
+    as `{"items": [...], "next_page_token": ...}`.
+    """
+    labels = {}
+    for item in label:
+        key, separator, value = item.partition("=")
+        if not key or not separator:
+            raise HTTPException(status_code=400, detail=f"Invalid label filter {item!r}, expected key=value")
+        labels[key] = value
+    filters = dict(zone=zone, name=name, status=status, machine_type=machine_type, labels=labels)
+
     try:
-        result = []
-        instances = gcloud.list_all_instances()
-        for zone, instance in instances.items():
-            for machine in instance:
-                result.append({"Instance Name": machine.name, "Instance Status": machine.status, "Zone": zone})
-        return result
+        if limit is not None or page_token is not None:
+            page = await instance_page(tenant.agcloud, limit or 500, page_token, **filters)
+            return Response(orjson.dumps(page), media_type="application/json")
+        if stream:
+            return StreamingResponse(stream_instances(tenant.agcloud, inventory.fresh_index(tenant.project_id),
+                                                      **filters), media_type="application/x-ndjson")
+        index = await inventory.index(tenant.gcloud)
+        if zone is None and name is None and status is None and machine_type is None and not labels:
+            return Response(index.to_json(), media_type="application/json")
+        return Response(index.to_json(index.find(**filters)), media_type="application/json")
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, 
             detail=f"Server error: {str(e)}")
-
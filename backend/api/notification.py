@@ -1,18 +1,235 @@
+import asyncio
+import logging
+import os
 import smtplib
-from core.enums import OperationType
+import time
+from collections import defaultdict
+from dataclasses import dataclass
 from email.message import EmailMessage
+from typing import Dict, List, Optional, Protocol
+
+from core.enums import OperationType
+
+# Queued by `stop` after the last notification, telling the dispatcher's task to return.
+_STOP = object()
+
+@dataclass
+class Notification:
+    receiver: str
+    operation_type: OperationType
+    instance_name: str
+    zone: str
+
+
+class Transport(Protocol):
+    def send(self, msg: EmailMessage): ...
+
+    def close(self): ...
+
+
+class SMTPTransport:
+    """
+    Sends mail over one persistent SMTP connection.
+
+    The connection is opened and logged into on first use, checked with NOOP when it
+    has been idle, and re-established once if the server dropped it. Point it at a local
+    server with `use_ssl=False` and no credentials to test against an SMTP stand-in.
+    """
+
+    def __init__(self, host: str = "smtp.gmail.com", port: int = 465, username: Optional[str] = None,
+                 password: Optional[str] = None, use_ssl: bool = True, timeout: float = 30.0,
+                 idle_check: float = 60.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.idle_check = idle_check
+
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def send(self, msg: EmailMessage):
+        try:
+            self._connection().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            logging.info(f"SMTP connection to {self.host} dropped, reconnecting")
+            self.close()
+            self._connection().send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def _connection(self) -> smtplib.SMTP:
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_check:
+            try:
+                self._server.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+
+        if self._server is None:
+            smtp = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+            self._server = smtp(self.host, self.port, timeout=self.timeout)
+            if self.username:
+                self._server.login(self.username, self.password)
+        return self._server
+
 
-def send_email(sender, receiver, condition, password):
+def build_message(sender: str, receiver: str, notifications: List[Notification]) -> EmailMessage:
     msg = EmailMessage()
-    server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-    server.login(sender, password)
-    if condition == OperationType.START:
-        msg.set_content("Server has been started")
-    elif condition == OperationType.STOP:
-        msg.set_content("Server has been stopped")
-    msg['Subject'] = str(condition)
+    if len(notifications) == 1:
+        condition = notifications[0].operation_type
+        if condition == OperationType.START:
+            msg.set_content("Server has been started")
+        elif condition == OperationType.STOP:
+            msg.set_content("Server has been stopped")
+        msg['Subject'] = str(condition)
+    else:
+        lines = [f"{'Started' if notification.operation_type == OperationType.START else 'Stopped'} "
+                 f"{notification.instance_name} ({notification.zone})" for notification in notifications]
+        msg.set_content("\n".join(lines))
+        msg['Subject'] = f"{len(notifications)} server operations completed"
     msg['From'] = sender
     msg['To'] = receiver
-    server.send_message(msg)
-    server.quit()
+    return msg
+
+
+class NotificationDispatcher:
+    """
+    Sends operation notifications from a background queue.
+
+    Notifications for the same receiver are coalesced into one digest email per
+    `digest_window` seconds (0 sends each one on its own), and emails go out at most
+    `rate_per_minute` times a minute over the transport's single connection, so a bulk
+    operation never blocks job completion on SMTP handshakes.
+    """
+
+    def __init__(self, transport: Transport, sender: str, digest_window: float = 30.0,
+                 rate_per_minute: float = 20.0):
+        self.transport = transport
+        self.sender = sender
+        self.digest_window = digest_window
+        self.min_interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+
+        self._pending: Dict[str, List[Notification]] = defaultdict(list)
+        self._deadlines: Dict[str, float] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_sent = 0.0
+
+        self._queued = 0
+        self._sent = 0
+        self._failed = 0
+
+    @classmethod
+    def from_env(cls) -> "NotificationDispatcher":
+        sender = os.environ.get("SENDER")
+        transport = SMTPTransport(host=os.environ.get("SMTP_HOST", "smtp.gmail.com"),
+                                  port=int(os.environ.get("SMTP_PORT", 465)),
+                                  username=sender, password=os.environ.get("PASSWORD"),
+                                  use_ssl=os.environ.get("SMTP_SSL", "true").lower() == "true")
+        return cls(transport, sender,
+                   digest_window=float(os.environ.get("NOTIFY_DIGEST_WINDOW", 30)),
+                   rate_per_minute=float(os.environ.get("NOTIFY_RATE_PER_MINUTE", 20)))
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the dispatcher after sending whatever is still pending."""
+        if self._task is None:
+            return
+        # Cancelling the task could lose the digest it is sending, which `_flush` has already taken out of
+        # `_pending`: it is told to return instead, once it gets to the end of the queue.
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+
+        while not self._queue.empty():
+            self._add(self._queue.get_nowait())
+        for receiver in list(self._pending):
+            await self._flush(receiver)
+        await asyncio.to_thread(self.transport.close)
+
+    def notify(self, receiver: str, operation_type: OperationType, instance_name: str, zone: str):
+        """Queues a notification. Safe to call from any thread."""
+        if not receiver:
+            return
+        if self._loop is None:
+            logging.warning(f"Notification dispatcher not started, dropping notification for {instance_name}")
+            return
+        notification = Notification(receiver=receiver, operation_type=operation_type,
+                                    instance_name=instance_name, zone=zone)
+        self._queued += 1
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self._loop:
+            self._queue.put_nowait(notification)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, notification)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queued,
+            "sent": self._sent,
+            "failed": self._failed,
+            "pending": sum(len(notifications) for notifications in self._pending.values()),
+        }
+
+    def _add(self, notification: Notification):
+        if notification.receiver not in self._pending:
+            self._deadlines[notification.receiver] = time.monotonic() + self.digest_window
+        self._pending[notification.receiver].append(notification)
+
+    async def _run(self):
+        while True:
+            timeout = None
+            if self._deadlines:
+                timeout = max(min(self._deadlines.values()) - time.monotonic(), 0)
+            try:
+                notification = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if notification is _STOP:
+                    return
+                self._add(notification)
+
+            now = time.monotonic()
+            for receiver in [receiver for receiver, deadline in self._deadlines.items() if deadline <= now]:
+                await self._flush(receiver)
+
+    async def _flush(self, receiver: str):
+        notifications = self._pending.pop(receiver, [])
+        self._deadlines.pop(receiver, None)
+        if not notifications:
+            return
+
+        wait = self._last_sent + self.min_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
 
+        msg = build_message(self.sender, receiver, notifications)
+        try:
+            await asyncio.to_thread(self.transport.send, msg)
+            self._sent += 1
+        except Exception:
+            self._failed += 1
+            logging.exception(f"Failed to send {len(notifications)} notification(s) to {receiver}")
+        finally:
+            self._last_sent = time.monotonic()
@@ -0,0 +1,393 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError, model_validator
+from sqlmodel import Session, select
+
+from api.bulk import InstanceRef, execute_bulk
+from api.events import FINAL_STATUS, TRANSITIONAL_STATUS
+from api.jobstore import job_writer
+from api.schema import ParentJob, Schedule, engine, utcnow
+from core.cron import CronExpression
+from core.enums import OperationStatus, OperationType
+
+if TYPE_CHECKING:
+    from api.dedup import OperationCoalescer
+    from api.inventory import InventoryCache
+    from api.tenants import Tenant
+
+# A run missed while the backend was down is still made if it is at most this many seconds late.
+SCHEDULER_MISFIRE_GRACE = float(os.environ.get("SCHEDULER_MISFIRE_GRACE", 3600))
+# The timer re-reads the wall clock at least this often, so clock adjustments are picked up.
+SCHEDULER_MAX_SLEEP = 60.0
+
+
+class ScheduleCreate(BaseModel):
+    name: str = ""
+    cron: str
+    timezone: str = "UTC"
+    type: OperationType
+    zone: Optional[str] = None
+    instance_name: Optional[str] = None
+    labels: Dict[str, str] = {}
+    receiver: str = ""
+    enabled: bool = True
+
+    @model_validator(mode="after")
+    def check(self) -> "ScheduleCreate":
+        if bool(self.zone) != bool(self.instance_name):
+            raise ValueError("zone and instance_name go together")
+        if not self.instance_name and not self.labels:
+            raise ValueError("A schedule targets an instance (zone and instance_name) or a label selector")
+        CronExpression(self.cron, self.timezone).next_after(datetime.now(timezone.utc))
+        return self
+
+
+class ScheduleUpdate(BaseModel):
+    name: Optional[str] = None
+    cron: Optional[str] = None
+    timezone: Optional[str] = None
+    type: Optional[OperationType] = None
+    zone: Optional[str] = None
+    instance_name: Optional[str] = None
+    labels: Optional[Dict[str, str]] = None
+    receiver: Optional[str] = None
+    enabled: Optional[bool] = None
+
+
+class ScheduleRead(ScheduleCreate):
+    id: int
+    project_id: str
+    created_at: datetime
+    last_run_at: Optional[datetime] = None
+    next_run_at: Optional[datetime] = None
+
+
+class SchedulePreview(BaseModel):
+    next_runs: List[datetime]
+    targets: List[InstanceRef]
+    skipped: List[InstanceRef]
+
+
+@dataclass
+class ScheduledEntry:
+    schedule: Schedule
+    cron: CronExpression
+    due: Optional[datetime]
+    version: int
+
+
+class Scheduler:
+    """
+    Runs the start/stop schedules stored in the `Schedule` table.
+
+    Every enabled schedule has one entry in a heap ordered by its next due time, and a
+    single task sleeps until the earliest one, so idle schedules cost nothing however many
+    there are. Updated and deleted schedules leave their old heap entries behind, which are
+    recognized by their version and dropped when they come up.
+
+    Schedules falling due together are coalesced: their targets are resolved against one
+    inventory listing per project, instances already in (or moving to) the requested status
+    are skipped, and one bulk operation is issued per project, operation type and receiver,
+    through the coalescer so an instance already being started or stopped is not acted on
+    twice. Each new job is recorded as a ParentJob carrying its schedule's id. Runs missed while the
+    backend was down are made on startup if they are at most `misfire_grace` seconds late.
+
+    A project that is not loaded when its schedules fall due is registered again from its
+    stored key. When that is not possible, every schedule of the run gets a failed
+    ParentJob, so the skipped run shows up in the job history.
+    """
+
+    def __init__(self, coalescer: "OperationCoalescer", inventory: "InventoryCache",
+                 misfire_grace: float = SCHEDULER_MISFIRE_GRACE):
+        self.coalescer = coalescer
+        self.inventory = inventory
+        self.misfire_grace = misfire_grace
+
+        self._entries: Dict[int, ScheduledEntry] = {}
+        self._heap: List[Tuple[float, int, int]] = []
+        self._versions = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set[asyncio.Task] = set()
+        self._tenant: Optional[Callable[[str], Awaitable[Optional["Tenant"]]]] = None
+
+        self._batches = 0
+        self._runs = 0
+        self._operations = 0
+        self._skipped = 0
+        self._failures = 0
+        self._caught_up = 0
+
+    async def start(self, tenant: Callable[[str], Awaitable[Optional["Tenant"]]]):
+        """
+        Loads the enabled schedules and starts the timer.
+
+        Args:
+            tenant (Callable[[str], Awaitable[Optional[Tenant]]]): Gets the tenant of a project ID, loading it
+                if needed, or None when its credentials are not available.
+        """
+        if self._task is not None:
+            return
+        self._tenant = tenant
+
+        def load() -> List[Schedule]:
+            with Session(engine) as session:
+                return list(session.exec(select(Schedule).where(Schedule.enabled)).all())
+
+        for schedule in await asyncio.to_thread(load):
+            self.upsert(schedule)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        tasks = [self._task, *self._running]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def upsert(self, schedule: Schedule):
+        """(Re)schedules a schedule after it was created or updated."""
+        self._entries.pop(schedule.id, None)
+        if schedule.enabled:
+            cron = CronExpression(schedule.cron, schedule.timezone)
+            self._versions += 1
+            entry = ScheduledEntry(schedule=schedule, cron=cron, due=self._first_due(schedule, cron),
+                                   version=self._versions)
+            self._entries[schedule.id] = entry
+            self._push(entry)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Rebuild the heap once stale entries outnumber live ones.
+            self._heap = [(entry.due.timestamp(), schedule_id, entry.version)
+                          for schedule_id, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def remove(self, schedule_id: int):
+        self._entries.pop(schedule_id, None)
+
+    def has_schedules(self, project_id: str) -> bool:
+        """Whether a project has enabled schedules, whose tenant must then be kept loaded."""
+        return any(entry.schedule.project_id == project_id for entry in self._entries.values())
+
+    def next_run(self, schedule_id: int) -> Optional[datetime]:
+        entry = self._entries.get(schedule_id)
+        return entry.due if entry is not None else None
+
+    async def preview(self, tenant: "Tenant", schedule: ScheduleCreate, runs: int = 5) -> SchedulePreview:
+        """Dry run: the next run times of a schedule and what its run would do right now."""
+        cron = CronExpression(schedule.cron, schedule.timezone)
+        targets, skipped = await self._resolve(tenant, schedule.type, [(None, schedule)])
+        return SchedulePreview(next_runs=cron.upcoming(datetime.now(timezone.utc), runs),
+                               targets=[target for target, _ in targets], skipped=skipped)
+
+    def stats(self) -> dict:
+        return {
+            "schedules": len(self._entries),
+            "heap": len(self._heap),
+            "next_due": datetime.fromtimestamp(self._heap[0][0], timezone.utc) if self._heap else None,
+            "running": len(self._running),
+            "batches": self._batches,
+            "runs": self._runs,
+            "operations": self._operations,
+            "skipped": self._skipped,
+            "failures": self._failures,
+            "caught_up": self._caught_up,
+        }
+
+    def _first_due(self, schedule: Schedule, cron: CronExpression) -> datetime:
+        now = datetime.now(timezone.utc)
+        baseline = (schedule.last_run_at or schedule.created_at).replace(tzinfo=timezone.utc)
+        due = cron.next_after(max(baseline, now - timedelta(seconds=self.misfire_grace)))
+        if due <= now:
+            self._caught_up += 1
+        return due
+
+    def _push(self, entry: ScheduledEntry):
+        heapq.heappush(self._heap, (entry.due.timestamp(), entry.schedule.id, entry.version))
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, SCHEDULER_MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            now = time.time()
+            due: List[ScheduledEntry] = []
+            while self._heap and self._heap[0][0] <= now:
+                _, schedule_id, version = heapq.heappop(self._heap)
+                entry = self._entries.get(schedule_id)
+                if entry is None or entry.version != version:
+                    continue
+                due.append(entry)
+
+            groups: Dict[Tuple[str, OperationType, str], List[ScheduledEntry]] = defaultdict(list)
+            for entry in due:
+                schedule = entry.schedule
+                groups[(schedule.project_id, schedule.type, schedule.receiver)].append(entry)
+                try:
+                    entry.due = entry.cron.next_after(max(entry.due, datetime.now(timezone.utc)))
+                    self._push(entry)
+                except ValueError:
+                    logging.warning(f"Schedule {schedule.id} will not fire again")
+                    del self._entries[schedule.id]
+
+            for (project_id, operation_type, receiver), entries in groups.items():
+                task = asyncio.create_task(self._execute(project_id, operation_type, receiver,
+                                                         [entry.schedule for entry in entries]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _execute(self, project_id: str, operation_type: OperationType, receiver: str,
+                       schedules: List[Schedule]):
+        self._batches += 1
+        self._runs += len(schedules)
+        try:
+            tenant = await self._tenant(project_id)
+        except Exception:
+            logging.exception(f"Failed to load the credentials of project {project_id}")
+            tenant = None
+        if tenant is None:
+            self._failures += len(schedules)
+            logging.error(f"Skipping {len(schedules)} schedule(s) of project {project_id}: "
+                          f"its credentials are not available")
+            await asyncio.to_thread(job_writer.run, lambda session: _record_skipped(session, project_id,
+                                                                                    operation_type, schedules))
+            return
+
+        try:
+            targets, skipped = await self._resolve(tenant, operation_type,
+                                                   [(schedule.id, schedule) for schedule in schedules])
+            self._skipped += len(skipped)
+            logging.info(f"Scheduled {operation_type.value} of {len(targets)} instance(s) for project {project_id} "
+                         f"from {len(schedules)} schedule(s), {len(skipped)} already done")
+
+            by_schedule: Dict[int, List[InstanceRef]] = defaultdict(list)
+            for target, schedule_id in targets:
+                by_schedule[schedule_id].append(target)
+
+            # One transaction per schedule, concurrent ones share the job writer's.
+            results = [result for schedule_results in await asyncio.gather(
+                *(execute_bulk(self.coalescer, tenant, operation_type, schedule_targets, receiver, schedule_id)
+                  for schedule_id, schedule_targets in by_schedule.items()))
+                for result in schedule_results]
+            self._operations += sum(result.job_id is not None for result in results)
+            self._failures += sum(result.error is not None for result in results)
+        except Exception:
+            self._failures += len(schedules)
+            logging.exception(f"Scheduled {operation_type.value} failed for project {project_id}")
+        finally:
+            await asyncio.to_thread(job_writer.run, lambda session: _mark_run(session, schedules))
+
+    async def _resolve(self, tenant: "Tenant", operation_type: OperationType,
+                       schedules: List[Tuple[Optional[int], ScheduleCreate]]
+                       ) -> Tuple[List[Tuple[InstanceRef, Optional[int]]], List[InstanceRef]]:
+        """Resolves the instances of the schedules, skipping the ones already in the requested status."""
+        index = await self.inventory.index(tenant.gcloud)
+        settled = {FINAL_STATUS[operation_type], TRANSITIONAL_STATUS[operation_type]}
+        seen = set()
+        targets, skipped = [], []
+        for schedule_id, schedule in schedules:
+            if schedule.instance_name:
+                record = index.get(schedule.zone, schedule.instance_name)
+                candidates = [(schedule.zone, schedule.instance_name, record.status if record else None)]
+            else:
+                candidates = [(record.zone, record.name, record.status) for record in index.find(labels=schedule.labels)]
+            for zone, name, status in candidates:
+                if (zone, name) in seen:
+                    continue
+                seen.add((zone, name))
+                ref = InstanceRef(zone=zone, instance_name=name)
+                if status in settled:
+                    skipped.append(ref)
+                else:
+                    targets.append((ref, schedule_id))
+        return targets, skipped
+
+
+def _mark_run(session: Session, schedules: List[Schedule]):
+    ran_at = utcnow()
+    for schedule in schedules:
+        stored = session.get(Schedule, schedule.id)
+        if stored is not None:
+            stored.last_run_at = ran_at
+
+
+def _record_skipped(session: Session, project_id: str, operation_type: OperationType, schedules: List[Schedule]):
+    # A failed job without an operation, so the run that could not be made is visible in /jobs.
+    session.add_all([ParentJob(name=schedule.instance_name or ",".join(f"{key}={value}"
+                                                                       for key, value in schedule.labels.items()),
+                               zone=schedule.zone or "", status=OperationStatus.DONE, type=operation_type,
+                               is_successful=False, project_id=project_id, schedule_id=schedule.id)
+                     for schedule in schedules])
+    _mark_run(session, schedules)
+
+
+def schedule_read(schedule: Schedule, next_run_at: Optional[datetime]) -> ScheduleRead:
+    return ScheduleRead.model_construct(**schedule.model_dump(), next_run_at=next_run_at)
+
+
+def list_schedules(session: Session, project_id: str) -> List[Schedule]:
+    return list(session.exec(select(Schedule).where(Schedule.project_id == project_id)
+                             .order_by(Schedule.id)).all())
+
+
+def get_schedule(session: Session, project_id: str, schedule_id: int) -> Schedule:
+    schedule = session.get(Schedule, schedule_id)
+    if schedule is None or schedule.project_id != project_id:
+        raise HTTPException(status_code=404, detail="Unknown schedule")
+    return schedule
+
+
+def create_schedule(project_id: str, body: ScheduleCreate) -> Schedule:
+    def write(session: Session) -> Schedule:
+        schedule = Schedule(project_id=project_id, **body.model_dump())
+        session.add(schedule)
+        session.flush()
+        return Schedule.model_validate(schedule.model_dump())
+
+    return job_writer.run(write)
+
+
+def update_schedule(project_id: str, schedule_id: int, body: ScheduleUpdate) -> Schedule:
+    """Applies a partial update, validating the resulting schedule as a whole."""
+    def write(session: Session) -> Schedule:
+        schedule = get_schedule(session, project_id, schedule_id)
+        changes = body.model_dump(exclude_unset=True)
+        try:
+            merged = ScheduleCreate(**{**schedule.model_dump(include=set(ScheduleCreate.model_fields)), **changes})
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False, include_input=False))
+        for key, value in merged.model_dump().items():
+            setattr(schedule, key, value)
+        session.flush()
+        return Schedule.model_validate(schedule.model_dump())
+
+    return job_writer.run(write)
+
+
+def delete_schedule(project_id: str, schedule_id: int):
+    def write(session: Session):
+        session.delete(get_schedule(session, project_id, schedule_id))
+
+    job_writer.run(write)
@@ -1,16 +1,39 @@
 from sqlmodel import Field, Relationship, Session, SQLModel, create_engine
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Dict, Optional
 from core.enums import OperationStatus, OperationType
+from sqlalchemy import JSON, Column, Index, event, inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
+from sqlalchemy.pool import QueuePool
+import os
+
+def utcnow() -> datetime:
+    # SQLite keeps datetimes naive, so timestamps are stored as naive UTC.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 class ParentJob(SQLModel, table=True):
+    # Composite indexes for the /jobs history queries: every filter combination ends in
+    # (created_at, id) so the newest-first keyset pagination is a single index range scan.
+    __table_args__ = (
+        Index("ix_parentjob_project_created", "project_id", "created_at", "id"),
+        Index("ix_parentjob_project_name_created", "project_id", "name", "created_at", "id"),
+        Index("ix_parentjob_project_zone_created", "project_id", "zone", "created_at", "id"),
+        Index("ix_parentjob_project_type_status_created", "project_id", "type", "status", "created_at", "id"),
+        # Lookups of the job behind an operation.
+        Index("ix_parentjob_project_operation", "project_id", "operation"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field(index=True)
     zone: str = Field(index=True)
     status: OperationStatus = Field(index=True)
     type: OperationType = Field(index=True)
     is_successful: bool = Field(default=False, index=True)
+    project_id: Optional[str] = None
+    created_at: Optional[datetime] = Field(default_factory=utcnow)
+    operation: Optional[str] = None
+    schedule_id: Optional[int] = Field(default=None, index=True)
 
     children: list["ChildJob"] = Relationship(back_populates="parent",
     sa_relationship=relationship("ChildJob", back_populates="parent"))
@@ -26,19 +49,112 @@ class ChildJob(SQLModel, table=True):
     start_time: Optional[datetime] = None 
     end_time: Optional[datetime] = None  
 
-    parent_id: int | None = Field(default=None, foreign_key="parentjob.id")
+    parent_id: int | None = Field(default=None, foreign_key="parentjob.id", index=True)
     parent: ParentJob | None = Relationship(back_populates="children",
     sa_relationship=relationship("ParentJob", back_populates="children"))
     
+class TrackingTask(SQLModel, table=True):
+    # Durable tracking queue: one row per job whose operation is still being tracked, leased
+    # by the worker tracking it and deleted once the job settles.
+    __table_args__ = (
+        Index("ix_trackingtask_project_lease", "project_id", "lease_expires_at"),
+    )
+
+    id: int | None = Field(default=None, primary_key=True)
+    job_id: int = Field(foreign_key="parentjob.id", unique=True)
+    project_id: str
+    zone: str
+    instance_name: str
+    operation_name: str
+    job_type: OperationType
+    receiver: str = ""
+    attempt: int = 0
+    lease_owner: Optional[str] = Field(default=None, index=True)
+    lease_expires_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=utcnow)
+
+class IdempotencyKey(SQLModel, table=True):
+    # The request a client's Idempotency-Key was first sent with, and the job that carried it
+    # out, which is unset while the request is in flight. Keys expire after IDEMPOTENCY_KEY_TTL.
+    __table_args__ = (
+        Index("ux_idempotencykey_project_key", "project_id", "key", unique=True),
+        # Sweeps of expired keys.
+        Index("ix_idempotencykey_created_at", "created_at"),
+    )
+
+    id: int | None = Field(default=None, primary_key=True)
+    project_id: str
+    key: str
+    zone: str
+    instance_name: str
+    type: OperationType
+    job_id: Optional[int] = Field(default=None, foreign_key="parentjob.id")
+    created_at: datetime = Field(default_factory=utcnow)
+
+class Schedule(SQLModel, table=True):
+    # Recurring start/stop of an instance, or of every instance matching a label selector.
+    id: int | None = Field(default=None, primary_key=True)
+    project_id: str = Field(index=True)
+    name: str = ""
+    cron: str
+    timezone: str = "UTC"
+    type: OperationType
+    zone: Optional[str] = None
+    instance_name: Optional[str] = None
+    labels: Dict[str, str] = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+    receiver: str = ""
+    enabled: bool = True
+    created_at: datetime = Field(default_factory=utcnow)
+    last_run_at: Optional[datetime] = None
+
 
-sqlite_file_name = "database.db"
+sqlite_file_name = os.environ.get("DATABASE_FILE", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 10))
+
+def create_sqlite_engine(url: str) -> Engine:
+    """Creates an engine tuned for concurrent access: WAL journal, NORMAL sync, busy timeout, pooled connections."""
+    connect_args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    sqlite_engine = create_engine(url, connect_args=connect_args, poolclass=QueuePool,
+                                  pool_size=SQLITE_POOL_SIZE, max_overflow=SQLITE_POOL_SIZE)
+
+    @event.listens_for(sqlite_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    return sqlite_engine
+
+engine = create_sqlite_engine(sqlite_url)
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    migrate(engine)
+
+def migrate(db_engine: Engine):
+    """Adds the columns and indexes introduced after a database was first created."""
+    columns = {column["name"] for column in inspect(db_engine).get_columns("parentjob")}
+    with db_engine.begin() as connection:
+        if "project_id" not in columns:
+            connection.execute(text("ALTER TABLE parentjob ADD COLUMN project_id VARCHAR"))
+        if "created_at" not in columns:
+            # Rows from before the column existed are stamped with the migration time.
+            connection.execute(text("ALTER TABLE parentjob ADD COLUMN created_at DATETIME"))
+            connection.execute(text("UPDATE parentjob SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL"))
+        if "operation" not in columns:
+            connection.execute(text("ALTER TABLE parentjob ADD COLUMN operation VARCHAR"))
+        if "schedule_id" not in columns:
+            connection.execute(text("ALTER TABLE parentjob ADD COLUMN schedule_id INTEGER"))
+
+    for table in (ParentJob.__table__, ChildJob.__table__, TrackingTask.__table__, Schedule.__table__,
+                  IdempotencyKey.__table__):
+        for index in table.indexes:
+            index.create(db_engine, checkfirst=True)
 
 def get_session():
     with Session(engine) as session:
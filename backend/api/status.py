@@ -0,0 +1,218 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from pydantic import BaseModel, Field
+
+from api.bulk import InstanceRef
+from api.events import TRANSITIONAL_STATUS
+from api.inventory import InventoryCache
+from api.tenants import Tenant
+from core.enums import InstanceStatus, OperationType
+from core.models import OperationData
+
+if TYPE_CHECKING:
+    from api.tracker import OperationTracker, TrackedOperation
+
+# Seconds a status fetched from Compute is served without asking again.
+STATUS_CACHE_TTL = float(os.environ.get("STATUS_CACHE_TTL", 5))
+STATUS_CACHE_SIZE = int(os.environ.get("STATUS_CACHE_SIZE", 10000))
+STATUS_MAX_BATCH = int(os.environ.get("STATUS_MAX_BATCH", 1000))
+
+Key = Tuple[str, str]
+Resolved = Union[Tuple[InstanceStatus, str], Exception]
+
+
+class StatusRequestBody(BaseModel):
+    instances: List[InstanceRef] = Field(min_length=1, max_length=STATUS_MAX_BATCH)
+
+
+class InstanceStatusResult(BaseModel):
+    zone: str
+    instance_name: str
+    status: Optional[InstanceStatus] = None
+    # Where the status came from: tracker, inventory, cache or compute.
+    source: Optional[str] = None
+    error: Optional[str] = None
+
+
+class InstanceNotFoundError(LookupError):
+    pass
+
+
+class InstanceStatusService:
+    """
+    Answers instance status queries from what the backend already knows, and asks Compute
+    for the rest in as few calls as possible.
+
+    An instance's status comes, in order, from the operation the tracker follows on it,
+    from the project's instance index while its inventory is fresh, and from statuses
+    fetched from Compute in the last `ttl` seconds. The remaining instances are fetched
+    with one filtered `instances.list` call per zone, and an instance already being
+    fetched for another request is awaited rather than fetched again, so a dashboard
+    refreshing many instances costs one request and concurrent refreshes share it.
+    """
+
+    def __init__(self, inventory: InventoryCache, tracker: "OperationTracker", ttl: float = STATUS_CACHE_TTL,
+                 max_entries: int = STATUS_CACHE_SIZE):
+        self.inventory = inventory
+        self.tracker = tracker
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[InstanceStatus, float]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        self._sources = defaultdict(int)
+        self._merged = 0
+        self._upstream_calls = 0
+        self._errors = 0
+
+    async def statuses(self, tenant: Tenant, instances: List[InstanceRef]) -> List[InstanceStatusResult]:
+        """
+        Gets the status of many instances.
+
+        Args:
+            tenant (Tenant): The tenant owning the instances.
+            instances (List[InstanceRef]): The instances, duplicates are answered once.
+
+        Returns:
+            List[InstanceStatusResult]: One result per instance, in request order, with an error instead of a
+            status for instances that do not exist or could not be fetched.
+        """
+        resolved = await self._resolve(tenant, [(ref.zone, ref.instance_name) for ref in instances])
+        results = []
+        for ref in instances:
+            outcome = resolved[(ref.zone, ref.instance_name)]
+            if isinstance(outcome, Exception):
+                results.append(InstanceStatusResult(zone=ref.zone, instance_name=ref.instance_name,
+                                                    error=str(outcome) or type(outcome).__name__))
+            else:
+                results.append(InstanceStatusResult(zone=ref.zone, instance_name=ref.instance_name,
+                                                    status=outcome[0], source=outcome[1]))
+        return results
+
+    async def status(self, tenant: Tenant, zone: str, instance_name: str) -> InstanceStatus:
+        """
+        Gets the status of one instance.
+
+        Raises:
+            HTTPException: 404 if the instance does not exist. Errors from Compute are raised as they are.
+        """
+        outcome = (await self._resolve(tenant, [(zone, instance_name)]))[(zone, instance_name)]
+        if isinstance(outcome, InstanceNotFoundError):
+            raise HTTPException(status_code=404, detail=str(outcome))
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome[0]
+
+    def on_operation_status(self, operation: "TrackedOperation"):
+        """Tracker status listener, forgets the fetched status of an instance we are acting on."""
+        self._cache.pop((operation.gcloud.credentials.project_id, operation.zone, operation.instance_name), None)
+
+    def on_operation_done(self, operation: "TrackedOperation", operation_data: OperationData):
+        self.on_operation_status(operation)
+
+    def drop(self, project_id: str):
+        """Drops the cached statuses of a project, e.g. once its tenant is evicted."""
+        for key in [key for key in self._cache if key[0] == project_id]:
+            del self._cache[key]
+
+    def stats(self) -> dict:
+        return {
+            "sources": dict(self._sources),
+            "merged": self._merged,
+            "upstream_calls": self._upstream_calls,
+            "errors": self._errors,
+            "cached": len(self._cache),
+            "in_flight": len(self._inflight),
+        }
+
+    async def _resolve(self, tenant: Tenant, keys: List[Key]) -> Dict[Key, Resolved]:
+        project_id = tenant.project_id
+        index = self.inventory.fresh_index(project_id)
+        now = time.monotonic()
+        resolved: Dict[Key, Resolved] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            zone, instance_name = key
+            job_type = next((job_type for job_type in (OperationType.START, OperationType.STOP)
+                             if self.tracker.active_job(project_id, zone, instance_name, job_type) is not None), None)
+            record = index.get(zone, instance_name) if index is not None else None
+            cached = self._cache.get((project_id, zone, instance_name))
+            if job_type is not None:
+                resolved[key] = (TRANSITIONAL_STATUS[job_type], "tracker")
+            elif record is not None:
+                resolved[key] = (record.status, "inventory")
+            elif cached is not None and now - cached[1] < self.ttl:
+                self._cache.move_to_end((project_id, zone, instance_name))
+                resolved[key] = (cached[0], "cache")
+            else:
+                missing.append(key)
+                continue
+            self._sources[resolved[key][1]] += 1
+
+        if missing:
+            resolved.update(await self._fetch(tenant, missing))
+        return resolved
+
+    async def _fetch(self, tenant: Tenant, keys: List[Key]) -> Dict[Key, Resolved]:
+        project_id = tenant.project_id
+        loop = asyncio.get_running_loop()
+        waiting: Dict[Key, asyncio.Future] = {}
+        owned: List[Key] = []
+        for key in keys:
+            future = self._inflight.get((project_id, *key))
+            if future is None:
+                future = self._inflight[(project_id, *key)] = loop.create_future()
+                owned.append(key)
+            else:
+                self._merged += 1
+            waiting[key] = future
+
+        if owned:
+            zone_instances = defaultdict(list)
+            for zone, instance_name in owned:
+                zone_instances[zone].append(instance_name)
+            self._upstream_calls += len(zone_instances)
+            try:
+                statuses = await tenant.agcloud.get_instances_status(dict(zone_instances))
+            except Exception as e:
+                for key in owned:
+                    waiting[key].set_exception(e)
+            else:
+                fetched_at = time.monotonic()
+                for key in owned:
+                    status = statuses.get(key)
+                    if status is None:
+                        waiting[key].set_exception(InstanceNotFoundError(f"Instance {key[1]} not found in {key[0]}"))
+                    else:
+                        self._store((project_id, *key), status, fetched_at)
+                        waiting[key].set_result((status, "compute"))
+            finally:
+                for key in owned:
+                    # Cancelled half way: the requests sharing the fetch fail rather than wait forever.
+                    if not waiting[key].done():
+                        waiting[key].cancel()
+                    del self._inflight[(project_id, *key)]
+
+        results: Dict[Key, Resolved] = {}
+        for key, future in waiting.items():
+            try:
+                results[key] = await asyncio.shield(future)
+                self._sources["compute"] += 1
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                results[key] = RuntimeError("Status fetch was cancelled")
+            except Exception as e:
+                self._errors += 1
+                results[key] = e
+        return results
+
+    def _store(self, key: Tuple[str, str, str], status: InstanceStatus, fetched_at: float):
+        self._cache[key] = (status, fetched_at)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+
+from fastapi import HTTPException
+
+from core.async_gcloud import AsyncGCloud
+from core.gcloud import GCloud
+
+TENANT_MAX = int(os.environ.get("TENANT_MAX", 32))
+TENANT_IDLE_TTL = float(os.environ.get("TENANT_IDLE_TTL", 3600))
+# Where the service account keys of registered projects are kept, so a restart loads them again. Empty, the
+# default, keeps them in memory only.
+CREDENTIALS_DIR = os.environ.get("CREDENTIALS_DIR", "")
+# Sent with the 401 answering a token the backend does not know (evicted, restarted), so clients can tell it from
+# other errors and upload their key to /load_config again.
+TENANT_CHALLENGE = {"WWW-Authenticate": "Tenant"}
+
+
+@dataclass
+class Tenant:
+    token: str
+    project_id: str
+    gcloud: GCloud
+    agcloud: AsyncGCloud
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class KeyStore:
+    """Keeps one service account key file per project in a directory only the backend can read."""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+
+    def path(self, project_id: str) -> Path:
+        if not project_id or Path(project_id).name != project_id or project_id.startswith("."):
+            raise ValueError(f"Invalid project ID {project_id!r}")
+        return self.directory / f"{project_id}.json"
+
+    def save(self, project_id: str, key: bytes):
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self.path(project_id)
+        tmp_path = path.with_suffix(".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        tmp_path.replace(path)
+
+    def delete(self, project_id: str):
+        try:
+            self.path(project_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def projects(self) -> List[str]:
+        return sorted(path.stem for path in self.directory.glob("*.json"))
+
+
+class TenantRegistry:
+    """
+    Keeps the Compute clients of every project the backend manages.
+
+    Tenants are looked up by an opaque token handed out by `/load_config`, or by project
+    ID. Each tenant's clients, and with them its discovery client and access token, are
+    reused across requests. At most `max_tenants` are kept; the least recently used one is
+    evicted when a new project is added, and tenants idle for longer than `idle_ttl`
+    seconds are evicted on the next registry access. Tenants a retain check holds on to,
+    e.g. because the project has schedules, are never evicted.
+
+    With a `KeyStore`, the key of every registered project is kept until its tenant is
+    evicted, and `start` registers the stored projects again after a restart. `restore`
+    does the same for one project on demand.
+
+    A replaced or evicted tenant's async client is closed once the operation waits that
+    acquired it are done. Requests for an unknown tenant are answered with 401 and a
+    `WWW-Authenticate: Tenant` header, telling clients to register again.
+
+    All methods are meant to be called from the event loop.
+    """
+
+    def __init__(self, max_tenants: int = TENANT_MAX, idle_ttl: float = TENANT_IDLE_TTL,
+                 store: Optional[KeyStore] = None):
+        self.max_tenants = max_tenants
+        self.idle_ttl = idle_ttl
+        self.store = store
+
+        self._tenants: "OrderedDict[str, Tenant]" = OrderedDict()
+        self._projects: Dict[str, str] = {}
+        self._evict_listeners: List[Callable[[Tenant], None]] = []
+        self._register_listeners: List[Callable[[Tenant], None]] = []
+        self._retain_checks: List[Callable[[Tenant], bool]] = []
+        self._closing: set[asyncio.Task] = set()
+        self._restoring: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._evictions = 0
+        self._restored = 0
+
+    def add_evict_listener(self, listener: Callable[[Tenant], None]):
+        self._evict_listeners.append(listener)
+
+    def add_register_listener(self, listener: Callable[[Tenant], None]):
+        """Registers a callback run whenever a project is registered or its credentials are reloaded."""
+        self._register_listeners.append(listener)
+
+    def add_retain_check(self, check: Callable[[Tenant], bool]):
+        """Registers a check telling whether a tenant must be kept even though it is idle or least recently used."""
+        self._retain_checks.append(check)
+
+    async def start(self):
+        """Registers the projects whose keys are stored, in the background."""
+        if self.store is not None and self._task is None:
+            self._task = asyncio.create_task(self._restore_stored())
+
+    async def register(self, credential_path: Union[str, Path], persist: bool = True) -> Tenant:
+        """
+        Registers the project of a service account key, or refreshes its clients.
+
+        Args:
+            credential_path (Union[str, Path]): Path to the service account key file.
+            persist (bool): Whether to keep the key in the key store.
+
+        Returns:
+            Tenant: The registered tenant.
+        """
+        gcloud = await asyncio.to_thread(GCloud, credential_path=credential_path)
+        project_id = gcloud.credentials.project_id
+        if persist and self.store is not None:
+            key = await asyncio.to_thread(Path(credential_path).read_bytes)
+            await asyncio.to_thread(self.store.save, project_id, key)
+        self._evict_idle()
+
+        token = self._projects.get(project_id)
+        if token is not None:
+            tenant = self._tenants[token]
+            if tenant.gcloud.credentials is not gcloud.credentials:
+                self._close(tenant.agcloud)
+                tenant.gcloud = gcloud
+                tenant.agcloud = AsyncGCloud.from_gcloud(gcloud)
+            self._touch(tenant)
+            self._notify_registered(tenant)
+            return tenant
+
+        tenant = Tenant(token=secrets.token_urlsafe(24), project_id=project_id,
+                        gcloud=gcloud, agcloud=AsyncGCloud.from_gcloud(gcloud))
+        self._tenants[tenant.token] = tenant
+        self._projects[project_id] = tenant.token
+
+        if len(self._tenants) > self.max_tenants:
+            for candidate in list(self._tenants.values()):
+                if candidate is not tenant and not self._retained(candidate):
+                    self._evict(candidate)
+                    if len(self._tenants) <= self.max_tenants:
+                        break
+
+        logging.info(f"Registered tenant for project {project_id}")
+        self._notify_registered(tenant)
+        return tenant
+
+    def get(self, key: Optional[str] = None) -> Tenant:
+        """
+        Gets a tenant by token or project ID.
+
+        Without a key, the only registered tenant is returned so single-project
+        deployments keep working unchanged.
+        """
+        self._evict_idle()
+
+        if key is None:
+            if len(self._tenants) == 1:
+                return self._touch(next(iter(self._tenants.values())))
+            if not self._tenants:
+                raise HTTPException(status_code=401, detail="No configuration loaded, upload credentials to /load_config",
+                                    headers=TENANT_CHALLENGE)
+            raise HTTPException(status_code=400, detail="Several projects are configured, set the X-Tenant header")
+
+        tenant = self._tenants.get(key) or self._tenants.get(self._projects.get(key, ""))
+        if tenant is None:
+            raise HTTPException(status_code=401, detail="Unknown tenant, upload credentials to /load_config again",
+                                headers=TENANT_CHALLENGE)
+        return self._touch(tenant)
+
+    def tenants(self) -> List[Tenant]:
+        return list(self._tenants.values())
+
+    async def restore(self, project_id: str) -> Optional[Tenant]:
+        """
+        Gets the tenant of a project, registering it from the key store when it is not loaded.
+
+        Concurrent calls for the same project share one registration.
+
+        Returns:
+            Optional[Tenant]: The tenant, None when the project is not loaded and its key is not stored.
+        """
+        token = self._projects.get(project_id)
+        if token is not None:
+            return self._touch(self._tenants[token])
+        if self.store is None:
+            return None
+
+        task = self._restoring.get(project_id)
+        if task is None:
+            task = asyncio.create_task(self._restore(project_id))
+            self._restoring[project_id] = task
+            task.add_done_callback(lambda _: self._restoring.pop(project_id, None))
+        return await asyncio.shield(task)
+
+    async def close(self):
+        tasks = [task for task in (self._task, *self._restoring.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        for tenant in list(self._tenants.values()):
+            await tenant.agcloud.aclose()
+        self._tenants.clear()
+        self._projects.clear()
+        for task in self._closing:
+            task.cancel()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "tenants": len(self._tenants),
+            "max_tenants": self.max_tenants,
+            "evictions": self._evictions,
+            "restored": self._restored,
+            "idle_seconds": {tenant.project_id: round(now - tenant.last_used, 1)
+                             for tenant in self._tenants.values()},
+        }
+
+    def _touch(self, tenant: Tenant) -> Tenant:
+        tenant.last_used = time.monotonic()
+        self._tenants.move_to_end(tenant.token)
+        return tenant
+
+    def _retained(self, tenant: Tenant) -> bool:
+        for check in self._retain_checks:
+            try:
+                if check(tenant):
+                    return True
+            except Exception:
+                logging.exception(f"Retain check failed for project {tenant.project_id}")
+                return True
+        return False
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        # Tenants are kept in least recently used order, so the idle ones are at the front.
+        for tenant in list(self._tenants.values()):
+            if now - tenant.last_used < self.idle_ttl:
+                break
+            if not self._retained(tenant):
+                self._evict(tenant)
+
+    def _evict(self, tenant: Tenant):
+        del self._tenants[tenant.token]
+        del self._projects[tenant.project_id]
+        self._evictions += 1
+        self._close(tenant.agcloud)
+        if self.store is not None:
+            self.store.delete(tenant.project_id)
+        logging.info(f"Evicted tenant for project {tenant.project_id}")
+
+        for listener in self._evict_listeners:
+            try:
+                listener(tenant)
+            except Exception:
+                logging.exception(f"Evict listener failed for project {tenant.project_id}")
+
+    def _notify_registered(self, tenant: Tenant):
+        for listener in self._register_listeners:
+            try:
+                listener(tenant)
+            except Exception:
+                logging.exception(f"Register listener failed for project {tenant.project_id}")
+
+    async def _restore(self, project_id: str) -> Optional[Tenant]:
+        path = self.store.path(project_id)
+        if not await asyncio.to_thread(path.exists):
+            return None
+        tenant = await self.register(path, persist=False)
+        self._restored += 1
+        return tenant
+
+    async def _restore_stored(self):
+        for project_id in await asyncio.to_thread(self.store.projects):
+            try:
+                await self.restore(project_id)
+            except Exception:
+                logging.exception(f"Failed to restore tenant for project {project_id}")
+
+    def _close(self, agcloud: AsyncGCloud):
+        task = asyncio.get_running_loop().create_task(agcloud.aclose_when_idle())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
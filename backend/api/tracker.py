@@ -0,0 +1,425 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, Iterable, List, Optional
+
+from opentelemetry import trace
+
+from api.utils import finalize_operation
+from core.async_gcloud import AsyncGCloud
+from core.enums import OperationStatus, OperationType
+from core.gcloud import GCloud
+from core.models import OperationData
+from core.telemetry import OPERATION_DONE_SECONDS, start_span
+
+TRACKER_MAX_WAITERS = int(os.environ.get("TRACKER_MAX_WAITERS", 64))
+TRACKER_WAIT_TIMEOUT = float(os.environ.get("TRACKER_WAIT_TIMEOUT", 600))
+
+
+@dataclass
+class TrackedOperation:
+    gcloud: GCloud
+    zone: str
+    instance_name: str
+    operation_name: str
+    job_id: int
+    job_type: OperationType
+    receiver: str
+    attempt: int = 0
+    agcloud: Optional[AsyncGCloud] = None
+    waiting: bool = False
+    wait_failed: bool = False
+    status: OperationStatus = OperationStatus.PENDING
+    interval: float = 0.0
+    next_poll: float = 0.0
+    tracked_at: float = field(default_factory=time.monotonic)
+    # When the job's first operation was tracked, kept across retries.
+    job_tracked_at: float = field(default_factory=time.monotonic)
+    # The span that started the job (usually its API request), linked from the tracking spans.
+    span_context: Optional[trace.SpanContext] = None
+
+
+class OperationTracker:
+    """
+    Tracks in-flight zone operations with long-poll waits and a single asyncio poller.
+
+    Operations tracked with an `AsyncGCloud` are watched with `zoneOperations.wait`, up to
+    `max_waiters` at a time, so completion is seen as soon as it happens with one request
+    every couple of minutes. Operations beyond that, without an async client, or whose
+    wait failed or timed out after `wait_timeout` seconds are polled instead.
+
+    Every operation started through the API is kept in a registry. The poller wakes up
+    when the earliest operation is due and checks all due operations of a client with
+    `GCloud.get_operations_data`, one list call per zone, so the cost of tracking grows
+    with the number of zones rather than the number of operations or worker threads.
+    Each operation backs off on its own while its status is unchanged and goes back to
+    the minimum interval as soon as it moves. Finished operations are handed to
+    `finalize_operation`, then to the registered listeners, and anyone waiting on them
+    is resolved.
+    """
+
+    def __init__(self, min_interval: float = 1.0, max_interval: float = 15.0,
+                 backoff: float = 1.5, no_of_retries: int = 3,
+                 max_waiters: int = TRACKER_MAX_WAITERS, wait_timeout: float = TRACKER_WAIT_TIMEOUT):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.no_of_retries = no_of_retries
+        self.max_waiters = max_waiters
+        self.wait_timeout = wait_timeout
+
+        self._operations: Dict[str, TrackedOperation] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = defaultdict(list)
+        self._completing: set[asyncio.Task] = set()
+        self._waiting: Dict[str, asyncio.Task] = {}
+        self._finalizing: set[int] = set()
+        # (project, zone, instance, job type) -> (operation name, job id) of the latest operation tracked for it.
+        self._targets: Dict[tuple, tuple] = {}
+        self._listeners: List[Callable[[TrackedOperation, OperationData], None]] = []
+        self._status_listeners: List[Callable[[TrackedOperation], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self._lag = 0.0
+        self._polls = 0
+        self._waits = 0
+        self._wait_fallbacks = 0
+        self._completed = 0
+
+    async def start(self):
+        """Starts the poller on the running event loop."""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the poller and fails any pending waiters."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        waiting = list(self._waiting.values())
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+
+        for waiters in self._waiters.values():
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(RuntimeError("Operation tracker stopped"))
+        self._waiters.clear()
+
+    def add_listener(self, listener: Callable[[TrackedOperation, OperationData], None]):
+        """
+        Registers a callback run on the event loop whenever a tracked job settles.
+
+        The callback receives the tracked operation and its final operation data.
+        """
+        self._listeners.append(listener)
+
+    def add_status_listener(self, listener: Callable[[TrackedOperation], None]):
+        """
+        Registers a callback run on the event loop when an operation starts being tracked
+        and whenever its status changes before it is done.
+        """
+        self._status_listeners.append(listener)
+
+    def track(self, gcloud: GCloud, zone: str, instance_name: str, operation_name: str, job_id: int,
+              job_type: OperationType, receiver: str, attempt: int = 0,
+              agcloud: Optional[AsyncGCloud] = None):
+        """
+        Registers an operation with the tracker. Safe to call from any thread.
+
+        Args:
+            gcloud (GCloud): The client the operation was started with.
+            zone (str): The zone of the operation.
+            instance_name (str): The name of the instance the operation targets.
+            operation_name (str): The name of the operation.
+            job_id (int): The id of the ParentJob recording the operation.
+            job_type (OperationType): The type of operation the ParentJob expects.
+            receiver (str): The email address to notify once the operation is done.
+            attempt (int): How many retries preceded this operation.
+            agcloud (Optional[AsyncGCloud]): The async client of the same project, to wait on the operation with.
+        """
+        if self._loop is None:
+            raise RuntimeError("Operation tracker has not been started")
+
+        operation = TrackedOperation(gcloud=gcloud, zone=zone, instance_name=instance_name,
+                                     operation_name=operation_name,
+                                     job_id=job_id, job_type=job_type, receiver=receiver,
+                                     attempt=attempt, agcloud=agcloud,
+                                     span_context=trace.get_current_span().get_span_context())
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self._loop:
+            self._register(operation)
+        else:
+            self._loop.call_soon_threadsafe(self._register, operation)
+
+    async def wait(self, operation_name: str, timeout: Optional[float] = None) -> OperationData:
+        """
+        Waits until a tracked operation, including any retries it triggers, is done.
+
+        Args:
+            operation_name (str): The name of the operation.
+            timeout (Optional[float]): Seconds to wait before giving up.
+
+        Returns:
+            OperationData: The final operation data.
+        """
+        if operation_name not in self._operations:
+            raise KeyError(f"Operation {operation_name} is not being tracked")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[operation_name].append(waiter)
+        return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+
+    def tracked_jobs(self) -> set[int]:
+        """Returns the ids of the jobs whose operations are being tracked or finalized."""
+        return {operation.job_id for operation in self._operations.values()} | self._finalizing
+
+    def active_job(self, project_id: str, zone: str, instance_name: str, job_type: OperationType) -> Optional[int]:
+        """
+        Gets the job whose operation of a type on an instance is being tracked or finalized.
+
+        Args:
+            project_id (str): The project of the instance.
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+            job_type (OperationType): The type of the operation.
+
+        Returns:
+            Optional[int]: The id of the job, None when there is no such operation in flight.
+        """
+        key = (project_id, zone, instance_name, job_type)
+        target = self._targets.get(key)
+        if target is None:
+            return None
+        operation_name, job_id = target
+        if operation_name in self._operations or job_id in self._finalizing:
+            return job_id
+        del self._targets[key]
+        return None
+
+    def stats(self) -> dict:
+        """Returns the number of in-flight and long-polled operations and how far the poller is lagging."""
+        return {
+            "in_flight": len(self._operations),
+            "waiting": len(self._waiting),
+            "polled": len(self._operations) - len(self._waiting),
+            "completing": len(self._completing),
+            "lag_seconds": round(self._lag, 3),
+            "polls": self._polls,
+            "waits": self._waits,
+            "wait_fallbacks": self._wait_fallbacks,
+            "completed": self._completed,
+        }
+
+    def _register(self, operation: TrackedOperation):
+        operation.interval = self.min_interval
+        operation.next_poll = time.monotonic() + self.min_interval
+        self._operations[operation.operation_name] = operation
+        self._targets[(operation.gcloud.credentials.project_id, operation.zone, operation.instance_name,
+                       operation.job_type)] = (operation.operation_name, operation.job_id)
+        if not (operation.agcloud is not None and len(self._waiting) < self.max_waiters
+                and self._start_wait(operation)):
+            self._wakeup.set()
+        self._notify_status(operation)
+
+    def _start_wait(self, operation: TrackedOperation) -> bool:
+        # The client stays open until the wait releases it, even if its tenant is evicted or reloaded meanwhile.
+        if not operation.agcloud.acquire():
+            operation.agcloud = None
+            return False
+        operation.waiting = True
+        self._waiting[operation.operation_name] = asyncio.create_task(self._wait(operation))
+        return True
+
+    async def _wait(self, operation: TrackedOperation):
+        agcloud = operation.agcloud
+        try:
+            with start_span("tracker.wait", links=_links([operation])):
+                operation_data = await agcloud.wait_operation(operation.zone, operation.operation_name,
+                                                         self.wait_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.warning(f"Waiting on operation {operation.operation_name} failed, polling it instead",
+                            exc_info=True)
+            self._wait_fallbacks += 1
+            operation.waiting = False
+            operation.wait_failed = True
+            operation.interval = self.min_interval
+            operation.next_poll = time.monotonic()
+            self._wakeup.set()
+            return
+        finally:
+            agcloud.release()
+            self._waiting.pop(operation.operation_name, None)
+            self._promote()
+
+        self._waits += 1
+        if self._operations.pop(operation.operation_name, None) is not None:
+            self._finish(operation, operation_data)
+
+    def _promote(self):
+        # Hands freed wait slots to operations that are being polled.
+        if self._task is None:
+            return
+        for operation in self._operations.values():
+            if len(self._waiting) >= self.max_waiters:
+                return
+            if not operation.waiting and not operation.wait_failed and operation.agcloud is not None:
+                self._start_wait(operation)
+
+    def _finish(self, operation: TrackedOperation, operation_data: OperationData):
+        task = asyncio.create_task(self._complete(operation, operation_data))
+        self._completing.add(task)
+        self._finalizing.add(operation.job_id)
+        task.add_done_callback(self._completing.discard)
+        task.add_done_callback(lambda _: self._finalizing.discard(operation.job_id))
+        task.add_done_callback(lambda _: self._release_target(operation))
+
+    def _release_target(self, operation: TrackedOperation):
+        key = (operation.gcloud.credentials.project_id, operation.zone, operation.instance_name, operation.job_type)
+        target = self._targets.get(key)
+        if target is not None and target[0] not in self._operations and target[1] not in self._finalizing:
+            del self._targets[key]
+
+    def _notify_status(self, operation: TrackedOperation):
+        for listener in self._status_listeners:
+            try:
+                listener(operation)
+            except Exception:
+                logging.exception(f"Status listener failed for operation {operation.operation_name}")
+
+    def _reschedule(self, operation: TrackedOperation, changed: bool):
+        if changed:
+            operation.interval = self.min_interval
+        else:
+            operation.interval = min(operation.interval * self.backoff, self.max_interval)
+        operation.next_poll = time.monotonic() + operation.interval
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            polled = [operation for operation in self._operations.values() if not operation.waiting]
+            due = [operation for operation in polled if operation.next_poll <= now]
+
+            if not due:
+                timeout = None
+                if polled:
+                    timeout = min(operation.next_poll for operation in polled) - now
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._lag = now - min(operation.next_poll for operation in due)
+
+            clients = defaultdict(list)
+            for operation in due:
+                clients[id(operation.gcloud)].append(operation)
+
+            await asyncio.gather(*(self._poll(operations) for operations in clients.values()))
+
+    async def _poll(self, operations: List[TrackedOperation]):
+        gcloud = operations[0].gcloud
+        zone_operations = defaultdict(list)
+        for operation in operations:
+            zone_operations[operation.zone].append(operation.operation_name)
+
+        try:
+            with start_span("tracker.poll", links=_links(operations)):
+                results = await asyncio.to_thread(gcloud.get_operations_data, dict(zone_operations))
+        except Exception:
+            logging.exception(f"Failed to poll {len(operations)} operation(s) in {len(zone_operations)} zone(s)")
+            for operation in operations:
+                self._reschedule(operation, changed=False)
+            return
+        finally:
+            self._polls += 1
+
+        for operation in operations:
+            operation_data = results.get(operation.operation_name)
+            if operation.waiting or operation.operation_name not in self._operations:
+                # A wait slot picked the operation up while this poll was in flight.
+                continue
+            if operation_data is None:
+                self._reschedule(operation, changed=False)
+            elif operation_data.status == OperationStatus.DONE:
+                del self._operations[operation.operation_name]
+                self._finish(operation, operation_data)
+            else:
+                logging.info(f"Waiting... Operation {operation.operation_name} is currently in {operation_data.status}")
+                changed = operation_data.status != operation.status
+                operation.status = operation_data.status
+                self._reschedule(operation, changed)
+                if changed:
+                    self._notify_status(operation)
+
+    async def _complete(self, operation: TrackedOperation, operation_data: OperationData):
+        try:
+            with start_span("tracker.complete", links=_links([operation])):
+                retry = await asyncio.to_thread(finalize_operation, operation.zone, operation.gcloud,
+                                                operation_data, operation.job_id,
+                                                operation.attempt, self.no_of_retries)
+        except Exception as e:
+            logging.exception(f"Failed to finalize operation {operation.operation_name}")
+            self._observe_done(operation, "error")
+            self._resolve(operation.operation_name, exception=e)
+            return
+
+        if retry is not None:
+            waiters = self._waiters.pop(operation.operation_name, [])
+            self._register(replace(operation, operation_name=retry.name, attempt=operation.attempt + 1,
+                                   status=OperationStatus.PENDING, waiting=False, wait_failed=False,
+                                   tracked_at=time.monotonic()))
+            if waiters:
+                self._waiters[retry.name].extend(waiters)
+            return
+
+        self._completed += 1
+        self._observe_done(operation, "success" if operation_data.type == operation.job_type else "failed")
+        for listener in self._listeners:
+            try:
+                listener(operation, operation_data)
+            except Exception:
+                logging.exception(f"Listener failed for operation {operation.operation_name}")
+        self._resolve(operation.operation_name, result=operation_data)
+
+    @staticmethod
+    def _observe_done(operation: TrackedOperation, outcome: str):
+        OPERATION_DONE_SECONDS.labels(operation.job_type.value, outcome).observe(
+            time.monotonic() - operation.job_tracked_at)
+
+    def _resolve(self, operation_name: str, result: Optional[OperationData] = None,
+                 exception: Optional[BaseException] = None):
+        for waiter in self._waiters.pop(operation_name, []):
+            if waiter.done():
+                continue
+            if exception is not None:
+                waiter.set_exception(exception)
+            else:
+                waiter.set_result(result)
+
+
+def _links(operations: Iterable[TrackedOperation]) -> List[trace.Link]:
+    return [trace.Link(operation.span_context) for operation in operations
+            if operation.span_context is not None and operation.span_context.is_valid]
@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import delete, or_, update
+from sqlmodel import Session, select
+
+from api.events import FINAL_STATUS
+from api.jobstore import job_writer
+from api.schema import ParentJob, TrackingTask, engine, utcnow
+from core.enums import OperationStatus
+from core.gcloud import GCloud
+
+if TYPE_CHECKING:
+    from api.tenants import Tenant
+    from api.tracker import OperationTracker
+
+TRACKING_LEASE_TTL = float(os.environ.get("TRACKING_LEASE_TTL", 60))
+RECOVERY_BATCH = int(os.environ.get("RECOVERY_BATCH", 500))
+RECOVERY_CONCURRENCY = int(os.environ.get("RECOVERY_CONCURRENCY", 4))
+RECOVERY_MAX_IN_FLIGHT = int(os.environ.get("RECOVERY_MAX_IN_FLIGHT", 2000))
+
+# SQLite caps the number of bound parameters, so long IN lists are split.
+_IN_CHUNK = 500
+
+
+class TrackingQueue:
+    """
+    Durable queue of the operations the tracker still has to follow.
+
+    Every job is queued as a `TrackingTask` in the same transaction that records it, leased
+    to the worker that issued it, and removed in the transaction that settles it. The
+    tracker is in-memory, so this is what lets tracking survive a restart: a worker keeps
+    renewing the leases of the jobs it is tracking, and whenever a project is registered,
+    and every `lease_ttl / 3` seconds after that, it claims the project's tasks that have
+    no live lease (their worker died, or never came back) and resumes them.
+
+    Resumed tasks are reconciled against Compute in chunks of `batch` operations, at most
+    `concurrency` chunks at a time and without pushing the tracker past `max_in_flight`
+    operations. Operations Compute still knows about are handed to the tracker, which
+    finalizes and notifies as usual. Operations it answers a 404 for are orphans: their job
+    is settled from the instance's current status. Operations that could not be fetched for
+    any other reason stay claimed until their lease runs out, and the next sweep tries again.
+
+    On startup, the projects with queued tasks are loaded with `restore` (from their stored
+    keys), so tracking resumes after a restart without the project being registered again.
+    """
+
+    def __init__(self, lease_ttl: float = TRACKING_LEASE_TTL, batch: int = RECOVERY_BATCH,
+                 concurrency: int = RECOVERY_CONCURRENCY, max_in_flight: int = RECOVERY_MAX_IN_FLIGHT,
+                 worker_id: Optional[str] = None):
+        self.lease_ttl = lease_ttl
+        self.batch = batch
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._tracker: Optional["OperationTracker"] = None
+        self._tenants: Callable[[], List["Tenant"]] = list
+        self._restore: Optional[Callable[[str], Awaitable[Optional["Tenant"]]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._resuming: Dict[str, asyncio.Task] = {}
+
+        self._renewals = 0
+        self._resumed = 0
+        self._orphans = 0
+        self._deferred = 0
+
+    def task(self, job: ParentJob, receiver: str) -> TrackingTask:
+        """Builds the queue entry of a new job, leased to this worker. Add it in the job's transaction."""
+        return TrackingTask(job_id=job.id, project_id=job.project_id, zone=job.zone, instance_name=job.name,
+                            operation_name=job.operation, job_type=job.type, receiver=receiver or "",
+                            lease_owner=self.worker_id, lease_expires_at=self._lease_expiry())
+
+    async def start(self, tracker: "OperationTracker", tenants: Callable[[], List["Tenant"]],
+                    restore: Optional[Callable[[str], Awaitable[Optional["Tenant"]]]] = None):
+        """
+        Starts renewing leases and sweeping for abandoned tasks of the registered tenants.
+
+        Args:
+            tracker (OperationTracker): The tracker resumed operations are handed to.
+            tenants (Callable[[], List[Tenant]]): Gets the registered tenants.
+            restore (Optional[Callable[[str], Awaitable[Optional[Tenant]]]]): Loads the tenant of a project ID
+                with queued tasks on startup, None when its credentials are not available.
+        """
+        if self._task is not None:
+            return
+        self._tracker = tracker
+        self._tenants = tenants
+        self._restore = restore
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the sweeps and releases this worker's leases so another worker can take over right away."""
+        if self._task is None:
+            return
+        tasks = [self._task, *self._resuming.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        await asyncio.to_thread(job_writer.run, self._release)
+
+    def resume(self, tenant: "Tenant") -> asyncio.Task:
+        """Claims and resumes the abandoned tasks of a tenant's project. Concurrent calls share one run."""
+        task = self._resuming.get(tenant.project_id)
+        if task is None:
+            task = asyncio.create_task(self._resume(tenant))
+            self._resuming[tenant.project_id] = task
+            task.add_done_callback(lambda done: self._resumed_project(tenant.project_id, done))
+        return task
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "resuming": sorted(self._resuming),
+            "renewals": self._renewals,
+            "resumed": self._resumed,
+            "orphans": self._orphans,
+            "deferred": self._deferred,
+        }
+
+    def _lease_expiry(self):
+        return utcnow() + timedelta(seconds=self.lease_ttl)
+
+    def _resumed_project(self, project_id: str, task: asyncio.Task):
+        self._resuming.pop(project_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Failed to resume tracking for project {project_id}", exc_info=task.exception())
+
+    async def _run(self):
+        if self._restore is not None:
+            await self._restore_queued()
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                job_ids = sorted(self._tracker.tracked_jobs())
+                await asyncio.to_thread(job_writer.run, lambda session: self._renew(session, job_ids))
+                self._renewals += 1
+            except Exception:
+                logging.exception("Failed to renew tracking leases")
+            for tenant in self._tenants():
+                self.resume(tenant)
+
+    async def _restore_queued(self):
+        def projects() -> List[str]:
+            with Session(engine) as session:
+                return list(session.exec(select(TrackingTask.project_id).distinct()).all())
+
+        for project_id in await asyncio.to_thread(projects):
+            try:
+                tenant = await self._restore(project_id)
+            except Exception:
+                logging.exception(f"Failed to load project {project_id} to resume its tracking")
+                continue
+            if tenant is None:
+                logging.warning(f"Tracking of project {project_id} resumes once its credentials are loaded")
+            else:
+                self.resume(tenant)
+
+    def _renew(self, session: Session, job_ids: List[int]):
+        # Only jobs the tracker still follows are renewed, so a job it dropped (e.g. its
+        # finalization failed) loses its lease and gets picked up again by a sweep.
+        expiry = self._lease_expiry()
+        for i in range(0, len(job_ids), _IN_CHUNK):
+            session.execute(update(TrackingTask)
+                            .where(TrackingTask.lease_owner == self.worker_id,
+                                   TrackingTask.job_id.in_(job_ids[i:i + _IN_CHUNK]))
+                            .values(lease_expires_at=expiry))
+
+    def _release(self, session: Session):
+        session.execute(update(TrackingTask)
+                        .where(TrackingTask.lease_owner == self.worker_id)
+                        .values(lease_owner=None, lease_expires_at=None))
+
+    def _claim(self, session: Session, project_id: str) -> List[TrackingTask]:
+        # The claim's expiry doubles as its token: it tells the rows taken over here apart from
+        # the ones this worker already holds, e.g. a job whose request has not tracked it yet.
+        expiry = self._lease_expiry()
+        session.execute(update(TrackingTask)
+                        .where(TrackingTask.project_id == project_id,
+                               or_(TrackingTask.lease_owner.is_(None), TrackingTask.lease_expires_at < utcnow()))
+                        .values(lease_owner=self.worker_id, lease_expires_at=expiry))
+        return list(session.exec(select(TrackingTask).where(TrackingTask.project_id == project_id,
+                                                            TrackingTask.lease_owner == self.worker_id,
+                                                            TrackingTask.lease_expires_at == expiry)).all())
+
+    async def _resume(self, tenant: "Tenant"):
+        claimed = await asyncio.to_thread(job_writer.run, lambda session: self._claim(session, tenant.project_id))
+        tracked = self._tracker.tracked_jobs()
+        tasks = [task for task in claimed if task.job_id not in tracked]
+        if not tasks:
+            return
+
+        logging.info(f"Resuming tracking of {len(tasks)} operation(s) for project {tenant.project_id}")
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def reconcile(chunk: List[TrackingTask]):
+            async with semaphore:
+                while self._tracker.stats()["in_flight"] >= self.max_in_flight:
+                    await asyncio.sleep(1)
+
+                zone_operations = defaultdict(list)
+                for task in chunk:
+                    zone_operations[task.zone].append(task.operation_name)
+                errors: Dict[str, Exception] = {}
+                operations = await asyncio.to_thread(tenant.gcloud.get_operations_data, dict(zone_operations),
+                                                     errors)
+
+                tracked = self._tracker.tracked_jobs()
+                orphans = []
+                deferred = 0
+                for task in chunk:
+                    if task.job_id in tracked:
+                        continue
+                    if task.operation_name in operations:
+                        self._tracker.track(tenant.gcloud, task.zone, task.instance_name, task.operation_name,
+                                            task.job_id, task.job_type, task.receiver, attempt=task.attempt,
+                                            agcloud=tenant.agcloud)
+                        self._resumed += 1
+                    elif GCloud.is_not_found(errors.get(task.operation_name)):
+                        orphans.append(task)
+                    else:
+                        # Not renewed, so the claim lapses and the next sweep tries again.
+                        deferred += 1
+                if deferred:
+                    self._deferred += deferred
+                    logging.warning(f"Could not get {deferred} operation(s) of project {tenant.project_id}, "
+                                    f"retrying on the next sweep")
+                if orphans:
+                    await self._settle_orphans(tenant, orphans)
+
+        await asyncio.gather(*(reconcile(tasks[i:i + self.batch]) for i in range(0, len(tasks), self.batch)))
+
+    async def _settle_orphans(self, tenant: "Tenant", tasks: List[TrackingTask]):
+        # Compute no longer knows the operation, so the instance's current status is the best
+        # evidence of whether the job did what it was meant to.
+        instances = await asyncio.to_thread(tenant.gcloud.list_all_instances,
+                                            zones=sorted({task.zone for task in tasks}))
+        statuses = {(zone, instance.name): instance.status
+                    for zone, zone_instances in instances.items() for instance in zone_instances}
+
+        def settle(session: Session):
+            for task in tasks:
+                job = session.get(ParentJob, task.job_id)
+                if job is not None:
+                    job.status = OperationStatus.DONE
+                    job.is_successful = statuses.get((task.zone, task.instance_name)) == FINAL_STATUS[task.job_type]
+            session.execute(delete(TrackingTask).where(TrackingTask.id.in_([task.id for task in tasks])))
+
+        await asyncio.to_thread(job_writer.run, settle)
+        self._orphans += len(tasks)
+        logging.warning(f"Settled {len(tasks)} orphaned job(s) of project {tenant.project_id} from instance status")
+
+
+def release_job(session: Session, job_id: int):
+    """Removes a settled job from the tracking queue, inside the settling transaction."""
+    session.execute(delete(TrackingTask).where(TrackingTask.job_id == job_id))
+
+
+def requeue_job(session: Session, job_id: int, operation_name: str):
+    """Points a job's queue entry at the operation of its retry, inside the retry's transaction."""
+    session.execute(update(TrackingTask).where(TrackingTask.job_id == job_id)
+                    .values(operation_name=operation_name, attempt=TrackingTask.attempt + 1))
+
+
+tracking_queue = TrackingQueue()
@@ -1,18 +1,110 @@
+from sqlalchemy import delete, update
 from sqlmodel import Session, select
-from api.notification import send_email
-from core.enums import OperationStatus, OperationType
-from api.schema import ParentJob, engine, ChildJob
-import time, logging, os
+from core.enums import OperationType
+from api.schema import IdempotencyKey, ParentJob, ParentJobPublic, ChildJob, engine
+from api.jobstore import job_writer
+from api.tracking import release_job, requeue_job, tracking_queue
+from core.telemetry import CHILD_JOBS_CREATED
+import logging
 from datetime import datetime
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 
-sender = os.environ.get("SENDER")
-password = os.environ.get("PASSWORD")
+def create_parent_job(name, zone, operation, operation_type, project_id=None, receiver=None,
+                      schedule_id=None) -> ParentJobPublic:
+    """Records a newly issued operation as a ParentJob.
 
-def child_retry(zone, job, gcloud, session: Session):
-    """Retries the operation and logs the attempt in the database."""
+    With a receiver, the job is also queued for durable tracking in the same transaction.
+    """
+    return create_parent_jobs([(name, zone, operation)], operation_type, project_id, receiver, schedule_id)[0]
+
+def create_parent_jobs(issued, operation_type, project_id=None, receiver=None,
+                       schedule_id=None) -> List[ParentJobPublic]:
+    """Records many issued operations, given as (name, zone, operation), as ParentJobs in one transaction.
+
+    With a receiver, the jobs are also queued for durable tracking in the same transaction.
+    """
+    def write(session: Session) -> List[ParentJobPublic]:
+        parentjobs = [ParentJob(name=name, zone=zone,
+                                status=operation.status, type=operation_type,
+                                is_successful=False, project_id=project_id, operation=operation.name,
+                                schedule_id=schedule_id) for name, zone, operation in issued]
+        session.add_all(parentjobs)
+        session.flush()
+        if receiver is not None:
+            session.add_all([tracking_queue.task(parentjob, receiver) for parentjob in parentjobs])
+        return [ParentJobPublic(**parentjob.model_dump()) for parentjob in parentjobs]
+
+    return job_writer.run(write)
+
+def find_parent_job(project_id, job_id=None, operation=None) -> Optional[ParentJobPublic]:
+    """Gets a project's ParentJob by id or by the name of its current operation."""
+    with Session(engine) as session:
+        statement = select(ParentJob).where(ParentJob.project_id == project_id)
+        if job_id is not None:
+            statement = statement.where(ParentJob.id == job_id)
+        if operation is not None:
+            statement = statement.where(ParentJob.operation == operation)
+        parentjob = session.exec(statement.order_by(ParentJob.id.desc())).first()
+        return ParentJobPublic.model_validate(parentjob) if parentjob is not None else None
+
+def claim_idempotency_key(project_id, key, zone, instance_name, operation_type, expired_before,
+                          abandoned_before) -> Tuple[IdempotencyKey, bool]:
+    """Records the request an idempotency key is sent with, unless the key is already recorded.
+
+    A key recorded before `expired_before`, or left without a job since before `abandoned_before` by a
+    request that never finished, is recorded again for this request. Returns the key's record and
+    whether this call recorded it. Raises IntegrityError when another worker records the same key at
+    the same time.
+    """
+    def write(session: Session) -> Tuple[IdempotencyKey, bool]:
+        record = session.exec(select(IdempotencyKey).where((IdempotencyKey.project_id == project_id)
+                                                           & (IdempotencyKey.key == key))).first()
+        claimed = (record is None or record.created_at < expired_before
+                   or (record.job_id is None and record.created_at < abandoned_before))
+        if claimed:
+            if record is not None:
+                session.delete(record)
+                session.flush()
+            record = IdempotencyKey(project_id=project_id, key=key, zone=zone, instance_name=instance_name,
+                                    type=operation_type)
+            session.add(record)
+            session.flush()
+        return IdempotencyKey(**record.model_dump()), claimed
+
+    return job_writer.run(write)
+
+def bind_idempotency_key(project_id, key, job_id):
+    """Points an idempotency key at the job carrying out its request, unless it already points at one."""
+    def write(session: Session):
+        session.execute(update(IdempotencyKey)
+                        .where((IdempotencyKey.project_id == project_id) & (IdempotencyKey.key == key)
+                               & IdempotencyKey.job_id.is_(None))
+                        .values(job_id=job_id))
+
+    job_writer.run(write)
+
+def release_idempotency_key(project_id, key):
+    """Forgets an idempotency key whose request failed before any job carried it out, so a retry can use it."""
+    def write(session: Session):
+        session.execute(delete(IdempotencyKey)
+                        .where((IdempotencyKey.project_id == project_id) & (IdempotencyKey.key == key)
+                               & IdempotencyKey.job_id.is_(None)))
+
+    job_writer.run(write)
+
+def purge_idempotency_keys(expired_before) -> int:
+    """Deletes the idempotency keys recorded before `expired_before` and returns how many there were."""
+    def write(session: Session) -> int:
+        return session.execute(delete(IdempotencyKey)
+                               .where(IdempotencyKey.created_at < expired_before)).rowcount
+
+    return job_writer.run(write)
+
+def child_retry(zone, job, gcloud):
+    """Retries the operation, logs the attempt in the database and returns the new operation."""
     logging.info(f"Retrying {job.type} operation for ParentJob {job.id}")
 
     if job.type == OperationType.START:
@@ -21,53 +113,63 @@ def child_retry(zone, job, gcloud, session: Session):
         new_operation = gcloud.stop_instance(zone, job.name)
     else:
         logging.error(f"Unknown operation type for {job.name}. Cannot retry.")
-        return
+        return None
 
     # Log retry attempt in the database
-    child_job = ChildJob(parent_id=job.id,
-        is_successful=False,
-        request_time=datetime.fromisoformat(new_operation.timestamps.insertTime) if new_operation.timestamps.insertTime else None,
-        start_time=datetime.fromisoformat(new_operation.timestamps.startTime) if new_operation.timestamps.startTime else None,
-        end_time=datetime.fromisoformat(new_operation.timestamps.endTime) if new_operation.timestamps.endTime else None)
-
-    session.add(child_job)
-    session.commit()
-    session.refresh(child_job)
-
-    logging.info(f"Logged ChildJob {child_job.id} for retry of ParentJob {job.id}")
-
-def check_operation_status(zone, gcloud, receiver, operation_name, job, no_of_retries=3):
-    """Background task to monitor operation status, update the database, and trigger retries if needed."""
-    session = Session(engine)
-    retries = 0  
-
-    try:
-        while retries <= no_of_retries:
-            operation_data = gcloud.get_operation_data(zone, operation_name)
-
-            if operation_data.status in [OperationStatus.PENDING, OperationStatus.RUNNING]:
-                logging.info(f" Waiting... Operation {operation_name} is currently in {operation_data.status}")
-                time.sleep(3)
-
-            elif operation_data.status == OperationStatus.DONE:
-                print("CONFIRMED", operation_data.type)
-                send_email(sender, receiver, operation_data.type, password)
-                parentjob = session.exec(select(ParentJob).where((ParentJob.id == job.id) & (ParentJob.zone == zone))).first()
-                if parentjob.type == operation_data.type:
-                    parentjob.status = operation_data.status
-                    parentjob.is_successful = True
-                    session.commit()
-                    session.refresh(parentjob)
-                    logging.info(f"ParentJob {parentjob.id} completed successfully.")
-                    break  # Exit loop if operation was successful and type matches
-                else:
-                    logging.warning(
-                        f"ParentJob {parentjob.id} completed but has type `{operation_data.type}` instead of `{parentjob.type}`."
-                        f" Triggering retry ({retries + 1}/{no_of_retries})...")
-
-                    # Log a retry attempt as a new `ChildJob`
-                    child_retry(zone, job, session)
-                    retries += 1  # Increment retries after triggering a retry
-        logging.info(f"Operation status logged: {operation_data.name} - {operation_data.status} - {operation_data.type}")
-    finally:
-        session.close()  # Ensure the session is closed
+    def write(session: Session) -> int:
+        child_job = ChildJob(parent_id=job.id,
+            is_successful=False,
+            request_time=datetime.fromisoformat(new_operation.timestamps.insertTime) if new_operation.timestamps.insertTime else None,
+            start_time=datetime.fromisoformat(new_operation.timestamps.startTime) if new_operation.timestamps.startTime else None,
+            end_time=datetime.fromisoformat(new_operation.timestamps.endTime) if new_operation.timestamps.endTime else None)
+        session.add(child_job)
+        session.flush()
+        session.get(ParentJob, job.id).operation = new_operation.name
+        requeue_job(session, job.id, new_operation.name)
+        return child_job.id
+
+    child_job_id = job_writer.run(write)
+    CHILD_JOBS_CREATED.labels(job.type.value).inc()
+
+    logging.info(f"Logged ChildJob {child_job_id} for retry of ParentJob {job.id}")
+    return new_operation
+
+def finalize_operation(zone, gcloud, operation_data, job_id, retries=0, no_of_retries=3):
+    """Updates the database once an operation is done and triggers a retry if needed.
+
+    Returns the retry operation to track, or None when the job is settled.
+    """
+    logging.info(f"Operation {operation_data.name} is done with type {operation_data.type}")
+
+    def settle(session: Session) -> Optional[ParentJob]:
+        parentjob = session.exec(select(ParentJob).where((ParentJob.id == job_id) & (ParentJob.zone == zone))).first()
+        if parentjob is None:
+            logging.error(f"ParentJob {job_id} not found for operation {operation_data.name}")
+            release_job(session, job_id)
+            return None
+
+        if parentjob.type == operation_data.type:
+            parentjob.status = operation_data.status
+            parentjob.is_successful = True
+            release_job(session, job_id)
+            logging.info(f"ParentJob {parentjob.id} completed successfully.")
+            return None
+
+        if retries >= no_of_retries:
+            parentjob.status = operation_data.status
+            release_job(session, job_id)
+            logging.error(f"ParentJob {parentjob.id} gave up after {no_of_retries} retries.")
+            return None
+
+        logging.warning(
+            f"ParentJob {parentjob.id} completed but has type `{operation_data.type}` instead of `{parentjob.type}`."
+            f" Triggering retry ({retries + 1}/{no_of_retries})...")
+        return parentjob
+
+    # The retry itself calls the Compute API, so it runs outside the writer's transaction.
+    parentjob = job_writer.run(settle)
+    if parentjob is None:
+        return None
+
+    # Log a retry attempt as a new `ChildJob`
+    return child_retry(zone, parentjob, gcloud)
@@ -0,0 +1,419 @@
+"""
+Local fake of the Compute Engine API, to benchmark and load-test the backend offline.
+
+Serves the calls the backend makes, over HTTP, for one project:
+
+- `instances.aggregatedList`, `instances.list`, `instances.get`, `instances.start` and
+  `instances.stop`;
+- `zoneOperations.get`, `zoneOperations.list`, `zoneOperations.wait` and
+  `globalOperations.aggregatedList`, and `zoneOperations.get` in batch requests;
+- the OAuth token endpoint named in the service account key written by `--key`.
+
+List filters take Compute's `(field eq regex)` / `(field ne regex)` expressions, plus
+`>`/`<` comparisons on timestamps, and lists are paged with `maxResults`/`pageToken`.
+Every request but the token one waits `--latency` seconds (give or take `--jitter`); a
+`--error-rate` fraction fails with 503 `backendError` and a `--rate-limit-rate` fraction
+with 429 `rateLimitExceeded`. Start and stop operations are PENDING, RUNNING after a fifth
+of `--operation-seconds` and DONE after all of it, when the instance becomes RUNNING or
+TERMINATED. `GET /fake/stats` counts the requests served by kind.
+
+Run from the backend directory, then point the backend at it and upload the key:
+
+    python -m benchmarks.fake_compute --port 8090 --instances 5000 --key /tmp/fake-key.json
+    COMPUTE_ROOT_URL=http://127.0.0.1:8090/ uvicorn api.main:app
+"""
+import argparse
+import asyncio
+import email.parser
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+ZONES = [f"{region}-{suffix}" for region in ("us-central1", "us-east1", "europe-west1", "asia-east1")
+         for suffix in ("a", "b", "c")]
+MACHINE_TYPES = ["e2-small", "e2-medium", "n2-standard-4", "n2-standard-8", "c3-highcpu-22"]
+TEAMS = [f"team-{i}" for i in range(20)]
+COMPARISONS: Dict[str, Callable[[str, str], bool]] = {
+    ">": lambda a, b: a > b, ">=": lambda a, b: a >= b, "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+}
+
+
+@dataclass
+class FakeConfig:
+    project_id: str = "fake-project"
+    instances: int = 1000
+    zones: List[str] = field(default_factory=lambda: list(ZONES))
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    operation_seconds: float = 2.0
+    # `zoneOperations.wait` returns after at most this long, two minutes in Compute.
+    wait_seconds: float = 120.0
+    seed: int = 7
+
+
+@dataclass
+class FakeOperation:
+    data: dict
+    zone: str
+    instance: dict
+    final_status: str
+    created_at: float
+    done_at: float
+
+
+def now_rfc3339() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def parse_filter(expression: Optional[str]) -> List[Tuple[str, str, str]]:
+    """Splits a Compute filter into `(field, operator, value)` terms, all of which must match."""
+    expression = (expression or "").strip()
+    if not expression:
+        return []
+    if not expression.startswith("("):
+        expression = f"({expression})"
+
+    terms = []
+    i = 0
+    while i < len(expression):
+        if expression[i].isspace():
+            i += 1
+            continue
+        if expression[i] != "(":
+            raise ValueError(f"Invalid filter {expression!r}")
+        depth, j = 0, i
+        while j < len(expression):
+            depth += {"(": 1, ")": -1}.get(expression[j], 0)
+            if depth == 0:
+                break
+            j += 1
+        if depth:
+            raise ValueError(f"Unbalanced filter {expression!r}")
+        name, operator, value = expression[i + 1:j].strip().split(" ", 2)
+        if operator not in ("eq", "ne") and operator not in COMPARISONS:
+            raise ValueError(f"Unsupported filter operator {operator!r}")
+        terms.append((name, operator, value.strip().strip('"')))
+        i = j + 1
+    return terms
+
+
+def matches(resource: dict, terms: List[Tuple[str, str, str]]) -> bool:
+    for name, operator, value in terms:
+        current = resource
+        for part in name.split("."):
+            current = current.get(part, "") if isinstance(current, dict) else ""
+        current = str(current)
+        if operator in COMPARISONS:
+            if not current or not COMPARISONS[operator](current, value):
+                return False
+        elif (re.fullmatch(value, current) is not None) != (operator == "eq"):
+            return False
+    return True
+
+
+def page(items: list, params, default_size: int = 500) -> Tuple[list, Optional[str]]:
+    start = int(params.get("pageToken") or 0)
+    size = min(int(params.get("maxResults") or default_size), 500)
+    end = start + size
+    return items[start:end], str(end) if end < len(items) else None
+
+
+class FakeCompute:
+    """The state of the fake project: its instances and operations."""
+
+    def __init__(self, config: FakeConfig, root_url: str):
+        self.config = config
+        self.base = f"{root_url.rstrip('/')}/compute/v1/projects/{config.project_id}"
+        self.rng = random.Random(config.seed)
+        self.requests: Counter = Counter()
+        self.instances: Dict[str, Dict[str, dict]] = {zone: {} for zone in config.zones}
+        self.operations: Dict[str, FakeOperation] = {}
+        self._by_zone: Dict[str, List[FakeOperation]] = {zone: [] for zone in config.zones}
+        self._pending: Dict[str, FakeOperation] = {}
+
+        created = "2024-01-01T00:00:00.000-07:00"
+        for i in range(config.instances):
+            zone = config.zones[i % len(config.zones)]
+            name = f"vm-{i:06d}"
+            self.instances[zone][name] = {
+                "id": str(i), "name": name, "zone": f"{self.base}/zones/{zone}",
+                "status": self.rng.choice(["RUNNING", "TERMINATED"]),
+                "machineType": f"{self.base}/zones/{zone}/machineTypes/{self.rng.choice(MACHINE_TYPES)}",
+                "labels": {"team": self.rng.choice(TEAMS), "env": self.rng.choice(("dev", "staging", "prod"))},
+                "creationTimestamp": created, "lastStartTimestamp": created, "lastStopTimestamp": created,
+            }
+
+    def instance(self, zone: str, name: str) -> Optional[dict]:
+        self.settle()
+        return self.instances.get(zone, {}).get(name)
+
+    def mutate(self, zone: str, instance: dict, operation_type: str) -> dict:
+        self.settle()
+        duration = self.config.operation_seconds
+        if operation_type == "start":
+            final_status = "RUNNING"
+            if instance["status"] != "RUNNING":
+                instance["status"] = "STAGING"
+        else:
+            final_status = "TERMINATED"
+            if instance["status"] != "TERMINATED":
+                instance["status"] = "STOPPING"
+
+        name = f"operation-{int(time.time() * 1000)}-{uuid.uuid4().hex[:12]}"
+        created_at = time.monotonic()
+        operation = FakeOperation(
+            data={"name": name, "operationType": operation_type, "status": "PENDING", "insertTime": now_rfc3339(),
+                  "zone": f"{self.base}/zones/{zone}",
+                  "targetLink": f"{self.base}/zones/{zone}/instances/{instance['name']}"},
+            zone=zone, instance=instance, final_status=final_status,
+            created_at=created_at, done_at=created_at + duration)
+        self.operations[name] = operation
+        self._by_zone[zone].append(operation)
+        self._pending[name] = operation
+        return dict(operation.data)
+
+    def operation(self, zone: str, name: str) -> Optional[FakeOperation]:
+        operation = self.operations.get(name)
+        if operation is None or operation.zone != zone:
+            return None
+        self._advance(operation, time.monotonic())
+        return operation
+
+    def settle(self):
+        """Moves every operation along to where it would be now."""
+        now = time.monotonic()
+        for operation in list(self._pending.values()):
+            self._advance(operation, now)
+
+    def zone_operations(self, zone: str) -> List[dict]:
+        self.settle()
+        return [operation.data for operation in self._by_zone.get(zone, [])]
+
+    def _advance(self, operation: FakeOperation, now: float):
+        data = operation.data
+        if data["status"] == "DONE":
+            return
+        if now >= operation.done_at:
+            data.setdefault("startTime", data["insertTime"])
+            data["status"] = "DONE"
+            data["endTime"] = now_rfc3339()
+            del self._pending[data["name"]]
+            operation.instance["status"] = operation.final_status
+            stamp = "lastStartTimestamp" if operation.final_status == "RUNNING" else "lastStopTimestamp"
+            operation.instance[stamp] = data["endTime"]
+        elif now >= operation.created_at + (operation.done_at - operation.created_at) / 5:
+            data["status"] = "RUNNING"
+            data.setdefault("startTime", now_rfc3339())
+
+
+def error(code: int, reason: str, message: str) -> JSONResponse:
+    return JSONResponse(status_code=code,
+                        content={"error": {"code": code, "message": message, "errors": [{"reason": reason}]}})
+
+
+def create_app(fake: FakeCompute) -> FastAPI:
+    config = fake.config
+    app = FastAPI()
+    prefix = f"/compute/v1/projects/{config.project_id}"
+
+    @app.middleware("http")
+    async def simulate(request: Request, call_next):
+        if not request.url.path.startswith(("/compute/", "/batch/")):
+            return await call_next(request)
+        if config.latency or config.jitter:
+            await asyncio.sleep(max(0.0, config.latency + fake.rng.uniform(-config.jitter, config.jitter)))
+        draw = fake.rng.random()
+        if draw < config.error_rate:
+            fake.requests["error"] += 1
+            return error(503, "backendError", "Simulated backend error")
+        if draw < config.error_rate + config.rate_limit_rate:
+            fake.requests["rate_limited"] += 1
+            return error(429, "rateLimitExceeded", "Simulated rate limit")
+        return await call_next(request)
+
+    @app.post("/token")
+    async def token():
+        fake.requests["token"] += 1
+        return {"access_token": f"fake-{uuid.uuid4().hex}", "expires_in": 3600, "token_type": "Bearer"}
+
+    @app.get("/fake/stats")
+    async def stats():
+        fake.settle()
+        return {"requests": dict(fake.requests),
+                "operations": Counter(operation.data["status"] for operation in fake.operations.values()),
+                "instances": Counter(instance["status"] for zone in fake.instances.values()
+                                     for instance in zone.values())}
+
+    @app.get(prefix + "/aggregated/instances")
+    async def aggregated_instances(request: Request):
+        fake.requests["instances.aggregatedList"] += 1
+        fake.settle()
+        try:
+            terms = parse_filter(request.query_params.get("filter"))
+        except ValueError as e:
+            return error(400, "invalid", str(e))
+        listed = [(zone, instance) for zone, instances in fake.instances.items() for instance in instances.values()
+                  if matches(instance, terms)]
+        items, next_token = page(listed, request.query_params)
+        grouped: Dict[str, dict] = {}
+        for zone, instance in items:
+            grouped.setdefault(f"zones/{zone}", {"instances": []})["instances"].append(instance)
+        return {"items": grouped, "nextPageToken": next_token} if next_token else {"items": grouped}
+
+    @app.get(prefix + "/aggregated/operations")
+    async def aggregated_operations(request: Request):
+        fake.requests["globalOperations.aggregatedList"] += 1
+        terms = parse_filter(request.query_params.get("filter"))
+        listed = [(zone, data) for zone in fake.instances for data in fake.zone_operations(zone) if matches(data, terms)]
+        if request.query_params.get("orderBy") == "creationTimestamp desc":
+            listed.sort(key=lambda item: item[1]["insertTime"], reverse=True)
+        items, next_token = page(listed, request.query_params)
+        grouped: Dict[str, dict] = {}
+        for zone, data in items:
+            grouped.setdefault(f"zones/{zone}", {"operations": []})["operations"].append(data)
+        return {"items": grouped, "nextPageToken": next_token} if next_token else {"items": grouped}
+
+    @app.get(prefix + "/zones/{zone}/instances")
+    async def list_instances(zone: str, request: Request):
+        fake.requests["instances.list"] += 1
+        fake.settle()
+        try:
+            terms = parse_filter(request.query_params.get("filter"))
+        except ValueError as e:
+            return error(400, "invalid", str(e))
+        listed = [instance for instance in fake.instances.get(zone, {}).values() if matches(instance, terms)]
+        items, next_token = page(listed, request.query_params)
+        return {"items": items, "nextPageToken": next_token} if next_token else {"items": items}
+
+    @app.get(prefix + "/zones/{zone}/instances/{name}")
+    async def get_instance(zone: str, name: str):
+        fake.requests["instances.get"] += 1
+        instance = fake.instance(zone, name)
+        if instance is None:
+            return error(404, "notFound", f"The resource 'instances/{name}' was not found")
+        return instance
+
+    @app.post(prefix + "/zones/{zone}/instances/{name}/{action}")
+    async def mutate_instance(zone: str, name: str, action: str):
+        if action not in ("start", "stop"):
+            return error(400, "invalid", f"Unsupported action {action!r}")
+        fake.requests[f"instances.{action}"] += 1
+        instance = fake.instance(zone, name)
+        if instance is None:
+            return error(404, "notFound", f"The resource 'instances/{name}' was not found")
+        return fake.mutate(zone, instance, action)
+
+    @app.get(prefix + "/zones/{zone}/operations")
+    async def list_operations(zone: str, request: Request):
+        fake.requests["zoneOperations.list"] += 1
+        try:
+            terms = parse_filter(request.query_params.get("filter"))
+        except ValueError as e:
+            return error(400, "invalid", str(e))
+        listed = [data for data in fake.zone_operations(zone) if matches(data, terms)]
+        if request.query_params.get("orderBy") == "creationTimestamp desc":
+            listed.reverse()
+        items, next_token = page(listed, request.query_params)
+        return {"items": items, "nextPageToken": next_token} if next_token else {"items": items}
+
+    @app.get(prefix + "/zones/{zone}/operations/{name}")
+    async def get_operation(zone: str, name: str):
+        fake.requests["zoneOperations.get"] += 1
+        operation = fake.operation(zone, name)
+        if operation is None:
+            return error(404, "notFound", f"The resource 'operations/{name}' was not found")
+        return operation.data
+
+    @app.post("/batch/compute/v1")
+    async def batch(request: Request):
+        fake.requests["batch"] += 1
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode() + await request.body())
+        get_operation_path = re.compile(re.escape(prefix) + r"/zones/([^/]+)/operations/([^/?]+)")
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            method, path, _ = part.get_payload().split("\n", 1)[0].split(" ", 2)
+            target = get_operation_path.fullmatch(path.split("?", 1)[0])
+            if method != "GET" or target is None:
+                response = error(400, "invalid", f"Unsupported batched call {method} {path}")
+            else:
+                response = await get_operation(*target.groups())
+            if isinstance(response, JSONResponse):
+                status, body = response.status_code, response.body.decode()
+            else:
+                status, body = 200, json.dumps(response)
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                         f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: application/json; charset=UTF-8\r\n\r\n{body}\r\n")
+        return Response("".join(parts) + f"--{boundary}--\r\n",
+                        media_type=f"multipart/mixed; boundary={boundary}")
+
+    @app.post(prefix + "/zones/{zone}/operations/{name}/wait")
+    async def wait_operation(zone: str, name: str):
+        fake.requests["zoneOperations.wait"] += 1
+        operation = fake.operation(zone, name)
+        if operation is None:
+            return error(404, "notFound", f"The resource 'operations/{name}' was not found")
+        await asyncio.sleep(max(0.0, min(operation.done_at - time.monotonic(), config.wait_seconds)))
+        return fake.operation(zone, name).data
+
+    return app
+
+
+def write_key(path, project_id: str, token_uri: str):
+    """Writes a service account key for the fake project, whose tokens come from `token_uri`."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    Path(path).write_text(json.dumps({
+        "type": "service_account", "project_id": project_id, "private_key_id": "fake", "private_key": pem,
+        "client_email": f"benchmark@{project_id}.iam.gserviceaccount.com", "client_id": "0", "token_uri": token_uri,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--project", default="fake-project")
+    parser.add_argument("--instances", type=int, default=1000)
+    parser.add_argument("--zones", type=int, default=len(ZONES), choices=range(1, len(ZONES) + 1),
+                        metavar=f"1-{len(ZONES)}", help="Number of zones to spread instances over")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every API request takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests failing with 429")
+    parser.add_argument("--operation-seconds", type=float, default=2.0, help="How long start/stop operations take")
+    parser.add_argument("--wait-seconds", type=float, default=120.0, help="Longest zoneOperations.wait call")
+    parser.add_argument("--key", help="Write a service account key for the fake project to this path")
+    args = parser.parse_args()
+
+    config = FakeConfig(project_id=args.project, instances=args.instances, zones=ZONES[:args.zones], latency=args.latency,
+                        jitter=args.jitter, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                        operation_seconds=args.operation_seconds, wait_seconds=args.wait_seconds)
+    root_url = f"http://{args.host}:{args.port}/"
+    if args.key:
+        write_key(args.key, args.project, f"{root_url}token")
+    uvicorn.run(create_app(FakeCompute(config, root_url)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
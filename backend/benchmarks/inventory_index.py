@@ -0,0 +1,143 @@
+"""
+Memory and latency of the instance index against the inventory models.
+
+Builds a synthetic fleet of `--instances` InstanceData models spread over zones, machine
+types and label sets, indexes it, and compares:
+
+- the memory held by the models and by the index;
+- a `/list-server` response built the way it used to be (walking the models into dicts
+  that FastAPI encodes) against the index's cached and freshly joined JSON bodies;
+- a filtered listing (status + label) and a single-instance lookup, as a linear scan over
+  the models and through the index.
+
+Run from the backend directory:
+
+    python -m benchmarks.inventory_index --instances 50000
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from api.index import InstanceIndex
+from core.enums import InstanceStatus
+from core.models import InstanceData, InstanceTimestamps
+
+ZONES = [f"{region}-{suffix}" for region in ("us-central1", "us-east1", "europe-west1", "asia-east1")
+         for suffix in ("a", "b", "c")]
+MACHINE_TYPES = ["e2-small", "e2-medium", "n2-standard-4", "n2-standard-8", "c3-highcpu-22"]
+TEAMS = [f"team-{i}" for i in range(20)]
+
+
+def build_fleet(count: int) -> dict:
+    rng = random.Random(7)
+    fleet = {}
+    for i in range(count):
+        zone = ZONES[i % len(ZONES)]
+        fleet.setdefault(zone, []).append(InstanceData(
+            name=f"vm-{i:06d}", status=rng.choice(list(InstanceStatus)), zone=zone,
+            machineType=rng.choice(MACHINE_TYPES),
+            labels={"team": rng.choice(TEAMS), "env": rng.choice(("dev", "staging", "prod"))},
+            timestamps=InstanceTimestamps(creationTimestamp="2024-01-01T00:00:00.000-07:00", deletionTimestamp=None,
+                                          lastStartTimestamp="2024-06-01T08:00:00.000-07:00",
+                                          lastStopTimestamp="2024-06-01T19:00:00.000-07:00")))
+    return fleet
+
+
+def build_index(fleet: dict) -> InstanceIndex:
+    index = InstanceIndex("benchmark")
+    index.sync(fleet)
+    return index
+
+
+def allocated(build):
+    """Returns what `build` returns and the bytes it left allocated."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def peak(fn) -> int:
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+
+def timed_ms(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def models_response(fleet: dict) -> bytes:
+    result = []
+    for zone, instances in fleet.items():
+        for machine in instances:
+            result.append({"Instance Name": machine.name, "Instance Status": machine.status, "Zone": zone})
+    return JSONResponse(jsonable_encoder(result)).body
+
+
+def models_filter(fleet: dict) -> list:
+    return [instance for instances in fleet.values() for instance in instances
+            if instance.status == InstanceStatus.RUNNING and instance.labels.get("team") == "team-3"]
+
+
+def models_lookup(fleet: dict, zone: str, name: str):
+    return next(instance for instance in fleet[zone] if instance.name == name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    fleet, models_bytes = allocated(lambda: build_fleet(args.instances))
+    index, index_bytes = allocated(lambda: build_index(fleet))
+    print(f"  {args.instances} instances")
+    print(f"  memory:   models {models_bytes / 2**20:7.1f} MiB ({models_bytes / args.instances:5.0f} B/instance)"
+          f"   index {index_bytes / 2**20:7.1f} MiB ({index_bytes / args.instances:5.0f} B/instance)")
+
+    assert models_response(fleet) == index.to_json()
+
+    old = timed_ms(lambda: models_response(fleet), args.repeat)
+    cached = timed_ms(index.to_json, args.repeat)
+    last = fleet[ZONES[0]][-1]
+
+    statuses = [last.status, next(status for status in InstanceStatus if status != last.status)]
+
+    def rejoin():
+        statuses.reverse()
+        index.set_status(last.zone, last.name, statuses[0])
+        return index.to_json()
+
+    joined = timed_ms(rejoin, args.repeat)
+    print(f"  list:     models {old:8.2f} ms   index cached {cached:8.3f} ms   index after a change {joined:8.2f} ms")
+    print(f"  peak:     models {peak(lambda: models_response(fleet)) / 2**20:7.1f} MiB"
+          f"   index {peak(rejoin) / 2**20:7.1f} MiB per response")
+
+    scan = timed_ms(lambda: models_filter(fleet), args.repeat)
+    found = timed_ms(lambda: index.find(status=InstanceStatus.RUNNING, labels={"team": "team-3"}), args.repeat)
+    assert len(models_filter(fleet)) == len(index.find(status=InstanceStatus.RUNNING, labels={"team": "team-3"}))
+    print(f"  filter:   models {scan:8.2f} ms   index {found:8.3f} ms")
+
+    scan = timed_ms(lambda: models_lookup(fleet, last.zone, last.name), args.repeat) * 1000
+    found = timed_ms(lambda: index.get(last.zone, last.name), args.repeat) * 1000
+    print(f"  lookup:   models {scan:8.1f} us   index {found:8.3f} us")
+
+
+if __name__ == "__main__":
+    main()
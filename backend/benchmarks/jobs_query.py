@@ -0,0 +1,115 @@
+"""
+Latency of the /jobs history queries on a large job table.
+
+Seeds a temporary database with `--rows` ParentJobs (and one ChildJob for every tenth
+job) spread over a few projects, instances and zones, then times `query_jobs` for the
+filters the API exposes, first pages and deep cursor pages alike, and reports p50/p99.
+
+Run from the backend directory:
+
+    python -m benchmarks.jobs_query --rows 1000000
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlmodel import Session, SQLModel
+
+from api.jobs import query_jobs
+from api.schema import ChildJob, ParentJob, create_sqlite_engine
+from core.enums import OperationStatus, OperationType
+
+PROJECTS = [f"project-{i}" for i in range(4)]
+ZONES = ["us-central1-a", "us-central1-b", "europe-west1-b", "asia-east1-a"]
+INSTANCES = [f"vm-{i}" for i in range(2000)]
+
+
+def seed(engine, rows: int, chunk: int = 50_000):
+    SQLModel.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+    rng = random.Random(0)
+    parent = ParentJob.__table__
+    child = ChildJob.__table__
+
+    with engine.begin() as connection:
+        for offset in range(0, rows, chunk):
+            parents = []
+            children = []
+            for job_id in range(offset + 1, min(offset + chunk, rows) + 1):
+                created_at = start + timedelta(seconds=job_id * 30)
+                parents.append({
+                    "id": job_id,
+                    "name": rng.choice(INSTANCES),
+                    "zone": rng.choice(ZONES),
+                    "status": OperationStatus.DONE.name if rng.random() < 0.97 else OperationStatus.RUNNING.name,
+                    "type": rng.choice([OperationType.START.name, OperationType.STOP.name]),
+                    "is_successful": True,
+                    "project_id": rng.choice(PROJECTS),
+                    "created_at": created_at,
+                })
+                if job_id % 10 == 0:
+                    children.append({"parent_id": job_id, "is_successful": True, "request_time": created_at})
+            connection.execute(parent.insert(), parents)
+            if children:
+                connection.execute(child.insert(), children)
+    with engine.connect() as connection:
+        connection.exec_driver_sql("ANALYZE")
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(engine, name, iterations, **filters):
+    samples = []
+    with Session(engine) as session:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            query_jobs(session, random.choice(PROJECTS), **filters)
+            samples.append((time.perf_counter() - started) * 1000)
+    print(f"{name:>24}: p50 {statistics.median(samples):7.2f} ms  p99 {percentile(samples, 0.99):7.2f} ms")
+
+
+def measure_deep(engine, iterations, pages):
+    samples = []
+    with Session(engine) as session:
+        for _ in range(iterations):
+            cursor = None
+            project_id = random.choice(PROJECTS)
+            for _ in range(pages):
+                started = time.perf_counter()
+                page = query_jobs(session, project_id, cursor=cursor, limit=100)
+                samples.append((time.perf_counter() - started) * 1000)
+                cursor = page.next_cursor
+    print(f"{f'pages 1-{pages} (100 rows)':>24}: p50 {statistics.median(samples):7.2f} ms  p99 {percentile(samples, 0.99):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_sqlite_engine(f"sqlite:///{Path(tmp) / 'jobs.db'}")
+        started = time.perf_counter()
+        seed(engine, args.rows)
+        print(f"seeded {args.rows} jobs in {time.perf_counter() - started:.1f} s")
+
+        measure(engine, "newest page", args.iterations)
+        measure(engine, "by instance", args.iterations, instance=random.choice(INSTANCES))
+        measure(engine, "by zone", args.iterations, zone=random.choice(ZONES))
+        measure(engine, "by type and status", args.iterations,
+                type=OperationType.STOP, status=OperationStatus.RUNNING)
+        measure(engine, "time range", args.iterations,
+                since=datetime(2024, 3, 1), until=datetime(2024, 3, 2))
+        measure_deep(engine, max(1, args.iterations // 20), 20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Write throughput of the job store with many concurrent jobs.
+
+Every job inserts a ParentJob, moves it through RUNNING and settles it as DONE, the
+writes a tracked operation makes over its life. Three setups are compared:
+
+* legacy: default SQLite settings, one Session and commit per write (the old code path)
+* tuned: WAL/NORMAL/busy-timeout engine, still one Session and commit per write
+* writer: tuned engine with every write going through the batching JobWriter
+
+Run from the backend directory:
+
+    python -m benchmarks.jobstore --jobs 1000 --workers 64
+"""
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from api.jobstore import JobWriter
+from api.schema import ParentJob, create_sqlite_engine
+from core.enums import OperationStatus, OperationType
+
+
+def run_job(write):
+    def insert(session):
+        job = ParentJob(name="bench", zone="us-central1-a", status=OperationStatus.PENDING,
+                        type=OperationType.STOP, is_successful=False)
+        session.add(job)
+        session.flush()
+        return job.id
+
+    job_id = write(insert)
+
+    def update(status, successful):
+        def apply(session):
+            job = session.get(ParentJob, job_id)
+            job.status = status
+            job.is_successful = successful
+        return apply
+
+    write(update(OperationStatus.RUNNING, False))
+    write(update(OperationStatus.DONE, True))
+
+
+def session_per_write(engine):
+    def write(fn):
+        with Session(engine) as session:
+            result = fn(session)
+            session.commit()
+            return result
+    return write
+
+
+def measure(name, engine, write, jobs, workers):
+    SQLModel.metadata.create_all(engine)
+    started = time.perf_counter()
+    errors = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(run_job, write) for _ in range(jobs)]:
+            try:
+                future.result()
+            except Exception:
+                errors += 1
+    elapsed = time.perf_counter() - started
+    writes = jobs * 3
+    print(f"{name:>8}: {elapsed:7.2f} s  {writes / elapsed:9.0f} writes/s  {jobs / elapsed:8.0f} jobs/s  errors={errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = create_engine(f"sqlite:///{Path(tmp) / 'legacy.db'}", connect_args={"check_same_thread": False})
+        measure("legacy", legacy, session_per_write(legacy), args.jobs, args.workers)
+
+        tuned = create_sqlite_engine(f"sqlite:///{Path(tmp) / 'tuned.db'}")
+        measure("tuned", tuned, session_per_write(tuned), args.jobs, args.workers)
+
+        batched = create_sqlite_engine(f"sqlite:///{Path(tmp) / 'writer.db'}")
+        writer = JobWriter(batched)
+        measure("writer", batched, writer.run, args.jobs, args.workers)
+        writer.stop()
+        print(f"  writer batches: {writer.stats()['batches']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+End-to-end load test of the backend against the fake Compute API.
+
+Starts `benchmarks.fake_compute` and the backend (uvicorn) as subprocesses, the backend
+pointed at the fake with `COMPUTE_ROOT_URL` and a scratch database, uploads the fake
+project's key, then drives each scenario with `--concurrency` clients for `--duration`
+seconds:
+
+- `list`, `list-filtered`, `list-stream`: `/list-server`, whole, filtered on status and a
+  label, and as NDJSON;
+- `status`, `status-batch`: `/server-status` of a random instance, and of `--batch` random
+  instances in one POST;
+- `bulk`: `/bulk/stop` and `/bulk/start` by label selector, one team at a time, with
+  `--bulk-concurrency` clients; once they stop, `tracking` measures how long the tracker
+  takes to settle every job.
+
+The backend keeps its Compute rate limits (`COMPUTE_MUTATE_RATE`...), which bound the bulk
+scenario like Compute quotas would; raise them in the environment to load the backend itself.
+
+For every scenario it reports throughput, p50/p99/max latency, errors and the Compute
+requests made per backend request. `--save` writes the results as JSON, and
+`--baseline` compares against saved results and exits with status 1 when a scenario's
+throughput dropped or its p99 grew by more than `--tolerance`. `tests/test_load.py` runs
+the same gate under pytest, against the baseline in `LOAD_BASELINE`.
+
+Run from the backend directory:
+
+    python -m benchmarks.load --instances 5000 --latency 0.05 --duration 10 --save load.json
+    python -m benchmarks.load --instances 5000 --latency 0.05 --duration 10 --baseline load.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from benchmarks.fake_compute import TEAMS, ZONES
+
+SCENARIOS = ["list", "list-filtered", "list-stream", "status", "status-batch", "bulk"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spawn(args: List[str], workdir: Path, log: str, env: Optional[dict] = None) -> subprocess.Popen:
+    # Run in the scratch directory, so the backend's app.log lands there too.
+    backend = str(Path(__file__).resolve().parent.parent)
+    python_path = os.pathsep.join(filter(None, [backend, os.environ.get("PYTHONPATH")]))
+    with open(workdir / log, "w") as output:
+        return subprocess.Popen([sys.executable, *args], cwd=workdir, env={**os.environ, **(env or {}),
+                                                                           "PYTHONPATH": python_path},
+                                stdout=output, stderr=subprocess.STDOUT)
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with status {process.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} was not ready after {timeout} seconds")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def compute_requests(client: httpx.AsyncClient, fake_url: str) -> int:
+    requests = (await client.get(f"{fake_url}/fake/stats")).json()["requests"]
+    return sum(count for kind, count in requests.items() if kind != "token")
+
+
+async def drive(request: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]], client: httpx.AsyncClient,
+                concurrency: int, duration: float) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count()
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await request(client, next(counter))
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors += failed
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+    }
+
+
+def scenario_request(name: str, instances: int, zones: int,
+                     batch: int) -> Callable[[httpx.AsyncClient, int], Awaitable]:
+    rng = random.Random(7)
+
+    async def read_stream(client, url):
+        async with client.stream("GET", url) as response:
+            async for _ in response.aiter_bytes():
+                pass
+            return response
+
+    def instance(i: int):
+        vm = rng.randrange(instances)
+        return ZONES[vm % zones], f"vm-{vm:06d}"
+
+    def bulk(client, i):
+        action = "stop" if i % 2 == 0 else "start"
+        return client.post(f"/bulk/{action}", json={"labels": {"team": TEAMS[(i // 2) % len(TEAMS)]},
+                                                    "receiver": ""})
+
+    return {
+        "list": lambda client, i: client.get("/list-server"),
+        "list-filtered": lambda client, i: client.get("/list-server", params={
+            "status": "RUNNING", "label": f"team={TEAMS[i % len(TEAMS)]}"}),
+        "list-stream": lambda client, i: read_stream(client, "/list-server?stream=true"),
+        "status": lambda client, i: client.get("/server-status", params=dict(
+            zip(("zone", "instance_name"), instance(i)))),
+        "status-batch": lambda client, i: client.post("/server-status", json={"instances": [
+            dict(zip(("zone", "instance_name"), instance(i))) for _ in range(batch)]}),
+        "bulk": bulk,
+    }[name]
+
+
+async def settle_time(client: httpx.AsyncClient, timeout: float) -> float:
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        stats = (await client.get("/tracker-stats")).json()
+        if not stats["in_flight"] and not stats["completing"]:
+            return time.monotonic() - started
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"Jobs were not settled after {timeout} seconds")
+
+
+async def run(args) -> Dict[str, dict]:
+    workdir = Path(tempfile.mkdtemp(prefix="load-"))
+    fake_port, api_port = free_port(), free_port()
+    fake_url, api_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{api_port}"
+    key = workdir / "key.json"
+
+    fake = spawn(["-m", "benchmarks.fake_compute", "--port", str(fake_port), "--instances", str(args.instances),
+                  "--zones", str(args.zones), "--latency", str(args.latency), "--jitter", str(args.jitter),
+                  "--error-rate", str(args.error_rate), "--operation-seconds", str(args.operation_seconds),
+                  "--key", str(key)], workdir, "fake_compute.log")
+    api = None
+    results = {}
+    try:
+        async with httpx.AsyncClient(timeout=120) as probe:
+            await ready(probe, f"{fake_url}/fake/stats", fake)
+            api = spawn(["-m", "uvicorn", "api.main:app", "--port", str(api_port), "--log-level", "warning"],
+                        workdir, "api.log",
+                        env={"COMPUTE_ROOT_URL": f"{fake_url}/", "DATABASE_FILE": str(workdir / "load.db")})
+            await ready(probe, f"{api_url}/hello", api)
+            tenant = (await probe.post(f"{api_url}/load_config",
+                                       files={"file": ("key.json", key.read_bytes())})).json()["tenant"]
+
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=api_url, headers={"X-Tenant": tenant}, timeout=120,
+                                         limits=limits) as client:
+                await client.get("/list-server")
+                for name in args.scenarios:
+                    before = await compute_requests(probe, fake_url)
+                    concurrency = args.bulk_concurrency if name == "bulk" else args.concurrency
+                    result = await drive(scenario_request(name, args.instances, args.zones, args.batch), client,
+                                         concurrency, args.duration)
+                    calls = await compute_requests(probe, fake_url) - before
+                    result["compute_per_request"] = round(calls / max(result["requests"], 1), 2)
+                    results[name] = result
+                    print(f"  {name:14} {result['rps']:9.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+                          f"p99 {result['p99_ms']:8.2f} ms  max {result['max_ms']:8.2f} ms  "
+                          f"errors {result['errors']:5}  compute/req {result['compute_per_request']:6.2f}")
+
+                    if name == "bulk":
+                        operations = (await client.get("/tracker-stats")).json()["in_flight"]
+                        seconds = await settle_time(client, args.settle_timeout)
+                        results["tracking"] = {"settle_seconds": round(seconds, 2),
+                                               "in_flight": operations}
+                        print(f"  {'tracking':14} {operations} in-flight operations settled in {seconds:.2f} s")
+    finally:
+        for process in (api, fake):
+            if process is not None:
+                stop(process)
+    print(f"  logs in {workdir}")
+    return results
+
+
+def regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if "rps" in base and result["rps"] < base["rps"] * (1 - tolerance):
+            found.append(f"{name}: throughput {result['rps']} req/s, baseline {base['rps']} req/s")
+        if "p99_ms" in base and result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            found.append(f"{name}: p99 {result['p99_ms']} ms, baseline {base['p99_ms']} ms")
+        if "settle_seconds" in base and result["settle_seconds"] > base["settle_seconds"] * (1 + tolerance):
+            found.append(f"{name}: settled in {result['settle_seconds']} s, baseline {base['settle_seconds']} s")
+    return found
+
+
+def arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=5000)
+    parser.add_argument("--zones", type=int, default=len(ZONES), choices=range(1, len(ZONES) + 1),
+                        metavar=f"1-{len(ZONES)}")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every Compute request takes")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Compute requests failing")
+    parser.add_argument("--operation-seconds", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--bulk-concurrency", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=50, help="Instances per status-batch request")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds each scenario runs")
+    parser.add_argument("--settle-timeout", type=float, default=300.0)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--save", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="Fail when worse than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    return parser
+
+
+def main():
+    args = arguments().parse_args()
+
+    results = asyncio.run(run(args))
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        found = regressions(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in found:
+            print(f"  REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Recovery time of the durable tracking queue after a restart.
+
+Seeds a temporary database with `--pending` jobs whose tracking tasks are leased to a
+worker that is gone, then registers the project the way `/load_config` does and times
+how long the tracking queue takes to claim them, hand them to the tracker and get every
+job settled. Compute is faked: every list call takes `--latency` seconds and returns the
+operations as DONE, except for an `--orphaned` fraction it no longer knows about, which
+are settled from the instance status instead.
+
+Run from the backend directory:
+
+    python -m benchmarks.recovery --pending 10000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+# The job store binds to DATABASE_FILE on import, so point it at a scratch database first.
+os.environ["DATABASE_FILE"] = str(Path(tempfile.mkdtemp()) / "recovery.db")
+
+from api.jobstore import job_writer  # noqa: E402
+from api.schema import ParentJob, TrackingTask, create_db_and_tables, engine, utcnow  # noqa: E402
+from api.tracker import OperationTracker  # noqa: E402
+from api.tracking import TrackingQueue  # noqa: E402
+from core.enums import InstanceStatus, OperationStatus, OperationType  # noqa: E402
+from core.models import InstanceData, InstanceTimestamps, OperationData, OperationTimestamps  # noqa: E402
+
+PROJECT = "bench-project"
+ZONES = ["us-central1-a", "us-central1-b", "europe-west1-b"]
+
+
+class FakeGCloud:
+    OPERATION_BATCH_SIZE = 50
+
+    def __init__(self, latency: float, orphaned: set):
+        self.latency = latency
+        self.orphaned = orphaned
+        self.credentials = SimpleNamespace(project_id=PROJECT)
+        self.calls = 0
+
+    def get_operations_data(self, zone_operations):
+        results = {}
+        for zone, names in zone_operations.items():
+            for i in range(0, len(names), self.OPERATION_BATCH_SIZE):
+                self.calls += 1
+                time.sleep(self.latency)
+                for name in names[i:i + self.OPERATION_BATCH_SIZE]:
+                    if name not in self.orphaned:
+                        results[name] = OperationData(
+                            name=name, type=OperationType.STOP, status=OperationStatus.DONE, zone=zone,
+                            timestamps=OperationTimestamps(insertTime="2024-01-01T00:00:00+00:00",
+                                                           startTime=None, endTime=None))
+        return results
+
+    def list_all_instances(self, zones=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        timestamps = InstanceTimestamps(creationTimestamp="2024-01-01T00:00:00+00:00", deletionTimestamp=None,
+                                        lastStartTimestamp=None, lastStopTimestamp=None)
+        return {zone: [InstanceData(name=f"vm-{i}", status=InstanceStatus.TERMINATED, zone=zone,
+                                    machineType="e2-small", timestamps=timestamps) for i in range(100)]
+                for zone in zones or ZONES}
+
+
+def seed(pending: int, orphaned_every: int) -> set:
+    create_db_and_tables()
+    expired = utcnow()
+    orphaned = set()
+    jobs, tasks = [], []
+    for job_id in range(1, pending + 1):
+        zone = ZONES[job_id % len(ZONES)]
+        name = f"vm-{job_id % 100}"
+        operation = f"operation-{job_id}"
+        if orphaned_every and job_id % orphaned_every == 0:
+            orphaned.add(operation)
+        jobs.append({"id": job_id, "name": name, "zone": zone, "status": OperationStatus.RUNNING.name,
+                     "type": OperationType.STOP.name, "is_successful": False, "project_id": PROJECT,
+                     "created_at": expired, "operation": operation})
+        tasks.append({"job_id": job_id, "project_id": PROJECT, "zone": zone, "instance_name": name,
+                      "operation_name": operation, "job_type": OperationType.STOP.name, "receiver": "",
+                      "attempt": 0, "lease_owner": "gone-worker", "lease_expires_at": expired,
+                      "created_at": expired})
+    with engine.begin() as connection:
+        connection.execute(ParentJob.__table__.insert(), jobs)
+        connection.execute(TrackingTask.__table__.insert(), tasks)
+    return orphaned
+
+
+def remaining() -> int:
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("SELECT COUNT(*) FROM trackingtask").scalar()
+
+
+async def recover(args, orphaned: set):
+    gcloud = FakeGCloud(args.latency, orphaned)
+    tenant = SimpleNamespace(project_id=PROJECT, gcloud=gcloud, agcloud=None)
+    tracker = OperationTracker(min_interval=args.poll_interval)
+    queue = TrackingQueue(batch=args.batch, concurrency=args.concurrency, max_in_flight=args.max_in_flight)
+
+    await tracker.start()
+    await queue.start(tracker, lambda: [tenant])
+
+    started = time.perf_counter()
+    await queue.resume(tenant)
+    resumed = time.perf_counter() - started
+
+    while remaining():
+        await asyncio.sleep(0.05)
+    settled = time.perf_counter() - started
+
+    stats = queue.stats()
+    await queue.stop()
+    await tracker.stop()
+
+    print(f"   pending jobs: {args.pending} ({stats['orphans']} orphaned)")
+    print(f"  claimed+queued: {resumed:7.2f} s")
+    print(f"  all settled:    {settled:7.2f} s  ({args.pending / settled:.0f} jobs/s)")
+    print(f"  compute calls:  {gcloud.calls}  tracker polls: {tracker.stats()['polls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pending", type=int, default=10_000)
+    parser.add_argument("--orphaned-every", type=int, default=20, help="Every n-th operation is unknown to Compute")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake Compute call")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-in-flight", type=int, default=2000)
+    args = parser.parse_args()
+
+    orphaned = seed(args.pending, args.orphaned_every)
+    asyncio.run(recover(args, orphaned))
+    job_writer.stop()
+
+
+if __name__ == "__main__":
+    main()
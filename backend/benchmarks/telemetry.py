@@ -0,0 +1,99 @@
+"""
+Overhead of the Prometheus metrics and OpenTelemetry spans.
+
+Times a trivial function with and without the `instrumented` decorator, and a trivial
+FastAPI route with and without `MetricsMiddleware`, driven in-process through httpx's
+ASGI transport. Without a configured OpenTelemetry SDK the spans are no-ops, which is
+how the backend runs unless an exporter is set up; pass `--sdk` to measure with a
+recording tracer provider (requires opentelemetry-sdk).
+
+Exits with status 1 when the overhead goes over the given limits, so it can gate CI.
+
+Run from the backend directory:
+
+    python -m benchmarks.telemetry --calls 200000 --requests 5000
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from core.telemetry import MetricsMiddleware, instrumented
+
+
+def per_call_us(fn, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn(1, 2)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def measure_calls(calls: int) -> float:
+    def add(a, b):
+        return a + b
+
+    decorated = instrumented("benchmark")(add)
+    per_call_us(decorated, calls // 10)
+    bare = min(per_call_us(add, calls) for _ in range(3))
+    wrapped = min(per_call_us(decorated, calls) for _ in range(3))
+    print(f"   method call: {bare:8.3f} us bare  {wrapped:8.3f} us instrumented  +{wrapped - bare:.3f} us")
+    return wrapped - bare
+
+
+def build_app(instrument: bool) -> FastAPI:
+    app = FastAPI()
+    if instrument:
+        app.add_middleware(MetricsMiddleware)
+
+    @app.get("/ping/{name}")
+    async def ping(name: str):
+        return {"name": name}
+
+    return app
+
+
+async def per_request_us(app: FastAPI, requests: int) -> float:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for i in range(requests // 10):
+            await client.get(f"/ping/{i}")
+        started = time.perf_counter()
+        for i in range(requests):
+            await client.get(f"/ping/{i}")
+        return (time.perf_counter() - started) / requests * 1e6
+
+
+def measure_requests(requests: int) -> float:
+    bare = min(asyncio.run(per_request_us(build_app(False), requests)) for _ in range(3))
+    wrapped = min(asyncio.run(per_request_us(build_app(True), requests)) for _ in range(3))
+    print(f"  API request: {bare:8.1f} us bare  {wrapped:8.1f} us instrumented  +{wrapped - bare:.1f} us "
+          f"({(wrapped - bare) / bare:.1%})")
+    return wrapped - bare
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200_000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--max-call-overhead-us", type=float, default=50.0)
+    parser.add_argument("--max-request-overhead-us", type=float, default=150.0)
+    parser.add_argument("--sdk", action="store_true", help="Record spans with the OpenTelemetry SDK")
+    args = parser.parse_args()
+
+    if args.sdk:
+        from opentelemetry import trace
+        from opentelemetry.sdk.trace import TracerProvider
+        trace.set_tracer_provider(TracerProvider())
+
+    call_overhead = measure_calls(args.calls)
+    request_overhead = measure_requests(args.requests)
+
+    if call_overhead > args.max_call_overhead_us or request_overhead > args.max_request_overhead_us:
+        print("instrumentation overhead is over the limit")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+import asyncio
+from contextlib import aclosing
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import httpx
+
+from core.enums import InstanceStatus, OperationStatus, OperationType
+from core.gcloud import COMPUTE_ROOT_URL, GCloud, INSTANCE_FIELDS, OPERATION_FIELDS, _re_escape, load_credentials
+from core.models import InstanceData, OperationData
+from core.ratelimit import Family, RetryInfo, classify_status, error_reasons, get_limiter
+from core.telemetry import instrumented
+
+COMPUTE_URL = f"{COMPUTE_ROOT_URL.rstrip('/')}/compute/v1"
+
+# `zoneOperations.wait` returns after at most about two minutes, leave room for that.
+OPERATION_WAIT_REQUEST_TIMEOUT = 150.0
+
+
+class AsyncGCloud:
+    """
+    Asynchronous counterpart of `GCloud` talking to the Compute REST API over httpx.
+
+    All calls share one `httpx.AsyncClient`, so connections are kept alive and pooled, and
+    one set of credentials whose token is refreshed by a single caller at a time. Pass the
+    credentials of an existing `GCloud` to share its token as well.
+
+    Long-lived users such as operation waits `acquire` the client and `release` it when
+    done, and `aclose_when_idle` closes it only once the last of them has.
+    """
+
+    def __init__(self, credential_path: Optional[Union[str, Path]] = None,
+                 credentials=None,
+                 max_connections: int = 100, max_keepalive_connections: int = 20,
+                 timeout: float = 30.0):
+        if credentials is None:
+            credentials = load_credentials(credential_path)
+        self.credentials = credentials
+        self.client = httpx.AsyncClient(
+            base_url=f"{COMPUTE_URL}/projects/{self.credentials.project_id}",
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive_connections),
+            timeout=timeout
+        )
+        self.limiter = get_limiter(self.credentials.project_id)
+        self._token_lock = asyncio.Lock()
+        self._users = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+
+    @classmethod
+    def from_gcloud(cls, gcloud: GCloud, **kwargs) -> "AsyncGCloud":
+        return cls(credentials=gcloud.credentials, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def acquire(self) -> bool:
+        """Marks the client in use, unless it is being closed. Returns whether it was acquired."""
+        if self._closing:
+            return False
+        self._users += 1
+        self._idle.clear()
+        return True
+
+    def release(self):
+        self._users -= 1
+        if not self._users:
+            self._idle.set()
+
+    async def aclose_when_idle(self):
+        """Closes the client once every user that acquired it has released it. New users are refused meanwhile."""
+        self._closing = True
+        try:
+            await self._idle.wait()
+        finally:
+            await self.client.aclose()
+
+    @instrumented("async_gcloud")
+    async def list_all_instances(self, status: Optional[InstanceStatus] = None, zones: Optional[List[str]] = None,
+                                 labels: Optional[Dict[str, str]] = None,
+                                 name_prefix: Optional[str] = None) -> Dict[str, List[InstanceData]]:
+        """
+        Lists all compute instances in all zones for a Google Cloud project.
+
+        Args:
+            status (Optional[InstanceStatus]): Filter instances by status.
+            zones (Optional[List[str]]): Only list instances in these zones.
+            labels (Optional[Dict[str, str]]): Only list instances carrying all of these labels.
+            name_prefix (Optional[str]): Only list instances whose name starts with this prefix.
+
+        Returns:
+            Dict[str, List[InstanceData]]: A dictionary with zones as keys and a list of instances as values.
+        """
+        matches = {}
+        async for page, _ in self.iter_instance_pages(status, zones, labels, name_prefix):
+            for zone, instances in page.items():
+                matches.setdefault(zone, []).extend(instances)
+        return matches
+
+    async def iter_instance_pages(self, status: Optional[InstanceStatus] = None, zones: Optional[List[str]] = None,
+                                  labels: Optional[Dict[str, str]] = None, name_prefix: Optional[str] = None,
+                                  name: Optional[str] = None, machine_type: Optional[str] = None,
+                                  page_size: int = 500, page_token: Optional[str] = None
+                                  ) -> AsyncIterator[Tuple[Dict[str, List[InstanceData]], Optional[str]]]:
+        """
+        Lists compute instances one `aggregatedList` page at a time, as the pages arrive.
+
+        Args:
+            status (Optional[InstanceStatus]): Filter instances by status.
+            zones (Optional[List[str]]): Only list instances in these zones.
+            labels (Optional[Dict[str, str]]): Only list instances carrying all of these labels.
+            name_prefix (Optional[str]): Only list instances whose name starts with this prefix.
+            name (Optional[str]): Only list the instances with this exact name.
+            machine_type (Optional[str]): Only list instances of this machine type.
+            page_size (int): The maximum number of instances per page, at most 500.
+            page_token (Optional[str]): Resume the listing from the token of a previous page.
+
+        Yields:
+            Tuple[Dict[str, List[InstanceData]], Optional[str]]: The instances of the page by zone, and the token
+            of the next page, None on the last one.
+        """
+        params = {
+            "filter": GCloud._instance_filter(status, zones, labels, name_prefix, name, machine_type),
+            "fields": f"items/*/instances({INSTANCE_FIELDS}),nextPageToken",
+            "maxResults": min(page_size, 500),
+            "pageToken": page_token,
+        }
+
+        async for response in self._pages("/aggregated/instances", params):
+            yield GCloud._page_instances(response, status), response.get('nextPageToken')
+
+    @instrumented("async_gcloud")
+    async def start_instance(self, zone: str, instance_name: str) -> OperationData:
+        """
+        Starts a compute instance in a Google Cloud project.
+
+        Args:
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+
+        Returns:
+            OperationData: The operation data.
+        """
+        response = await self._request("POST", f"/zones/{zone}/instances/{instance_name}/start", family=Family.MUTATE)
+        return GCloud._to_operation_data(response, zone)
+
+    @instrumented("async_gcloud")
+    async def stop_instance(self, zone: str, instance_name: str) -> OperationData:
+        """
+        Stops a compute instance in a Google Cloud project.
+
+        Args:
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+
+        Returns:
+            OperationData: The operation data.
+        """
+        response = await self._request("POST", f"/zones/{zone}/instances/{instance_name}/stop", family=Family.MUTATE)
+        return GCloud._to_operation_data(response, zone)
+
+    @instrumented("async_gcloud")
+    async def get_instance_status(self, zone: str, instance_name: str) -> InstanceStatus:
+        """
+        Gets the status of a compute instance in a Google Cloud project.
+
+        Args:
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+
+        Returns:
+            InstanceStatus: The status of the instance.
+        """
+        response = await self._request("GET", f"/zones/{zone}/instances/{instance_name}",
+                                       params={"fields": "status"})
+        return InstanceStatus(response['status'])
+
+    @instrumented("async_gcloud")
+    async def get_instances_status(self, zone_instances: Dict[str, List[str]]) -> Dict[Tuple[str, str], InstanceStatus]:
+        """
+        Gets the status of many compute instances with one filtered list call per zone, zones in parallel.
+
+        Args:
+            zone_instances (Dict[str, List[str]]): Instance names keyed by zone.
+
+        Returns:
+            Dict[Tuple[str, str], InstanceStatus]: The statuses keyed by (zone, instance name). Instances that
+            do not exist are left out.
+        """
+        statuses = {}
+
+        async def list_zone(zone: str, instance_names: List[str]):
+            params = {
+                "filter": f"name eq ({'|'.join(_re_escape(name) for name in instance_names)})",
+                "fields": "items(name,status),nextPageToken",
+            }
+            async for response in self._pages(f"/zones/{zone}/instances", params):
+                for instance in response.get('items', []):
+                    statuses[(zone, instance['name'])] = InstanceStatus(instance['status'])
+
+        await asyncio.gather(*(
+            list_zone(zone, instance_names[i:i + GCloud.OPERATION_BATCH_SIZE])
+            for zone, instance_names in zone_instances.items()
+            for i in range(0, len(instance_names), GCloud.OPERATION_BATCH_SIZE)
+        ))
+        return statuses
+
+    @instrumented("async_gcloud")
+    async def get_operation_data(self, zone: str, operation_name: str) -> OperationData:
+        """
+        Gets the data of an operation in a Google Cloud project.
+
+        Args:
+            zone (str): The zone of the operation.
+            operation_name (str): The name of the operation.
+
+        Returns:
+            OperationData: The operation data.
+        """
+        response = await self._request("GET", f"/zones/{zone}/operations/{operation_name}",
+                                       params={"fields": OPERATION_FIELDS})
+        return GCloud._to_operation_data(response, zone)
+
+    @instrumented("async_gcloud")
+    async def wait_operation(self, zone: str, operation_name: str, timeout: Optional[float] = None) -> OperationData:
+        """
+        Waits until an operation is done with the `zoneOperations.wait` long-poll.
+
+        Each request blocks server-side until the operation is done or about two minutes
+        have passed. Cancelling the calling task aborts the request in flight.
+
+        Args:
+            zone (str): The zone of the operation.
+            operation_name (str): The name of the operation.
+            timeout (Optional[float]): Seconds to wait before giving up.
+
+        Returns:
+            OperationData: The data of the finished operation.
+
+        Raises:
+            asyncio.TimeoutError: The operation was not done in time.
+        """
+        async def wait_until_done() -> OperationData:
+            while True:
+                response = await self._request("POST", f"/zones/{zone}/operations/{operation_name}/wait",
+                                               params={"fields": OPERATION_FIELDS},
+                                               timeout=OPERATION_WAIT_REQUEST_TIMEOUT)
+                operation_data = GCloud._to_operation_data(response, zone)
+                if operation_data.status == OperationStatus.DONE:
+                    return operation_data
+
+        return await asyncio.wait_for(wait_until_done(), timeout)
+
+    @instrumented("async_gcloud")
+    async def get_operations_data(self, zone_operations: Dict[str, List[str]]) -> Dict[str, OperationData]:
+        """
+        Gets the data of many operations with one filtered list call per zone, zones in parallel.
+
+        Args:
+            zone_operations (Dict[str, List[str]]): Operation names keyed by zone.
+
+        Returns:
+            Dict[str, OperationData]: The operation data keyed by operation name.
+        """
+        results = {}
+
+        async def list_zone(zone: str, operation_names: List[str]):
+            params = {
+                "filter": f"name eq ({'|'.join(_re_escape(name) for name in operation_names)})",
+                "fields": f"items({OPERATION_FIELDS}),nextPageToken",
+            }
+            async for response in self._pages(f"/zones/{zone}/operations", params):
+                for operation in response.get('items', []):
+                    results[operation['name']] = GCloud._to_operation_data(operation, zone)
+
+        await asyncio.gather(*(
+            list_zone(zone, operation_names[i:i + GCloud.OPERATION_BATCH_SIZE])
+            for zone, operation_names in zone_operations.items()
+            for i in range(0, len(operation_names), GCloud.OPERATION_BATCH_SIZE)
+        ))
+        return results
+
+    @instrumented("async_gcloud")
+    async def get_instance_operations(self, zone: str, instance_name: str,
+                                      status: Optional[OperationStatus] = None) -> List[OperationData]:
+        """
+        Gets the operations of a compute instance in a Google Cloud project.
+
+        Supported operation types are in the OperationType enum.
+
+        Args:
+            zone (str): The zone of the instance.
+            instance_name (str): The name of the instance.
+            status (Optional[OperationStatus]): Filter operations by status. Defaults to [OperationStatus.RUNNING, OperationStatus.PENDING].
+
+        Returns:
+            List[OperationData]: A list of operation data, newest first.
+        """
+        if not status:
+            status = [OperationStatus.RUNNING, OperationStatus.PENDING]
+
+        if not isinstance(status, list):
+            status = [status]
+
+        return await self.scan_operations(zone, [instance_name], status=status)
+
+    @instrumented("async_gcloud")
+    async def scan_operations(self, zone: str, instance_names: Optional[List[str]] = None,
+                              status: Optional[List[OperationStatus]] = None,
+                              operation_types: Optional[List[OperationType]] = None,
+                              since: Optional[str] = None, until: Optional[str] = None,
+                              max_results: Optional[int] = None) -> List[OperationData]:
+        """
+        Scans the instance operations of a zone, newest first.
+
+        Instances, statuses and operation types are filtered by Compute, and operations are
+        listed newest first, so the scan stops at the first operation older than `since` or
+        once `max_results` operations are found instead of walking the zone's history.
+
+        Args:
+            zone (str): The zone to scan.
+            instance_names (Optional[List[str]]): Only operations on these instances. Defaults to all instances.
+            status (Optional[List[OperationStatus]]): Only operations in these statuses.
+            operation_types (Optional[List[OperationType]]): Only operations of these types. Defaults to every
+                type in the OperationType enum.
+            since (Optional[str]): RFC 3339 timestamp, only operations inserted at or after it.
+            until (Optional[str]): RFC 3339 timestamp, only operations inserted before it.
+            max_results (Optional[int]): Stop after this many operations.
+
+        Returns:
+            List[OperationData]: The matching operations, newest first.
+        """
+        operations = []
+        if max_results is not None and max_results <= 0:
+            return operations
+        async with aclosing(self._scan_zone(zone, instance_names, status, operation_types, since, until,
+                                            page_size=max_results or 500)) as scan:
+            async for _, operation in scan:
+                operations.append(operation)
+                if len(operations) == max_results:
+                    break
+        return operations
+
+    @instrumented("async_gcloud")
+    async def scan_instances_operations(self, zone_instances: Dict[str, List[str]],
+                                        status: Optional[List[OperationStatus]] = None,
+                                        operation_types: Optional[List[OperationType]] = None,
+                                        since: Optional[str] = None, until: Optional[str] = None,
+                                        max_per_instance: Optional[int] = None
+                                        ) -> Dict[Tuple[str, str], List[OperationData]]:
+        """
+        Scans the operations of many instances in one pass per zone, newest first, zones in parallel.
+
+        With `max_per_instance` the scan of a batch of names stops as soon as every instance
+        in it has that many operations.
+
+        Args:
+            zone_instances (Dict[str, List[str]]): Instance names keyed by zone.
+            status (Optional[List[OperationStatus]]): Only operations in these statuses.
+            operation_types (Optional[List[OperationType]]): Only operations of these types. Defaults to every
+                type in the OperationType enum.
+            since (Optional[str]): RFC 3339 timestamp, only operations inserted at or after it.
+            until (Optional[str]): RFC 3339 timestamp, only operations inserted before it.
+            max_per_instance (Optional[int]): Keep at most this many operations per instance.
+
+        Returns:
+            Dict[Tuple[str, str], List[OperationData]]: The operations keyed by (zone, instance name), newest
+            first. Instances without a matching operation are left out.
+        """
+        results = {}
+
+        async def scan_chunk(zone: str, instance_names: List[str]):
+            full = 0
+            async with aclosing(self._scan_zone(zone, instance_names, status, operation_types,
+                                                since, until)) as scan:
+                async for instance_name, operation in scan:
+                    operations = results.setdefault((zone, instance_name), [])
+                    if max_per_instance is not None and len(operations) >= max_per_instance:
+                        continue
+                    operations.append(operation)
+                    if len(operations) == max_per_instance:
+                        full += 1
+                        if full == len(set(instance_names)):
+                            return
+
+        await asyncio.gather(*(
+            scan_chunk(zone, instance_names[i:i + GCloud.OPERATION_BATCH_SIZE])
+            for zone, instance_names in zone_instances.items()
+            for i in range(0, len(instance_names), GCloud.OPERATION_BATCH_SIZE)
+        ))
+        return results
+
+    async def _scan_zone(self, zone: str, instance_names: Optional[List[str]],
+                         status: Optional[List[OperationStatus]], operation_types: Optional[List[OperationType]],
+                         since: Optional[str], until: Optional[str],
+                         page_size: int = 500) -> AsyncIterator[Tuple[str, OperationData]]:
+        since_time = datetime.fromisoformat(since) if since else None
+        until_time = datetime.fromisoformat(until) if until else None
+        params = {
+            "filter": GCloud._operation_filter(zone, instance_names, status, operation_types),
+            "fields": f"items({OPERATION_FIELDS},targetLink),nextPageToken",
+            "orderBy": "creationTimestamp desc",
+            "maxResults": min(page_size, 500),
+        }
+        async with aclosing(self._pages(f"/zones/{zone}/operations", params)) as pages:
+            async for response in pages:
+                scanned, past_since = GCloud._scan_page(response, zone, since_time, until_time)
+                for item in scanned:
+                    yield item
+                if past_since:
+                    return
+
+    async def _pages(self, url: str, params: dict):
+        params = {key: value for key, value in params.items() if value is not None}
+        while True:
+            response = await self._request("GET", url, params=params)
+            yield response
+            if not response.get('nextPageToken'):
+                return
+            params = {**params, "pageToken": response['nextPageToken']}
+
+    async def _request(self, method: str, url: str, params: Optional[dict] = None,
+                       timeout: Union[float, httpx.Timeout, None] = httpx.USE_CLIENT_DEFAULT,
+                       family: Family = Family.READ) -> dict:
+        async def send() -> dict:
+            response = await self.client.request(method, url, params=params, headers=await self._headers(),
+                                                 timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+        return await self.limiter.acall(family, send, self._retry_info)
+
+    @staticmethod
+    def _retry_info(error: BaseException) -> Optional[RetryInfo]:
+        if isinstance(error, httpx.HTTPStatusError):
+            response = error.response
+            return classify_status(response.status_code, error_reasons(response.text),
+                                   response.headers.get("retry-after"))
+        if isinstance(error, httpx.TransportError):
+            return RetryInfo(True, None)
+        return None
+
+    async def _headers(self) -> dict:
+        if not self.credentials.valid:
+            async with self._token_lock:
+                # Another caller may have refreshed the token while we waited for the lock.
+                if not self.credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        return {"Authorization": f"Bearer {self.credentials.token}"}
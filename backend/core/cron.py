@@ -0,0 +1,149 @@
+import bisect
+from datetime import datetime, timedelta, timezone
+from typing import List
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTH_NAMES = {name: i for i, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+WEEKDAY_NAMES = {name: i for i, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+
+# A schedule that cannot fire within this many years (e.g. "0 0 30 2 *") never fires.
+MAX_YEARS_AHEAD = 5
+
+
+class CronExpression:
+    """
+    Standard five-field cron expression (minute, hour, day of month, month, day of week)
+    evaluated in a time zone.
+
+    Fields take `*`, values, `a-b` ranges, `/step` and comma lists; months and weekdays
+    also take three-letter names, and Sunday is both 0 and 7. `@daily`-style macros are
+    accepted. As in cron, when both the day of month and the day of week are restricted, a
+    day matching either one fires.
+
+    Raises:
+        ValueError: If the expression or the time zone is invalid.
+    """
+
+    def __init__(self, expression: str, tz: str = "UTC"):
+        self.expression = expression
+        try:
+            self.tz = ZoneInfo(tz)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown time zone {tz!r}")
+
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} must have 5 fields")
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, MONTH_NAMES)
+        self.weekdays = sorted({day % 7 for day in _parse_field(fields[4], 0, 7, WEEKDAY_NAMES)})
+        # As in cron, a field starting with "*" (e.g. "*/1") does not restrict the day.
+        self._any_day = fields[2].startswith("*")
+        self._any_weekday = fields[4].startswith("*")
+
+    def next_after(self, after: datetime) -> datetime:
+        """
+        Gets the first time the expression fires strictly after a point in time.
+
+        Args:
+            after (datetime): A timezone-aware point in time.
+
+        Returns:
+            datetime: The next firing time, in UTC.
+
+        Raises:
+            ValueError: If the expression never fires.
+        """
+        local = after.astimezone(self.tz).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = local.year + MAX_YEARS_AHEAD
+
+        while local.year <= limit:
+            if local.month not in self.months:
+                month = _next_value(self.months, local.month)
+                year = local.year if month is not None else local.year + 1
+                local = datetime(year, month or self.months[0], 1)
+                continue
+            if not self._day_matches(local):
+                local = datetime(local.year, local.month, local.day) + timedelta(days=1)
+                continue
+            if local.hour not in self.hours:
+                hour = _next_value(self.hours, local.hour)
+                if hour is None:
+                    local = datetime(local.year, local.month, local.day) + timedelta(days=1)
+                else:
+                    local = local.replace(hour=hour, minute=0)
+                continue
+            if local.minute not in self.minutes:
+                minute = _next_value(self.minutes, local.minute)
+                if minute is None:
+                    local = local.replace(minute=0) + timedelta(hours=1)
+                else:
+                    local = local.replace(minute=minute)
+                continue
+
+            fires = local.replace(tzinfo=self.tz).astimezone(timezone.utc)
+            if fires > after:
+                return fires
+            # A wall clock time repeated by a DST change maps back before `after`.
+            local += timedelta(minutes=1)
+
+        raise ValueError(f"Cron expression {self.expression!r} never fires")
+
+    def upcoming(self, after: datetime, count: int) -> List[datetime]:
+        """Gets the next `count` firing times after a point in time, in UTC."""
+        times = []
+        for _ in range(count):
+            after = self.next_after(after)
+            times.append(after)
+        return times
+
+    def _day_matches(self, local: datetime) -> bool:
+        day = local.day in self.days
+        weekday = (local.isoweekday() % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _next_value(values: List[int], current: int):
+    """The smallest value greater than `current`, None when there is none."""
+    i = bisect.bisect_right(values, current)
+    return values[i] if i < len(values) else None
+
+
+def _parse_field(field: str, low: int, high: int, names: dict = None) -> List[int]:
+    values = set()
+    for part in field.lower().split(","):
+        range_part, _, step = part.partition("/")
+        try:
+            step = int(step) if step else 1
+            if range_part == "*":
+                start, end = low, high
+            else:
+                start_name, _, end_name = range_part.partition("-")
+                start = _parse_value(start_name, names)
+                end = _parse_value(end_name, names) if end_name else (high if step > 1 else start)
+        except ValueError:
+            raise ValueError(f"Invalid cron field {field!r}")
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"Invalid cron field {field!r}, values must be within {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+def _parse_value(value: str, names: dict = None) -> int:
+    if names and value in names:
+        return names[value]
+    return int(value)
@@ -1,65 +1,282 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
 from pathlib import Path
-from typing import Dict, List, Optional, Union
-from googleapiclient import discovery
-from google.oauth2 import service_account
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 from core.enums import InstanceStatus, OperationStatus, OperationType
 from core.models import OperationData, OperationTimestamps, InstanceData, InstanceTimestamps
+from core.ratelimit import Family, RetryInfo, classify_status, error_reasons, get_limiter
+from core.telemetry import instrumented
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+OPERATION_FIELDS = "name,operationType,status,insertTime,startTime,endTime"
+INSTANCE_FIELDS = ("name,status,zone,machineType,labels,creationTimestamp,"
+                   "deletionTimestamp,lastStartTimestamp,lastStopTimestamp")
+
+def _re_escape(value: str) -> str:
+    # Compute filters take RE2 patterns; unlike `re.escape` this leaves `-` alone.
+    return re.sub(r"([.^$*+?()\[\]{}|\\])", r"\\\1", value)
+
+DISCOVERY_URL = "https://compute.googleapis.com/$discovery/rest?version=v1"
+# Root of the Compute API. Point it at a local fake (benchmarks/fake_compute.py) to run without Google Cloud.
+COMPUTE_ROOT_URL = os.environ.get("COMPUTE_ROOT_URL", "https://compute.googleapis.com/")
+DISCOVERY_CACHE_DIR = Path(os.environ.get("DISCOVERY_CACHE_DIR", Path.home() / ".cache" / "gcp-vm-control"))
+DISCOVERY_MAX_AGE = timedelta(days=float(os.environ.get("DISCOVERY_MAX_AGE_DAYS", 7)))
+
+# Parsed credentials keyed by the SHA-256 of the key file, so re-uploading a key reuses its token.
+_credentials_cache = {}
+
+# Incremental syncs look back a little further than the last sync to absorb clock skew.
+SYNC_CLOCK_SKEW = timedelta(seconds=60)
+# Operations inserted up to this long before the last sync are still checked for having ended after it.
+SYNC_OPERATION_LOOKBACK = timedelta(seconds=float(os.environ.get("SYNC_OPERATION_LOOKBACK", 3600)))
+
+def _valid_document(document) -> bool:
+    return (isinstance(document, dict) and document.get('id') == 'compute:v1'
+            and {'instances', 'zoneOperations', 'globalOperations'} <= document.get('resources', {}).keys())
+
+def _read_cached_document(path: Path) -> Optional[dict]:
+    try:
+        age = timedelta(seconds=time.time() - path.stat().st_mtime)
+        if age > DISCOVERY_MAX_AGE:
+            logging.info(f"Discovery cache {path} is {age} old, ignoring it")
+            return None
+        document = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return document if _valid_document(document) else None
+
+def _fetch_document() -> dict:
+    import httplib2
+
+    response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+    if response.status != 200:
+        raise RuntimeError(f"Failed to fetch the Compute discovery document: HTTP {response.status}")
+    return json.loads(content)
+
+@functools.lru_cache(maxsize=None)
+def load_compute_document() -> dict:
+    """
+    Loads the Compute v1 discovery document once per process.
+
+    The document is read from the on-disk cache when it is valid and younger than
+    DISCOVERY_MAX_AGE, otherwise from the copy bundled with googleapiclient, and only
+    fetched over the network when neither is usable. Fetched documents are written
+    back to the cache.
+    """
+    from googleapiclient.discovery_cache import get_static_doc
+
+    path = DISCOVERY_CACHE_DIR / "compute.v1.json"
+    document = _read_cached_document(path)
+    if document is not None:
+        return document
+
+    static_doc = get_static_doc('compute', 'v1')
+    if static_doc is not None:
+        document = json.loads(static_doc)
+        if _valid_document(document):
+            return document
+
+    document = _fetch_document()
+    if not _valid_document(document):
+        raise RuntimeError("Fetched Compute discovery document is not valid")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(document))
+        tmp_path.replace(path)
+    except OSError:
+        logging.warning(f"Could not write the discovery cache to {path}")
+    return document
+
+def load_credentials(credential_path: Union[str, Path]):
+    """Loads service account credentials, reusing the ones already parsed for the same key."""
+    from google.oauth2 import service_account
+
+    raw = Path(credential_path).read_bytes()
+    digest = hashlib.sha256(raw).hexdigest()
+    credentials = _credentials_cache.get(digest)
+    if credentials is None:
+        credentials = service_account.Credentials.from_service_account_info(json.loads(raw), scopes=SCOPES)
+        _credentials_cache[digest] = credentials
+    return credentials
 
 class GCloud:
+    # Names per `zoneOperations().list` filter, keeps the filter expression well under the URL limit.
+    OPERATION_BATCH_SIZE = 50
+
     def __init__(self, credential_path: Union[str, Path]):
         self.credential_path = Path(credential_path)
-        self.credentials = service_account.Credentials.from_service_account_file(self.credential_path)
-        self.service = discovery.build('compute', 'v1', credentials=self.credentials)
+        self.credentials = load_credentials(self.credential_path)
 
-    def list_all_instances(self, status: Optional[InstanceStatus] = None) -> Dict[str, List[InstanceData]]:
+        from googleapiclient import discovery
+        document = load_compute_document()
+        if COMPUTE_ROOT_URL != document['rootUrl']:
+            # The root URL also makes the batch endpoint, which `api_endpoint` would leave pointing at Google.
+            document = {**document, 'rootUrl': f"{COMPUTE_ROOT_URL.rstrip('/')}/"}
+        self.service = discovery.build_from_document(document, credentials=self.credentials)
+        self.limiter = get_limiter(self.credentials.project_id)
+        self._local = threading.local()
+
+    @instrumented("gcloud")
+    def list_all_instances(self, status: Optional[InstanceStatus] = None, zones: Optional[List[str]] = None,
+                           labels: Optional[Dict[str, str]] = None,
+                           name_prefix: Optional[str] = None) -> Dict[str, List[InstanceData]]:
         """
         Lists all compute instances in all zones for a Google Cloud project, 
         abstracting zone management.
 
+        Filters are applied server-side and the response is trimmed to the fields
+        InstanceData needs, so pages stay small on large projects.
+
         Args:
             status (Optional[InstanceStatus]): Filter instances by status.
+            zones (Optional[List[str]]): Only list instances in these zones.
+            labels (Optional[Dict[str, str]]): Only list instances carrying all of these labels.
+            name_prefix (Optional[str]): Only list instances whose name starts with this prefix.
 
         Returns:
             Dict[str, List[InstanceData]]: A dictionary with zones as keys and a list of instances as values.
         """
-        request = self.service.instances().aggregatedList(project=self.credentials.project_id)
-
         matches = {}
-        
+        for page, _ in self.iter_instance_pages(status, zones, labels, name_prefix):
+            for zone, instances in page.items():
+                matches.setdefault(zone, []).extend(instances)
+        return matches
+
+    def iter_instance_pages(self, status: Optional[InstanceStatus] = None, zones: Optional[List[str]] = None,
+                            labels: Optional[Dict[str, str]] = None, name_prefix: Optional[str] = None,
+                            name: Optional[str] = None, machine_type: Optional[str] = None,
+                            page_size: int = 500,
+                            page_token: Optional[str] = None) -> Iterator[Tuple[Dict[str, List[InstanceData]], Optional[str]]]:
+        """
+        Lists compute instances one `aggregatedList` page at a time, as the pages arrive.
+
+        Args:
+            status (Optional[InstanceStatus]): Filter instances by status.
+            zones (Optional[List[str]]): Only list instances in these zones.
+            labels (Optional[Dict[str, str]]): Only list instances carrying all of these labels.
+            name_prefix (Optional[str]): Only list instances whose name starts with this prefix.
+            name (Optional[str]): Only list the instances with this exact name.
+            machine_type (Optional[str]): Only list instances of this machine type.
+            page_size (int): The maximum number of instances per page, at most 500.
+            page_token (Optional[str]): Resume the listing from the token of a previous page.
+
+        Yields:
+            Tuple[Dict[str, List[InstanceData]], Optional[str]]: The instances of the page by zone, and the token
+            of the next page, None on the last one.
+        """
+        request = self.service.instances().aggregatedList(
+            project=self.credentials.project_id,
+            filter=self._instance_filter(status, zones, labels, name_prefix, name, machine_type),
+            fields=f"items/*/instances({INSTANCE_FIELDS}),nextPageToken",
+            maxResults=min(page_size, 500),
+            pageToken=page_token
+        )
+
         while request is not None:
-            response = request.execute()
-            
-            for zone, instances_in_zone in response.get('items', {}).items():
-                if 'instances' in instances_in_zone:
-                    for instance in instances_in_zone['instances']:
-                        if status is None or instance['status'] == status.value:
-                            if zone.startswith('zones/'):
-                                zone = zone.split('/')[-1]
-                            machine_type_split = "/machineTypes/"
-                            if machine_type_split in instance["machineType"]:
-                                machine_type = instance["machineType"].split(machine_type_split)[1]
-                            
-                            instance_data = InstanceData(
-                                name=instance['name'],
-                                status=InstanceStatus(instance['status']),
-                                zone=zone,
-                                machineType=machine_type,
-                                timestamps=InstanceTimestamps(
-                                    creationTimestamp=instance['creationTimestamp'],
-                                    deletionTimestamp=instance.get('deletionTimestamp'),
-                                    lastStartTimestamp=instance.get('lastStartTimestamp'),
-                                    lastStopTimestamp=instance.get('lastStopTimestamp')
-                                )
-                            )
-                            instances = matches.get(zone, [])
-                            instances.append(instance_data)
-                            matches[zone] = instances
-            
+            response = self._execute(request)
+            yield self._page_instances(response, status), response.get('nextPageToken')
             request = self.service.instances().aggregatedList_next(previous_request=request, previous_response=response)
 
-        return matches
+    @instrumented("gcloud")
+    def get_changed_zones(self, since: str) -> Set[str]:
+        """
+        Gets the zones whose instances changed since a point in time.
+
+        An instance change always leaves a zone operation behind (start, stop, insert,
+        delete, preemption, guest shutdown...), so the zones of the instance operations
+        that ran after `since` are the zones that need to be listed again.
+
+        Operations are listed newest first, and the scan stops after the first page with
+        nothing inserted in the SYNC_OPERATION_LOOKBACK before `since`, which still covers
+        the operations that were running at the previous sync and ended after it. A second
+        pass filtered on status finds the operations that are still not done, however long
+        ago they started.
+
+        Args:
+            since (str): RFC 3339 timestamp of the previous sync.
+
+        Returns:
+            Set[str]: The names of the zones that changed.
+        """
+        since_time = datetime.fromisoformat(since)
+        cutoff = since_time - SYNC_OPERATION_LOOKBACK
+        request = self.service.globalOperations().aggregatedList(
+            project=self.credentials.project_id,
+            filter="targetLink eq .*/instances/.*",
+            fields="items/*/operations(zone,status,insertTime,endTime),nextPageToken",
+            orderBy="creationTimestamp desc",
+            maxResults=500
+        )
+
+        zones = set()
+
+        while request is not None:
+            response = self._execute(request)
 
+            recent = False
+            for zone, operation in self._aggregated_operations(response):
+                inserted = datetime.fromisoformat(operation['insertTime'])
+                end_time = operation.get('endTime')
+                recent = recent or inserted >= cutoff
+                if (operation['status'] != OperationStatus.DONE.value or inserted >= since_time
+                        or (end_time and datetime.fromisoformat(end_time) >= since_time)):
+                    zones.add(zone)
+            if not recent:
+                break
 
+            request = self.service.globalOperations().aggregatedList_next(previous_request=request, previous_response=response)
+
+        request = self.service.globalOperations().aggregatedList(
+            project=self.credentials.project_id,
+            filter=f"(targetLink eq .*/instances/.*) (status ne {OperationStatus.DONE.value})",
+            fields="items/*/operations(zone),nextPageToken",
+            maxResults=500
+        )
+        while request is not None:
+            response = self._execute(request)
+            zones.update(zone for zone, _ in self._aggregated_operations(response))
+            request = self.service.globalOperations().aggregatedList_next(previous_request=request, previous_response=response)
+
+        return zones
+
+    @instrumented("gcloud")
+    def sync_instances(self, previous: Optional[Dict[str, List[InstanceData]]] = None, since: Optional[str] = None,
+                       status: Optional[InstanceStatus] = None) -> Tuple[Dict[str, List[InstanceData]], str]:
+        """
+        Brings an instance listing up to date, re-listing only the zones that changed.
+
+        Without a previous listing this is a full `list_all_instances`.
+
+        Args:
+            previous (Optional[Dict[str, List[InstanceData]]]): The listing returned by the previous sync.
+            since (Optional[str]): The sync timestamp returned by the previous sync.
+            status (Optional[InstanceStatus]): Filter instances by status.
+
+        Returns:
+            Tuple[Dict[str, List[InstanceData]], str]: The up to date listing and its sync timestamp.
+        """
+        synced_at = (datetime.now(timezone.utc) - SYNC_CLOCK_SKEW).isoformat()
+
+        if previous is None or since is None:
+            return self.list_all_instances(status), synced_at
+
+        changed = self.get_changed_zones(since)
+        if not changed:
+            return previous, synced_at
+
+        instances = {zone: machines for zone, machines in previous.items() if zone not in changed}
+        instances.update(self.list_all_instances(status, zones=sorted(changed)))
+        return instances, synced_at
+
+    @instrumented("gcloud")
     def start_instance(self, zone: str, instance_name: str) -> OperationData:
         """
         Starts a compute instance in a Google Cloud project.
@@ -72,20 +289,11 @@ class GCloud:
             OperationData: The operation data.
         """
         request = self.service.instances().start(project=self.credentials.project_id, zone=zone, instance=instance_name)
-        response = request.execute()
+        response = self._execute(request, Family.MUTATE)
 
-        return OperationData(
-            name=response['name'],
-            type=OperationType(response['operationType']),
-            status=OperationStatus(response['status']),
-            zone=zone,
-            timestamps=OperationTimestamps(
-                insertTime=response['insertTime'],
-                startTime=response.get('startTime'),
-                endTime=response.get('endTime')
-            )
-        )
+        return self._to_operation_data(response, zone)
     
+    @instrumented("gcloud")
     def get_instance_status(self, zone: str, instance_name: str) -> InstanceStatus:
         """
         Gets the status of a compute instance in a Google Cloud project.
@@ -99,10 +307,39 @@ class GCloud:
         """
         request = self.service.instances().get(project=self.credentials.project_id,
                                                zone=zone, instance=instance_name)
-        response = request.execute()
+        response = self._execute(request)
         
         return InstanceStatus(response['status'])
     
+    @instrumented("gcloud")
+    def get_instances_status(self, zone_instances: Dict[str, List[str]]) -> Dict[Tuple[str, str], InstanceStatus]:
+        """
+        Gets the status of many compute instances with one filtered list call per zone.
+
+        Args:
+            zone_instances (Dict[str, List[str]]): Instance names keyed by zone.
+
+        Returns:
+            Dict[Tuple[str, str], InstanceStatus]: The statuses keyed by (zone, instance name). Instances that
+            do not exist are left out.
+        """
+        statuses = {}
+        for zone, instance_names in zone_instances.items():
+            for i in range(0, len(instance_names), self.OPERATION_BATCH_SIZE):
+                chunk = instance_names[i:i + self.OPERATION_BATCH_SIZE]
+                request = self.service.instances().list(
+                    project=self.credentials.project_id, zone=zone,
+                    filter=f"name eq ({'|'.join(_re_escape(name) for name in chunk)})",
+                    fields="items(name,status),nextPageToken"
+                )
+                while request is not None:
+                    response = self._execute(request)
+                    for instance in response.get('items', []):
+                        statuses[(zone, instance['name'])] = InstanceStatus(instance['status'])
+                    request = self.service.instances().list_next(previous_request=request, previous_response=response)
+        return statuses
+
+    @instrumented("gcloud")
     def stop_instance(self, zone: str, instance_name: str) -> OperationData:
         """
         Stops a compute instance in a Google Cloud project.
@@ -116,20 +353,11 @@ class GCloud:
         """
         request = self.service.instances().stop(project=self.credentials.project_id,
                                                 zone=zone, instance=instance_name)
-        response = request.execute()
+        response = self._execute(request, Family.MUTATE)
         
-        return OperationData(
-            name=response['name'],
-            type=OperationType(response['operationType']),
-            status=OperationStatus(response['status']),
-            zone=zone,
-            timestamps=OperationTimestamps(
-                insertTime=response['insertTime'],
-                startTime=response.get('startTime'),
-                endTime=response.get('endTime')
-            )
-        )
+        return self._to_operation_data(response, zone)
 
+    @instrumented("gcloud")
     def get_operation_data(self, zone: str, operation_name: str) -> OperationData:
         """
         Gets the data of an operation in a Google Cloud project.
@@ -143,20 +371,100 @@ class GCloud:
         """
         request = self.service.zoneOperations().get(project=self.credentials.project_id,
                                                     zone=zone, operation=operation_name)
-        response = request.execute()
+        response = self._execute(request)
 
-        return OperationData(
-            name=response['name'],
-            type=OperationType(response['operationType']),
-            status=OperationStatus(response['status']),
-            zone=zone,
-            timestamps=OperationTimestamps(
-                insertTime=response['insertTime'],
-                startTime=response.get('startTime'),
-                endTime=response.get('endTime')
-            )
-        )
+        return self._to_operation_data(response, zone)
+
+    @instrumented("gcloud")
+    def wait_operation(self, zone: str, operation_name: str, timeout: Optional[float] = None,
+                       cancel: Optional[threading.Event] = None) -> OperationData:
+        """
+        Waits until an operation is done with the `zoneOperations.wait` long-poll.
+
+        Each call blocks server-side until the operation is done or about two minutes have
+        passed, so completion is seen as soon as it happens at the cost of one request per
+        two minutes. The timeout and cancellation are checked between calls.
+
+        Args:
+            zone (str): The zone of the operation.
+            operation_name (str): The name of the operation.
+            timeout (Optional[float]): Seconds to wait before giving up.
+            cancel (Optional[threading.Event]): Stops waiting once set.
+
+        Returns:
+            OperationData: The data of the finished operation.
 
+        Raises:
+            TimeoutError: The operation was not done in time, or the wait was cancelled.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            request = self.service.zoneOperations().wait(project=self.credentials.project_id, zone=zone,
+                                                         operation=operation_name, fields=OPERATION_FIELDS)
+            operation_data = self._to_operation_data(self._execute(request), zone)
+            if operation_data.status == OperationStatus.DONE:
+                return operation_data
+            if cancel is not None and cancel.is_set():
+                raise TimeoutError(f"Wait for operation {operation_name} was cancelled")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Operation {operation_name} was not done after {timeout} seconds")
+
+    @instrumented("gcloud")
+    def get_operations_data(self, zone_operations: Dict[str, List[str]],
+                            errors: Optional[Dict[str, Exception]] = None) -> Dict[str, OperationData]:
+        """
+        Gets the data of many operations with one filtered list call per zone.
+
+        Operations the list call does not return are fetched with a single HTTP batch request.
+
+        Args:
+            zone_operations (Dict[str, List[str]]): Operation names keyed by zone.
+            errors (Optional[Dict[str, Exception]]): When given, filled with the error of every operation the
+                batch request failed to get, keyed by operation name, e.g. an `HttpError` 404 for an operation
+                Compute no longer knows.
+
+        Returns:
+            Dict[str, OperationData]: The operation data keyed by operation name.
+        """
+        results = {}
+        missing = []
+
+        for zone, operation_names in zone_operations.items():
+            for i in range(0, len(operation_names), self.OPERATION_BATCH_SIZE):
+                chunk = operation_names[i:i + self.OPERATION_BATCH_SIZE]
+                pattern = "|".join(_re_escape(name) for name in chunk)
+                request = self.service.zoneOperations().list(
+                    project=self.credentials.project_id, zone=zone,
+                    filter=f"name eq ({pattern})",
+                    fields=f"items({OPERATION_FIELDS}),nextPageToken"
+                )
+
+                while request is not None:
+                    response = self._execute(request)
+                    for operation in response.get('items', []):
+                        results[operation['name']] = self._to_operation_data(operation, zone)
+                    request = self.service.zoneOperations().list_next(previous_request=request, previous_response=response)
+
+                missing.extend((zone, name) for name in chunk if name not in results)
+
+        if missing:
+            def callback(request_id, response, exception):
+                zone, operation_name = missing[int(request_id)]
+                if exception is None:
+                    results[response['name']] = self._to_operation_data(response, zone)
+                elif errors is not None:
+                    errors[operation_name] = exception
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for i, (zone, operation_name) in enumerate(missing):
+                batch.add(self.service.zoneOperations().get(project=self.credentials.project_id,
+                                                            zone=zone, operation=operation_name),
+                          request_id=str(i))
+            self._execute(batch, cost=len(missing))
+
+        return results
+
+    @instrumented("gcloud")
     def get_instance_operations(self, zone: str, instance_name: str, status: Optional[OperationStatus] = None) -> List[OperationData]:
         """
         Gets the operations of a compute instance in a Google Cloud project.
@@ -169,7 +477,7 @@ class GCloud:
             status (Optional[OperationStatus]): Filter operations by status. Defaults to [OperationStatus.RUNNING, OperationStatus.PENDING].
 
         Returns:
-            List[OperationData]: A list of operation data.
+            List[OperationData]: A list of operation data, newest first.
         """
         if not status:
             status = [OperationStatus.RUNNING, OperationStatus.PENDING]
@@ -177,34 +485,229 @@ class GCloud:
         if not isinstance(status, list):
             status = [status]
 
-        status = [s.value for s in status]
+        return self.scan_operations(zone, [instance_name], status=status)
 
+    @instrumented("gcloud")
+    def scan_operations(self, zone: str, instance_names: Optional[List[str]] = None,
+                        status: Optional[List[OperationStatus]] = None,
+                        operation_types: Optional[List[OperationType]] = None,
+                        since: Optional[str] = None, until: Optional[str] = None,
+                        max_results: Optional[int] = None) -> List[OperationData]:
+        """
+        Scans the instance operations of a zone, newest first.
+
+        Instances, statuses and operation types are filtered by Compute, and operations are
+        listed newest first, so the scan stops at the first operation older than `since` or
+        once `max_results` operations are found instead of walking the zone's history.
+
+        Args:
+            zone (str): The zone to scan.
+            instance_names (Optional[List[str]]): Only operations on these instances. Defaults to all instances.
+            status (Optional[List[OperationStatus]]): Only operations in these statuses.
+            operation_types (Optional[List[OperationType]]): Only operations of these types. Defaults to every
+                type in the OperationType enum.
+            since (Optional[str]): RFC 3339 timestamp, only operations inserted at or after it.
+            until (Optional[str]): RFC 3339 timestamp, only operations inserted before it.
+            max_results (Optional[int]): Stop after this many operations.
+
+        Returns:
+            List[OperationData]: The matching operations, newest first.
+        """
+        operations = []
+        if max_results is not None and max_results <= 0:
+            return operations
+        for _, operation in self._scan_zone(zone, instance_names, status, operation_types, since, until,
+                                            page_size=max_results or 500):
+            operations.append(operation)
+            if len(operations) == max_results:
+                break
+        return operations
+
+    @instrumented("gcloud")
+    def scan_instances_operations(self, zone_instances: Dict[str, List[str]],
+                                  status: Optional[List[OperationStatus]] = None,
+                                  operation_types: Optional[List[OperationType]] = None,
+                                  since: Optional[str] = None, until: Optional[str] = None,
+                                  max_per_instance: Optional[int] = None) -> Dict[Tuple[str, str], List[OperationData]]:
+        """
+        Scans the operations of many instances in one pass per zone, newest first.
+
+        Answers questions like "which of these instances have an operation pending" with one
+        filtered, newest-first list call per zone and batch of names, rather than one scan
+        per instance. With `max_per_instance` the scan of a batch stops as soon as every
+        instance in it has that many operations.
+
+        Args:
+            zone_instances (Dict[str, List[str]]): Instance names keyed by zone.
+            status (Optional[List[OperationStatus]]): Only operations in these statuses.
+            operation_types (Optional[List[OperationType]]): Only operations of these types. Defaults to every
+                type in the OperationType enum.
+            since (Optional[str]): RFC 3339 timestamp, only operations inserted at or after it.
+            until (Optional[str]): RFC 3339 timestamp, only operations inserted before it.
+            max_per_instance (Optional[int]): Keep at most this many operations per instance.
+
+        Returns:
+            Dict[Tuple[str, str], List[OperationData]]: The operations keyed by (zone, instance name), newest
+            first. Instances without a matching operation are left out.
+        """
+        results = {}
+        for zone, instance_names in zone_instances.items():
+            for i in range(0, len(instance_names), self.OPERATION_BATCH_SIZE):
+                chunk = instance_names[i:i + self.OPERATION_BATCH_SIZE]
+                full = 0
+                for instance_name, operation in self._scan_zone(zone, chunk, status, operation_types, since, until):
+                    operations = results.setdefault((zone, instance_name), [])
+                    if max_per_instance is not None and len(operations) >= max_per_instance:
+                        continue
+                    operations.append(operation)
+                    if len(operations) == max_per_instance:
+                        full += 1
+                        if full == len(set(chunk)):
+                            break
+        return results
+
+    def _scan_zone(self, zone: str, instance_names: Optional[List[str]], status: Optional[List[OperationStatus]],
+                   operation_types: Optional[List[OperationType]], since: Optional[str], until: Optional[str],
+                   page_size: int = 500) -> Iterator[Tuple[str, OperationData]]:
+        since_time = datetime.fromisoformat(since) if since else None
+        until_time = datetime.fromisoformat(until) if until else None
         request = self.service.zoneOperations().list(
-            project=self.credentials.project_id, zone=zone, 
-            filter=f"targetLink eq https://www.googleapis.com/compute/v1/projects/{self.credentials.project_id}/zones/{zone}/instances/{instance_name}"
+            project=self.credentials.project_id, zone=zone,
+            filter=self._operation_filter(zone, instance_names, status, operation_types),
+            fields=f"items({OPERATION_FIELDS},targetLink),nextPageToken",
+            orderBy="creationTimestamp desc",
+            maxResults=min(page_size, 500)
         )
 
-        operations = []
-        operation_types = [operation_type.value for operation_type in OperationType]
-        
         while request is not None:
-            response = request.execute()
-            
-            for operation in response.get('items', []):
-                operation_type = operation['operationType']
-                if (status is None or operation['status'] in status) and operation_type in operation_types:
-                    operations.append(OperationData(
-                        name=operation['name'],
-                        type=OperationType(operation['operationType']),
-                        status=OperationStatus(operation['status']),
-                        zone=zone,
-                        timestamps=OperationTimestamps(
-                            insertTime=operation['insertTime'],
-                            startTime=operation.get('startTime'),
-                            endTime=operation.get('endTime')
-                        )
-                    ))
-            
+            response = self._execute(request)
+            scanned, past_since = self._scan_page(response, zone, since_time, until_time)
+            yield from scanned
+            if past_since:
+                return
             request = self.service.zoneOperations().list_next(previous_request=request, previous_response=response)
 
-        return operations
\ No newline at end of file
+    @staticmethod
+    def _operation_filter(zone: str, instance_names: Optional[List[str]] = None,
+                          status: Optional[List[OperationStatus]] = None,
+                          operation_types: Optional[List[OperationType]] = None) -> str:
+        names = "|".join(_re_escape(name) for name in instance_names) if instance_names else "[^/]+"
+        expressions = [f"(targetLink eq .*/zones/{_re_escape(zone)}/instances/({names}))"]
+        if status:
+            expressions.append(f"(status eq ({'|'.join(s.value for s in status)}))")
+        operation_types = operation_types or list(OperationType)
+        expressions.append(f"(operationType eq ({'|'.join(t.value for t in operation_types)}))")
+        return " ".join(expressions)
+
+    @staticmethod
+    def _scan_page(response: dict, zone: str, since_time: Optional[datetime],
+                   until_time: Optional[datetime]) -> Tuple[List[Tuple[str, OperationData]], bool]:
+        """
+        The instance names and data of a newest-first page's operations within the time range, and whether
+        the page went past `since`, which ends the scan.
+        """
+        scanned = []
+        for operation in response.get('items', []):
+            inserted = datetime.fromisoformat(operation['insertTime'])
+            if since_time is not None and inserted < since_time:
+                return scanned, True
+            if until_time is None or inserted < until_time:
+                scanned.append((operation['targetLink'].rsplit('/', 1)[-1], GCloud._to_operation_data(operation, zone)))
+        return scanned, False
+
+    def _execute(self, request, family: Family = Family.READ, cost: int = 1):
+        import google_auth_httplib2
+        import httplib2
+
+        # httplib2 connections are not thread-safe, so each thread gets its own authorized transport.
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+            self._local.http = http
+        return self.limiter.call(family, lambda: request.execute(http=http), self._retry_info, cost)
+
+    @staticmethod
+    def is_not_found(error: Optional[BaseException]) -> bool:
+        """Whether an error is Compute saying the resource does not exist."""
+        from googleapiclient.errors import HttpError
+
+        return isinstance(error, HttpError) and error.resp.status == 404
+
+    @staticmethod
+    def _retry_info(error: BaseException) -> Optional[RetryInfo]:
+        from googleapiclient.errors import HttpError
+        import httplib2
+
+        if isinstance(error, HttpError):
+            return classify_status(error.resp.status, error_reasons(error.content), error.resp.get('retry-after'))
+        if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+            return RetryInfo(True, None)
+        return None
+
+    @staticmethod
+    def _instance_filter(status: Optional[InstanceStatus] = None, zones: Optional[List[str]] = None,
+                         labels: Optional[Dict[str, str]] = None, name_prefix: Optional[str] = None,
+                         name: Optional[str] = None, machine_type: Optional[str] = None) -> Optional[str]:
+        expressions = []
+        if status is not None:
+            expressions.append(f"(status eq {status.value})")
+        if zones:
+            expressions.append(f"(zone eq .*/zones/({'|'.join(_re_escape(zone) for zone in zones)}))")
+        for key, value in (labels or {}).items():
+            expressions.append(f"(labels.{key} eq {_re_escape(value)})")
+        if name_prefix:
+            expressions.append(f"(name eq {_re_escape(name_prefix)}.*)")
+        if name:
+            expressions.append(f"(name eq {_re_escape(name)})")
+        if machine_type:
+            expressions.append(f"(machineType eq .*/machineTypes/{_re_escape(machine_type)})")
+        return " ".join(expressions) or None
+
+    @staticmethod
+    def _aggregated_operations(response: dict) -> Iterator[Tuple[str, dict]]:
+        """The zone operations of a `globalOperations.aggregatedList` page, with the name of their zone."""
+        for operations_in_scope in response.get('items', {}).values():
+            for operation in operations_in_scope.get('operations', []):
+                if 'zone' in operation:
+                    yield operation['zone'].split('/')[-1], operation
+
+    @staticmethod
+    def _page_instances(response: dict, status: Optional[InstanceStatus] = None) -> Dict[str, List[InstanceData]]:
+        matches = {}
+        for zone, instances_in_zone in response.get('items', {}).items():
+            if 'instances' in instances_in_zone:
+                zone = zone.split('/')[-1]
+                for instance in instances_in_zone['instances']:
+                    if status is None or instance['status'] == status.value:
+                        matches.setdefault(zone, []).append(GCloud._to_instance_data(instance, zone))
+        return matches
+
+    @staticmethod
+    def _to_instance_data(instance: dict, zone: str) -> InstanceData:
+        return InstanceData(
+            name=instance['name'],
+            status=InstanceStatus(instance['status']),
+            zone=zone,
+            machineType=instance['machineType'].split('/')[-1],
+            labels=instance.get('labels', {}),
+            timestamps=InstanceTimestamps(
+                creationTimestamp=instance['creationTimestamp'],
+                deletionTimestamp=instance.get('deletionTimestamp'),
+                lastStartTimestamp=instance.get('lastStartTimestamp'),
+                lastStopTimestamp=instance.get('lastStopTimestamp')
+            )
+        )
+
+    @staticmethod
+    def _to_operation_data(response: dict, zone: str) -> OperationData:
+        return OperationData(
+            name=response['name'],
+            type=OperationType(response['operationType']),
+            status=OperationStatus(response['status']),
+            zone=zone,
+            timestamps=OperationTimestamps(
+                insertTime=response['insertTime'],
+                startTime=response.get('startTime'),
+                endTime=response.get('endTime')
+            )
+        )
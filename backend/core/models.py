@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, Optional
 
 from pydantic import BaseModel
 
@@ -18,6 +18,7 @@ class InstanceData(BaseModel):
     status: InstanceStatus
     zone: str
     machineType: str
+    labels: Dict[str, str] = {}
     timestamps: InstanceTimestamps
 
 class OperationTimestamps(BaseModel):
@@ -0,0 +1,336 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, TypeVar
+
+from core.telemetry import COMPUTE_CIRCUIT_OPENED, COMPUTE_RETRIES
+
+COMPUTE_READ_RATE = float(os.environ.get("COMPUTE_READ_RATE", 20))
+COMPUTE_READ_BURST = float(os.environ.get("COMPUTE_READ_BURST", 40))
+COMPUTE_MUTATE_RATE = float(os.environ.get("COMPUTE_MUTATE_RATE", 10))
+COMPUTE_MUTATE_BURST = float(os.environ.get("COMPUTE_MUTATE_BURST", 20))
+COMPUTE_MAX_RETRIES = int(os.environ.get("COMPUTE_MAX_RETRIES", 5))
+COMPUTE_BACKOFF_BASE = float(os.environ.get("COMPUTE_BACKOFF_BASE", 0.5))
+COMPUTE_BACKOFF_MAX = float(os.environ.get("COMPUTE_BACKOFF_MAX", 30))
+COMPUTE_BREAKER_THRESHOLD = int(os.environ.get("COMPUTE_BREAKER_THRESHOLD", 10))
+COMPUTE_BREAKER_RESET = float(os.environ.get("COMPUTE_BREAKER_RESET", 30))
+
+# 403s carrying one of these reasons are rate limits rather than permission errors.
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+T = TypeVar("T")
+
+
+class RetryInfo(NamedTuple):
+    """Tells whether a failed call may be retried, and after how many seconds the server asked us to wait."""
+    retryable: bool
+    retry_after: Optional[float]
+    # Whether the API turned the call down for a rate limit, in which case it surely did nothing.
+    rate_limited: bool = False
+
+
+class Family(Enum):
+    READ = "read"
+    MUTATE = "mutate"
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the Compute API while a project's circuit breaker is open."""
+
+    def __init__(self, project_id: str, retry_after: float):
+        super().__init__(f"Compute API calls for project {project_id} are suspended after repeated failures, "
+                         f"retry in {retry_after:.0f}s")
+        self.project_id = project_id
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second, holding at most `burst`.
+
+    `reserve` takes the tokens right away, going into debt if needed, and returns how long
+    the caller has to sleep before using them, so sync and async callers can share a bucket.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.waits = 0
+        self.waited_seconds = 0.0
+
+    def reserve(self, cost: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            delay = max(0.0, -self._tokens / self.rate)
+            if delay:
+                self.waits += 1
+                self.waited_seconds += delay
+            return delay
+
+    def stats(self) -> dict:
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(tokens, 2),
+            "waits": self.waits,
+            "waited_seconds": round(self.waited_seconds, 3),
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive retryable failures and rejects calls for `reset_timeout`
+    seconds. After that a single trial call is let through (half-open): its success closes the
+    breaker, its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+        self.opened = 0
+        self.rejected = 0
+
+    def before_call(self) -> Optional[float]:
+        """Returns None when the call may go ahead, otherwise the seconds until the next trial."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return None
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return None
+            self.rejected += 1
+            return max(remaining, 0.0) or self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                COMPUTE_CIRCUIT_OPENED.inc()
+
+    def record_ignored(self):
+        """Releases a half-open trial whose call failed for a reason that says nothing about the API's health."""
+        with self._lock:
+            self._trial_running = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self._failures,
+                "opened": self.opened, "rejected": self.rejected}
+
+
+class ComputeLimiter:
+    """
+    Client-side protection for the Compute API calls of one project.
+
+    Every call takes a token from the bucket of its family, reads or mutations, which have
+    separate quotas upstream. Reads failing with a rate limit, a 5xx or a transport error are
+    retried with full-jitter exponential backoff, waiting at least as long as `Retry-After`
+    says. Mutations are only retried on a rate limit: after a 5xx or a lost connection the
+    operation may have been created, and starting or stopping the instance again is for the
+    caller to decide. Sustained failures of a family open its circuit breaker, which fails
+    that family's calls fast with `CircuitOpenError` instead of adding load to an API that
+    is already struggling, so failing mutations do not block reads and the other way round.
+
+    Callers pass a `classify` function that maps an exception to a `RetryInfo`, or None for
+    errors that are neither retried nor counted by the breaker (e.g. a 404).
+    """
+
+    def __init__(self, project_id: str, read_rate: float = COMPUTE_READ_RATE, read_burst: float = COMPUTE_READ_BURST,
+                 mutate_rate: float = COMPUTE_MUTATE_RATE, mutate_burst: float = COMPUTE_MUTATE_BURST,
+                 max_retries: int = COMPUTE_MAX_RETRIES, backoff_base: float = COMPUTE_BACKOFF_BASE,
+                 backoff_max: float = COMPUTE_BACKOFF_MAX, breaker_threshold: int = COMPUTE_BREAKER_THRESHOLD,
+                 breaker_reset: float = COMPUTE_BREAKER_RESET):
+        self.project_id = project_id
+        self.buckets = {
+            Family.READ: TokenBucket(read_rate, read_burst),
+            Family.MUTATE: TokenBucket(mutate_rate, mutate_burst),
+        }
+        self.breakers = {family: CircuitBreaker(breaker_threshold, breaker_reset) for family in Family}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {"calls": 0, "retries": 0, "failures": 0, "gave_up": 0}
+
+    def call(self, family: Family, fn: Callable[[], T], classify: Callable[[BaseException], Optional[RetryInfo]],
+             cost: int = 1) -> T:
+        """Runs `fn`, which makes `cost` API calls, under the limiter, sleeping the calling thread while it waits."""
+        attempt = 0
+        while True:
+            self._check_breaker(family)
+            delay = self.buckets[family].reserve(cost)
+            if delay:
+                time.sleep(delay)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._on_failure(e, family, attempt, classify)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(family)
+            return result
+
+    async def acall(self, family: Family, fn: Callable[[], Awaitable[T]],
+                    classify: Callable[[BaseException], Optional[RetryInfo]], cost: int = 1) -> T:
+        """Runs the coroutine returned by `fn` under the limiter, sleeping on the event loop while it waits."""
+        attempt = 0
+        while True:
+            self._check_breaker(family)
+            delay = self.buckets[family].reserve(cost)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                self.breakers[family].record_ignored()
+                raise
+            except Exception as e:
+                delay = self._on_failure(e, family, attempt, classify)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(family)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            "buckets": {family.value: bucket.stats() for family, bucket in self.buckets.items()},
+            "breakers": {family.value: breaker.stats() for family, breaker in self.breakers.items()},
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _check_breaker(self, family: Family):
+        retry_after = self.breakers[family].before_call()
+        if retry_after is not None:
+            raise CircuitOpenError(self.project_id, retry_after)
+        self._count("calls")
+
+    def _on_success(self, family: Family):
+        self.breakers[family].record_success()
+
+    def _on_failure(self, error: Exception, family: Family, attempt: int,
+                    classify: Callable[[BaseException], Optional[RetryInfo]]) -> float:
+        """Returns how long to wait before retrying, or re-raises the error."""
+        info = classify(error)
+        breaker = self.breakers[family]
+        if info is None:
+            # The API answered, it just did not like the request.
+            breaker.record_success()
+            raise error
+
+        retryable, retry_after, rate_limited = info
+        if family is Family.MUTATE and not rate_limited:
+            retryable = False
+        self._count("failures")
+        breaker.record_failure()
+        if not retryable or attempt >= self.max_retries:
+            if retryable:
+                self._count("gave_up")
+            raise error
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self._count("retries")
+        COMPUTE_RETRIES.labels(family.value).inc()
+        logging.warning(f"Compute API call for {self.project_id} failed ({error}), "
+                        f"retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        return delay
+
+
+_limiters: Dict[str, ComputeLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(project_id: str) -> ComputeLimiter:
+    """Returns the limiter of a project, shared by all of its `GCloud` and `AsyncGCloud` clients."""
+    with _limiters_lock:
+        limiter = _limiters.get(project_id)
+        if limiter is None:
+            limiter = _limiters[project_id] = ComputeLimiter(project_id)
+        return limiter
+
+
+def limiter_stats() -> dict:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {project_id: limiter.stats() for project_id, limiter in limiters.items()}
+
+
+def classify_status(status: int, reasons: set, retry_after: Optional[str]) -> Optional[RetryInfo]:
+    """
+    Classifies an HTTP error response of the Compute API.
+
+    Returns None for client errors, which are neither retried nor held against the API.
+    """
+    rate_limited = status == 429 or (status == 403 and bool(reasons & RATE_LIMIT_REASONS))
+    if rate_limited or status >= 500:
+        return RetryInfo(True, parse_retry_after(retry_after), rate_limited)
+    return None
+
+
+def error_reasons(body) -> set:
+    """Extracts the `error.errors[].reason` values of a Google API error body."""
+    try:
+        error = json.loads(body).get("error", {})
+        return {detail.get("reason") for detail in error.get("errors", [])}
+    except (TypeError, ValueError, AttributeError):
+        return set()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
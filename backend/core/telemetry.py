@@ -0,0 +1,136 @@
+import contextlib
+import functools
+import inspect
+import time
+from typing import Callable, ContextManager, Optional
+
+from opentelemetry import trace
+from prometheus_client import Counter, Gauge, Histogram
+
+tracer = trace.get_tracer("gcp-vm-control")
+
+_NO_SPAN = contextlib.nullcontext(trace.INVALID_SPAN)
+
+
+def tracing_enabled() -> bool:
+    """Whether an OpenTelemetry SDK has been installed; without one every span is a no-op."""
+    return not isinstance(trace.get_tracer_provider(), (trace.ProxyTracerProvider, trace.NoOpTracerProvider))
+
+
+def start_span(name: str, **kwargs) -> ContextManager[trace.Span]:
+    """Like `tracer.start_as_current_span`, but skips the context bookkeeping when tracing is off."""
+    if not tracing_enabled():
+        return _NO_SPAN
+    return tracer.start_as_current_span(name, **kwargs)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time until the response of an API request starts.",
+    ["method", "route", "status"])
+GCLOUD_CALL_SECONDS = Histogram(
+    "gcloud_call_duration_seconds", "Duration of GCloud and AsyncGCloud method calls, retries included.",
+    ["client", "method", "outcome"])
+OPERATION_DONE_SECONDS = Histogram(
+    "operation_time_to_done_seconds", "Time from tracking a job until it settles, retries included.",
+    ["type", "outcome"], buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, float("inf")))
+DB_COMMIT_SECONDS = Histogram(
+    "job_writer_commit_duration_seconds", "Duration of job writer transaction commits.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, float("inf")))
+TENANT_REGISTER_SECONDS = Histogram(
+    "tenant_register_duration_seconds", "Time to register the project of a key uploaded to /load_config.")
+DB_LAST_COMMIT_SECONDS = Gauge(
+    "job_writer_last_commit_seconds", "Duration of the most recent job writer commit.")
+TRACKED_OPERATIONS = Gauge(
+    "tracked_operations", "Operations currently tracked, by how they are watched.", ["mode"])
+JOB_WRITER_QUEUE = Gauge(
+    "job_writer_queue_depth", "Writes waiting for the job writer.")
+COMPUTE_RETRIES = Counter(
+    "compute_api_retries_total", "Compute API calls retried by the rate limiter.", ["family"])
+COMPUTE_CIRCUIT_OPENED = Counter(
+    "compute_api_circuit_opened_total", "Times a project's circuit breaker opened.")
+CHILD_JOBS_CREATED = Counter(
+    "child_jobs_created_total", "ChildJobs recorded for retried operations.", ["type"])
+
+
+def instrumented(client: str) -> Callable:
+    """
+    Decorates a GCloud/AsyncGCloud method to time it and run it in a span.
+    """
+    def decorator(fn: Callable) -> Callable:
+        name = fn.__name__
+        span_name = f"{client}.{name}"
+        labels = {outcome: GCLOUD_CALL_SECONDS.labels(client, name, outcome) for outcome in ("ok", "error")}
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = "error"
+                with start_span(span_name):
+                    try:
+                        result = await fn(*args, **kwargs)
+                        outcome = "ok"
+                        return result
+                    finally:
+                        labels[outcome].observe(time.perf_counter() - started)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = "error"
+                with start_span(span_name):
+                    try:
+                        result = fn(*args, **kwargs)
+                        outcome = "ok"
+                        return result
+                    finally:
+                        labels[outcome].observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request and running it in a server span.
+
+    Requests are labelled with their route template rather than the raw path, so path
+    parameters do not blow up the number of series. Latency is measured until the
+    response starts, which keeps streaming responses (/events, NDJSON) meaningful.
+    """
+
+    def __init__(self, app, skip: Optional[set] = None):
+        self.app = app
+        self.skip = skip or set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], getattr(route, "path", "unmatched"),
+                                        str(status)).observe(time.perf_counter() - started)
+
+        async def send_wrapper(message):
+            nonlocal status, observed
+            if message["type"] == "http.response.start" and not observed:
+                status = message["status"]
+                observed = True
+                observe()
+            await send(message)
+
+        with start_span(f"{scope['method']} {scope['path']}", kind=trace.SpanKind.SERVER) as span:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                if not observed:
+                    observe()
+                route = scope.get("route")
+                if span.is_recording():
+                    if route is not None:
+                        span.update_name(f"{scope['method']} {route.path}")
+                    span.set_attribute("http.status_code", status)
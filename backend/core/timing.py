@@ -0,0 +1,50 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class StartupTimer:
+    """
+    Records how long each phase of the backend's startup takes.
+
+    Phases are measured either as a block (`phase`) or as the time since the previous
+    mark (`mark`), which is how module imports are timed. `report`, called once startup is
+    done, logs the phases and warns when the total goes over the configured budget, so
+    regressions show up in the logs; the report is then kept in `last_report`.
+    """
+
+    def __init__(self, budget_ms: Optional[float] = None):
+        self.budget_ms = budget_ms
+        self.phases: Dict[str, float] = {}
+        self.last_report: Optional[dict] = None
+        self._started = time.perf_counter()
+        self._last_mark = self._started
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases[name] = (now - self._last_mark) * 1000
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (time.perf_counter() - started) * 1000
+            self._last_mark = time.perf_counter()
+
+    def report(self) -> dict:
+        total_ms = sum(self.phases.values())
+        report = {
+            "phases_ms": {name: round(duration, 2) for name, duration in self.phases.items()},
+            "total_ms": round(total_ms, 2),
+            "budget_ms": self.budget_ms,
+        }
+
+        logging.info(f"Startup timing: {report}")
+        if self.budget_ms is not None and total_ms > self.budget_ms:
+            logging.warning(f"Startup took {total_ms:.0f} ms, over the {self.budget_ms:.0f} ms budget")
+        self.last_report = report
+        return report
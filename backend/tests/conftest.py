@@ -0,0 +1,87 @@
+"""
+Shared fixtures: the fake Compute API of `benchmarks.fake_compute`, served by uvicorn in a
+thread, and clients of its project.
+
+The backend reads `COMPUTE_ROOT_URL` and its database path on import, so they are set here,
+before any test module imports it. Tests share one scratch database.
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+_scratch = Path(tempfile.mkdtemp(prefix="backend-tests-"))
+with socket.socket() as _sock:
+    _sock.bind(("127.0.0.1", 0))
+    FAKE_PORT = _sock.getsockname()[1]
+FAKE_URL = f"http://127.0.0.1:{FAKE_PORT}/"
+os.environ["COMPUTE_ROOT_URL"] = FAKE_URL
+os.environ.setdefault("DATABASE_FILE", str(_scratch / "test.db"))
+os.environ.setdefault("CREDENTIALS_DIR", "")
+
+import uvicorn  # noqa: E402
+
+from benchmarks.fake_compute import FakeCompute, FakeConfig, create_app, write_key  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_server():
+    fake = FakeCompute(FakeConfig(instances=20, zones=["zone-a", "zone-b"], operation_seconds=0.5), FAKE_URL)
+    server = uvicorn.Server(uvicorn.Config(create_app(fake), host="127.0.0.1", port=FAKE_PORT, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Fake Compute API did not start")
+        time.sleep(0.05)
+    yield fake
+    server.should_exit = True
+    thread.join(timeout=10)
+
+
+@pytest.fixture
+def fake_compute(fake_server):
+    """The fake Compute API, without simulated errors or latency and with its request counters reset."""
+    fake_server.config.error_rate = 0.0
+    fake_server.config.rate_limit_rate = 0.0
+    fake_server.config.latency = 0.0
+    fake_server.requests.clear()
+    yield fake_server
+    fake_server.config.error_rate = 0.0
+    fake_server.config.rate_limit_rate = 0.0
+    fake_server.config.latency = 0.0
+
+
+@pytest.fixture(scope="session")
+def fake_key(fake_server):
+    """A service account key of the fake project, whose tokens come from the fake."""
+    path = _scratch / "key.json"
+    write_key(path, fake_server.config.project_id, f"{FAKE_URL}token")
+    return path
+
+
+@pytest.fixture(scope="session")
+def database():
+    from api.schema import create_db_and_tables
+
+    create_db_and_tables()
+
+
+@pytest.fixture
+def new_tenant(fake_key):
+    """Makes tenants of the fake project. Call it inside the event loop using it, which its async client binds to."""
+    from api.tenants import Tenant
+    from core.async_gcloud import AsyncGCloud
+    from core.gcloud import GCloud
+
+    def make() -> Tenant:
+        gcloud = GCloud(credential_path=fake_key)
+        return Tenant(token="test", project_id=gcloud.credentials.project_id, gcloud=gcloud,
+                      agcloud=AsyncGCloud.from_gcloud(gcloud))
+
+    return make
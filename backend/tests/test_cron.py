@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from core.cron import CronExpression
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_stepped_wildcard_day_does_not_restrict_the_weekday():
+    # 2026-10-17 is a Saturday: "*/1" matches every day, so only the weekdays restrict it.
+    assert CronExpression("0 9 */1 * 1-5").next_after(utc(2026, 10, 17, 12)) == utc(2026, 10, 19, 9)
+    # "*/2" is Sunday, Tuesday, Thursday and Saturday, on any day of the month.
+    assert CronExpression("0 9 * * */2").upcoming(utc(2026, 10, 17, 12), 2) == [
+        utc(2026, 10, 18, 9), utc(2026, 10, 20, 9)]
+
+
+def test_day_of_month_or_day_of_week():
+    # Both restricted: the 13th or a Friday, whichever comes first.
+    assert CronExpression("0 0 13 * 5").upcoming(utc(2026, 10, 17), 3) == [
+        utc(2026, 10, 23), utc(2026, 10, 30), utc(2026, 11, 6)]
+    assert CronExpression("0 0 13 * 5").next_after(utc(2026, 11, 7)) == utc(2026, 11, 13)
+    # One of them a wildcard: only the other restricts the day.
+    assert CronExpression("0 0 13 * *").next_after(utc(2026, 10, 17)) == utc(2026, 11, 13)
+    assert CronExpression("0 0 * * 5").next_after(utc(2026, 10, 17)) == utc(2026, 10, 23)
+
+
+def test_names_and_sunday_as_seven():
+    assert CronExpression("30 8 * jan mon-fri").next_after(utc(2026, 10, 17)) == utc(2027, 1, 1, 8, 30)
+    assert CronExpression("0 0 * * 7").next_after(utc(2026, 10, 17)) == utc(2026, 10, 18)
+    assert CronExpression("0 0 * * sun").next_after(utc(2026, 10, 17)) == utc(2026, 10, 18)
+    assert CronExpression("@weekly").next_after(utc(2026, 10, 17)) == utc(2026, 10, 18)
+
+
+def test_fires_at_local_time_across_dst_changes():
+    # 09:00 in Berlin is 07:00 UTC in summer time and 08:00 UTC in winter time.
+    assert CronExpression("0 9 * * *", "Europe/Berlin").upcoming(utc(2026, 10, 24, 12), 2) == [
+        utc(2026, 10, 25, 8), utc(2026, 10, 26, 8)]
+    assert CronExpression("0 9 * * *", "Europe/Berlin").next_after(utc(2026, 3, 28, 12)) == utc(2026, 3, 29, 7)
+
+
+def test_dst_transitions_fire_once():
+    # 02:30 does not exist on 2026-03-29 in Berlin, the wall clock jumps from 02:00 to 03:00:
+    # it fires once, an hour late.
+    assert CronExpression("30 2 * * *", "Europe/Berlin").upcoming(utc(2026, 3, 28, 12), 2) == [
+        utc(2026, 3, 29, 1, 30), utc(2026, 3, 30, 0, 30)]
+    # 02:30 happens twice on 2026-10-25 in Berlin: it fires on the first one only.
+    assert CronExpression("30 2 * * *", "Europe/Berlin").upcoming(utc(2026, 10, 24, 12), 2) == [
+        utc(2026, 10, 25, 0, 30), utc(2026, 10, 26, 1, 30)]
+
+
+def test_invalid_expressions():
+    with pytest.raises(ValueError):
+        CronExpression("0 0 * *")
+    with pytest.raises(ValueError):
+        CronExpression("0 24 * * *")
+    with pytest.raises(ValueError):
+        CronExpression("0 0 * * *", "Mars/Olympus")
+    with pytest.raises(ValueError):
+        CronExpression("0 0 30 2 *").next_after(utc(2026, 10, 17))
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session, select
+
+from api.dedup import OperationCoalescer
+from api.schema import IdempotencyKey, ParentJob, engine, utcnow
+from api.tracker import OperationTracker
+from core.enums import OperationType
+
+ZONE = "zone-a"
+
+
+def jobs_of(instance_name: str) -> list:
+    with Session(engine) as session:
+        return session.exec(select(ParentJob).where(ParentJob.name == instance_name)).all()
+
+
+def run(new_tenant, scenario, precheck: bool = True):
+    """Runs `scenario(coalescer, tenant)` with a started tracker."""
+    async def main():
+        tracker = OperationTracker()
+        await tracker.start()
+        tenant = new_tenant()
+        try:
+            return await scenario(OperationCoalescer(tracker, precheck=precheck), tenant)
+        finally:
+            await tracker.stop()
+            await tenant.agcloud.aclose()
+    return asyncio.run(main())
+
+
+def test_concurrent_identical_requests_share_one_operation(fake_compute, database, new_tenant):
+    async def scenario(coalescer, tenant):
+        return await asyncio.gather(*(coalescer.run(tenant, ZONE, "vm-000002", OperationType.STOP, "")
+                                      for _ in range(5)))
+
+    jobs = run(new_tenant, scenario)
+
+    assert fake_compute.requests["instances.stop"] == 1
+    assert len({job.id for job in jobs}) == 1
+    assert len(jobs_of("vm-000002")) == 1
+
+
+def test_tracked_job_is_attached(fake_compute, database, new_tenant):
+    async def scenario(coalescer, tenant):
+        first = await coalescer.run(tenant, ZONE, "vm-000004", OperationType.STOP, "")
+        second = await coalescer.run(tenant, ZONE, "vm-000004", OperationType.STOP, "")
+        return first, second, coalescer.stats()
+
+    first, second, stats = run(new_tenant, scenario)
+
+    assert first.id == second.id
+    assert fake_compute.requests["instances.stop"] == 1
+    assert stats["attached_tracked"] == 1
+
+
+def test_idempotency_key_replays_the_job(fake_compute, database, new_tenant):
+    async def scenario(coalescer, tenant):
+        first = await coalescer.run(tenant, ZONE, "vm-000006", OperationType.START, "", idempotency_key="replay")
+        # A new tracker knows nothing of the first job, the key alone finds it.
+        coalescer.tracker = OperationTracker()
+        second = await coalescer.run(tenant, ZONE, "vm-000006", OperationType.START, "", idempotency_key="replay")
+        with pytest.raises(HTTPException) as raised:
+            await coalescer.run(tenant, ZONE, "vm-000008", OperationType.START, "", idempotency_key="replay")
+        return first, second, raised.value, coalescer.stats()
+
+    first, second, mismatch, stats = run(new_tenant, scenario, precheck=False)
+
+    assert first.id == second.id
+    assert fake_compute.requests["instances.start"] == 1
+    assert stats["replayed"] == 1
+    assert mismatch.status_code == 422
+
+
+def test_key_in_use_is_a_conflict(fake_compute, database, new_tenant):
+    async def scenario(coalescer, tenant):
+        results = await asyncio.gather(*(coalescer.run(tenant, ZONE, "vm-000010", OperationType.STOP, "",
+                                                       idempotency_key="in-use") for _ in range(2)),
+                                       return_exceptions=True)
+        return results
+
+    results = run(new_tenant, scenario)
+
+    conflicts = [result for result in results if isinstance(result, HTTPException)]
+    assert [conflict.status_code for conflict in conflicts] == [409]
+    assert fake_compute.requests["instances.stop"] == 1
+
+
+def test_expired_keys_are_swept_and_can_be_reused(fake_compute, database, new_tenant):
+    with Session(engine) as session:
+        session.add(IdempotencyKey(project_id=fake_compute.config.project_id, key="old", zone=ZONE,
+                                   instance_name="vm-000012", type=OperationType.STOP,
+                                   created_at=utcnow() - timedelta(days=2)))
+        session.commit()
+
+    async def scenario(coalescer, tenant):
+        job = await coalescer.run(tenant, ZONE, "vm-000014", OperationType.STOP, "", idempotency_key="old")
+        return job, coalescer.stats()
+
+    job, stats = run(new_tenant, scenario)
+
+    assert stats["keys_purged"] >= 1
+    with Session(engine) as session:
+        record = session.exec(select(IdempotencyKey).where(IdempotencyKey.key == "old")).one()
+    assert (record.instance_name, record.job_id) == ("vm-000014", job.id)
+
+
+def test_pending_upstream_operation_is_adopted(fake_compute, database, new_tenant):
+    operation = fake_compute.mutate(ZONE, fake_compute.instances[ZONE]["vm-000016"], "stop")
+
+    async def scenario(coalescer, tenant):
+        job = await coalescer.run(tenant, ZONE, "vm-000016", OperationType.STOP, "")
+        return job, coalescer.stats()
+
+    job, stats = run(new_tenant, scenario)
+
+    assert job.operation == operation["name"]
+    assert fake_compute.requests["instances.stop"] == 0
+    assert stats["attached_upstream"] == 1
+    assert len(jobs_of("vm-000016")) == 1
+
+
+def test_bulk_records_new_jobs_in_one_transaction(fake_compute, database, new_tenant, monkeypatch):
+    import api.dedup
+
+    writes = []
+    create_parent_jobs = api.dedup.create_parent_jobs
+    monkeypatch.setattr(api.dedup, "create_parent_jobs",
+                        lambda issued, *args: writes.append(len(issued)) or create_parent_jobs(issued, *args))
+    instances = [("zone-b", f"vm-{i:06d}") for i in (1, 3, 5, 7)]
+
+    async def scenario(coalescer, tenant):
+        return await coalescer.run_many(tenant, OperationType.START, instances + instances[:1], "")
+
+    results = run(new_tenant, scenario)
+
+    assert writes == [4]
+    assert sorted(results) == sorted(instances)
+    assert fake_compute.requests["instances.start"] == 4
@@ -0,0 +1,95 @@
+import asyncio
+from typing import AsyncIterator, List
+
+from api.events import EventBus
+
+PROJECT = "events-project"
+
+
+def frame_ids(frames: List[str]) -> List[int]:
+    return [int(frame.split("\n")[0].removeprefix("id: ")) for frame in frames if frame.startswith("id: ")]
+
+
+def frame_types(frames: List[str]) -> List[str]:
+    return [frame.split("\n")[1].removeprefix("event: ") for frame in frames if frame.startswith("id: ")]
+
+
+async def take(stream: AsyncIterator[str], count: int) -> List[str]:
+    return [await asyncio.wait_for(anext(stream), 1) for _ in range(count)]
+
+
+def test_resume_replays_missed_events_of_the_project():
+    bus = EventBus(history=10)
+
+    async def main():
+        seen = bus.publish("job", PROJECT, {"n": 1})
+        missed = [bus.publish("job", PROJECT, {"n": 2}),
+                  bus.publish("job", "other-project", {"n": 3}),
+                  bus.publish("instance", PROJECT, {"n": 4})]
+        stream = bus.subscribe(PROJECT, last_event_id=seen.id)
+        replayed = await take(stream, 2)
+        live = bus.publish("job", PROJECT, {"n": 5})
+        frames = replayed + await take(stream, 1)
+        await stream.aclose()
+        return frames, [missed[0].id, missed[2].id, live.id]
+
+    frames, expected = asyncio.run(main())
+
+    assert frame_ids(frames) == expected
+    assert bus.stats()["subscribers"] == 0
+
+
+def test_resume_from_before_the_history_resets():
+    bus = EventBus(history=3)
+
+    async def main():
+        first = bus.publish("job", PROJECT, {})
+        kept = [bus.publish("job", PROJECT, {}) for _ in range(4)][1:]
+        stream = bus.subscribe(PROJECT, last_event_id=first.id)
+        frames = await take(stream, 4)
+        await stream.aclose()
+
+        # Resuming from the reset event replays the whole history, and nothing else.
+        stream = bus.subscribe(PROJECT, last_event_id=frame_ids(frames)[0])
+        again = await take(stream, 3)
+        await stream.aclose()
+        return frames, again, [event.id for event in kept]
+
+    frames, again, kept = asyncio.run(main())
+
+    assert frame_types(frames) == ["reset", "job", "job", "job"]
+    assert frame_ids(frames) == [kept[0] - 1, *kept]
+    assert frame_ids(again) == kept
+
+
+def test_resume_from_the_latest_event_waits_for_new_ones():
+    bus = EventBus(history=3)
+
+    async def main():
+        last = bus.publish("job", PROJECT, {})
+        stream = bus.subscribe(PROJECT, last_event_id=last.id, heartbeat=0.05)
+        frames = await take(stream, 1)
+        await stream.aclose()
+        return frames
+
+    assert asyncio.run(main()) == [": ping\n\n"]
+
+
+def test_subscriber_falling_behind_is_cut_off():
+    bus = EventBus(history=2)
+
+    async def main():
+        stream = bus.subscribe(PROJECT)
+        first = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        events = [bus.publish("job", PROJECT, {}) for _ in range(4)]
+        frames = [await first]
+        async for frame in stream:
+            frames.append(frame)
+        return frames, events
+
+    frames, events = asyncio.run(main())
+
+    # The queue held the first two events when the third came, after them the stream ends.
+    assert frame_ids(frames) == [event.id for event in events[:2]]
+    assert bus.stats()["dropped"] == 1
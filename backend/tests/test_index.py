@@ -0,0 +1,88 @@
+import orjson
+
+from api.index import InstanceIndex
+from core.enums import InstanceStatus
+from core.models import InstanceData, InstanceTimestamps
+
+TIMESTAMPS = InstanceTimestamps(creationTimestamp="2024-01-01T00:00:00.000-07:00", deletionTimestamp=None,
+                                lastStartTimestamp=None, lastStopTimestamp=None)
+
+
+def instance(zone: str, name: str, status: InstanceStatus, machine_type: str = "e2-small", **labels) -> InstanceData:
+    return InstanceData(name=name, status=status, zone=zone, machineType=machine_type, labels=labels,
+                        timestamps=TIMESTAMPS)
+
+
+def listing() -> dict:
+    return {
+        "zone-a": [instance("zone-a", "vm-1", InstanceStatus.RUNNING, team="web"),
+                   instance("zone-a", "vm-2", InstanceStatus.TERMINATED, "e2-medium", team="web", env="prod")],
+        "zone-b": [instance("zone-b", "vm-3", InstanceStatus.RUNNING, team="data", env="prod")],
+    }
+
+
+def names(records) -> list:
+    return [record.name for record in records]
+
+
+def test_lookups_intersect_the_secondary_indexes():
+    index = InstanceIndex("project")
+    assert len(index.sync(listing())) == 3
+
+    assert index.get("zone-a", "vm-2").machine_type == "e2-medium"
+    assert index.get("zone-b", "vm-1") is None
+    assert names(index.find(status=InstanceStatus.RUNNING)) == ["vm-1", "vm-3"]
+    assert names(index.find(labels={"env": "prod"}, status=InstanceStatus.RUNNING)) == ["vm-3"]
+    assert names(index.find(zone="zone-a", labels={"team": "web"}, machine_type="e2-small")) == ["vm-1"]
+    assert index.find(labels={"team": "nobody"}) == []
+    # Instances with the same labels share one label set.
+    index.sync({**listing(), "zone-c": [instance("zone-c", "vm-4", InstanceStatus.RUNNING, team="web")]})
+    assert index.get("zone-c", "vm-4").labels is index.get("zone-a", "vm-1").labels
+    assert index.stats()["label_sets"] == 3
+
+
+def test_sync_reports_changes_and_removes_missing_instances():
+    index = InstanceIndex("project")
+    index.sync(listing())
+
+    updated = listing()
+    updated["zone-a"] = [instance("zone-a", "vm-1", InstanceStatus.STOPPING, team="web")]
+    changed = index.sync(updated)
+
+    assert names(changed) == ["vm-1"]
+    assert index.get("zone-a", "vm-2") is None
+    assert len(index) == 2
+    assert names(index.find(status=InstanceStatus.TERMINATED)) == []
+    assert index.stats()["statuses"] == {"STOPPING": 1, "RUNNING": 1}
+
+    del updated["zone-b"]
+    index.sync(updated)
+    assert names(index.find()) == ["vm-1"]
+
+
+def test_zones_whose_listing_is_unchanged_are_skipped():
+    index = InstanceIndex("project")
+    instances = listing()
+    index.sync(instances)
+
+    # Incremental syncs reuse the very list of a zone that did not change.
+    instances["zone-b"][0].status = InstanceStatus.TERMINATED
+    assert index.sync(dict(instances)) == []
+    assert index.get("zone-b", "vm-3").status == InstanceStatus.RUNNING
+
+
+def test_listing_body_follows_status_updates():
+    index = InstanceIndex("project")
+    index.sync(listing())
+    body = index.to_json()
+    assert index.to_json() is body
+
+    assert index.set_status("zone-a", "vm-1", InstanceStatus.STOPPING)
+    assert not index.set_status("zone-a", "vm-1", InstanceStatus.STOPPING)
+    assert not index.set_status("zone-a", "vm-9", InstanceStatus.STOPPING)
+
+    rows = orjson.loads(index.to_json())
+    assert rows[0] == {"Instance Name": "vm-1", "Instance Status": "STOPPING", "Zone": "zone-a"}
+    assert names(index.find(status=InstanceStatus.STOPPING)) == ["vm-1"]
+    assert orjson.loads(index.to_json([index.get("zone-b", "vm-3")])) == [
+        {"Instance Name": "vm-3", "Instance Status": "RUNNING", "Zone": "zone-b"}]
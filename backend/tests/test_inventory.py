@@ -0,0 +1,95 @@
+import asyncio
+
+from api.inventory import InventoryCache
+from api.tracker import TrackedOperation
+from core.enums import InstanceStatus, OperationStatus, OperationType
+from core.gcloud import GCloud
+from core.models import OperationData, OperationTimestamps
+
+ZONE = "zone-a"
+
+
+def listings(fake) -> int:
+    return fake.requests["instances.aggregatedList"]
+
+
+def entry(cache: InventoryCache, status=None) -> dict:
+    [found] = [entry for entry in cache.stats()["entries"] if entry["status"] == status]
+    return found
+
+
+def test_entries_are_served_until_invalidated(fake_compute, fake_key):
+    gcloud = GCloud(credential_path=fake_key)
+    project_id = gcloud.credentials.project_id
+    cache = InventoryCache(ttl=60, incremental=False)
+
+    async def main():
+        await cache.get(gcloud)
+        await cache.get(gcloud, InstanceStatus.RUNNING)
+        await cache.get(gcloud)
+        assert listings(fake_compute) == 2
+
+        # An instance the unfiltered entry does not list leaves it valid, status filtered entries may change.
+        cache.invalidate(project_id, ZONE, "vm-unknown")
+        assert (entry(cache)["invalidated"], entry(cache, "RUNNING")["invalidated"]) == (False, True)
+
+        cache.invalidate(project_id, ZONE, "vm-000000")
+        assert entry(cache)["invalidated"]
+        await cache.get(gcloud)
+        assert listings(fake_compute) == 3
+        assert not entry(cache)["invalidated"]
+
+    asyncio.run(main())
+
+
+def test_stale_entries_are_served_while_refreshing(fake_compute, fake_key):
+    gcloud = GCloud(credential_path=fake_key)
+    cache = InventoryCache(ttl=0, stale_ttl=60, incremental=False)
+
+    async def main():
+        first = await cache.get(gcloud)
+        assert await cache.get(gcloud) is first
+        await asyncio.sleep(0.2)
+        return cache.stats()
+
+    stats = asyncio.run(main())
+
+    assert (stats["misses"], stats["stale_hits"], stats["refreshes"]) == (1, 1, 2)
+
+
+def test_finished_operation_updates_the_index_and_invalidates(fake_compute, fake_key):
+    gcloud = GCloud(credential_path=fake_key)
+    cache = InventoryCache(ttl=60, incremental=False)
+    fake_compute.instances[ZONE]["vm-000002"]["status"] = "RUNNING"
+    operation = TrackedOperation(gcloud=gcloud, zone=ZONE, instance_name="vm-000002", operation_name="op",
+                                 job_id=1, job_type=OperationType.STOP, receiver="")
+    done = OperationData(name="op", type=OperationType.STOP, status=OperationStatus.DONE, zone=ZONE,
+                         timestamps=OperationTimestamps(insertTime="", startTime=None, endTime=None))
+
+    async def main():
+        index = await cache.index(gcloud)
+        cache.on_operation_status(operation)
+        assert index.get(ZONE, "vm-000002").status == InstanceStatus.STOPPING
+        cache.on_operation_done(operation, done)
+        assert index.get(ZONE, "vm-000002").status == InstanceStatus.TERMINATED
+        assert entry(cache)["invalidated"]
+        assert cache.fresh_index(gcloud.credentials.project_id) is None
+
+    asyncio.run(main())
+
+
+def test_operation_finishing_mid_fetch_invalidates_the_new_entry(fake_compute, fake_key):
+    gcloud = GCloud(credential_path=fake_key)
+    project_id = gcloud.credentials.project_id
+    cache = InventoryCache(ttl=60, incremental=False)
+
+    async def main():
+        fetch = asyncio.create_task(cache.get(gcloud))
+        await asyncio.sleep(0.1)
+        cache.invalidate(project_id, ZONE, "vm-000000")
+        await fetch
+
+    fake_compute.config.latency = 0.3
+    asyncio.run(main())
+
+    assert entry(cache)["invalidated"]
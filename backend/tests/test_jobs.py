@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session
+
+from api.jobs import query_jobs
+from api.schema import ParentJob, engine
+from core.enums import OperationStatus, OperationType
+
+PROJECT = "jobs-project"
+CREATED_AT = datetime(2026, 10, 1, 12)
+
+
+@pytest.fixture(scope="module")
+def jobs(database) -> list:
+    """Ten jobs of their own project, every pair created at the same time, so pages break ties on the id."""
+    with Session(engine) as session:
+        created = [ParentJob(name=f"vm-{i}", zone="zone-a" if i % 2 else "zone-b", status=OperationStatus.DONE,
+                             type=OperationType.STOP if i < 5 else OperationType.START, project_id=PROJECT,
+                             created_at=CREATED_AT + timedelta(minutes=i // 2))
+                   for i in range(10)]
+        session.add_all(created)
+        session.commit()
+        return [job.id for job in created]
+
+
+def page_through(session: Session, **filters) -> list:
+    pages, cursor = [], None
+    while True:
+        page = query_jobs(session, PROJECT, cursor=cursor, **filters)
+        pages.append([job.id for job in page.items])
+        cursor = page.next_cursor
+        if cursor is None:
+            return pages
+
+
+def test_pages_are_newest_first_without_gaps_or_repeats(jobs):
+    with Session(engine) as session:
+        pages = page_through(session, limit=3)
+
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert [job_id for page in pages for job_id in page] == sorted(jobs, reverse=True)
+
+
+def test_new_jobs_do_not_shift_later_pages(jobs):
+    with Session(engine) as session:
+        first = query_jobs(session, PROJECT, limit=4)
+        new = ParentJob(name="vm-new", zone="zone-a", status=OperationStatus.PENDING, type=OperationType.STOP,
+                        project_id=PROJECT, created_at=CREATED_AT + timedelta(hours=1))
+        session.add(new)
+        session.commit()
+        try:
+            second = query_jobs(session, PROJECT, limit=4, cursor=first.next_cursor)
+        finally:
+            session.delete(new)
+            session.commit()
+
+    assert [job.id for job in first.items + second.items] == sorted(jobs, reverse=True)[:8]
+
+
+def test_filters_apply_to_every_page(jobs):
+    with Session(engine) as session:
+        pages = page_through(session, limit=2, zone="zone-a", type=OperationType.STOP)
+        window = query_jobs(session, PROJECT, since=CREATED_AT + timedelta(minutes=1),
+                            until=(CREATED_AT + timedelta(minutes=3)).replace(tzinfo=timezone.utc))
+
+    # vm-1 and vm-3: the odd ones in zone-a, below 5 stopped.
+    assert pages == [[jobs[3], jobs[1]]]
+    assert sorted(job.name for job in window.items) == ["vm-2", "vm-3", "vm-4", "vm-5"]
+
+
+def test_invalid_cursor_is_rejected(jobs):
+    with Session(engine) as session, pytest.raises(HTTPException) as raised:
+        query_jobs(session, PROJECT, cursor="not-a-cursor")
+
+    assert raised.value.status_code == 400
@@ -0,0 +1,42 @@
+"""
+The regression gate of `benchmarks.load`, run as a test so CI fails on a performance regression.
+
+A short run against the fake Compute API checks that no request failed. With `LOAD_BASELINE`
+pointing at results saved by `python -m benchmarks.load --save` with the same `LOAD_ARGS`, it
+also fails when a scenario's throughput, p99 or settle time regressed beyond `--tolerance`.
+"""
+import asyncio
+import json
+import os
+import shlex
+from pathlib import Path
+
+from benchmarks import load
+
+LOAD_ARGS = os.environ.get("LOAD_ARGS", "--instances 500 --latency 0.01 --jitter 0 --duration 1 "
+                                        "--operation-seconds 0.5 --concurrency 8")
+LOAD_BASELINE = os.environ.get("LOAD_BASELINE")
+
+
+def test_regressions_compare_against_baseline():
+    baseline = {"list": {"rps": 100.0, "p99_ms": 10.0}, "tracking": {"settle_seconds": 2.0}}
+
+    assert load.regressions({"list": {"rps": 85.0, "p99_ms": 11.0}, "tracking": {"settle_seconds": 2.3},
+                             "status": {"rps": 1.0, "p99_ms": 500.0}}, baseline, tolerance=0.2) == []
+    assert load.regressions({"list": {"rps": 70.0, "p99_ms": 13.0}, "tracking": {"settle_seconds": 3.0}},
+                            baseline, tolerance=0.2) == [
+        "list: throughput 70.0 req/s, baseline 100.0 req/s",
+        "list: p99 13.0 ms, baseline 10.0 ms",
+        "tracking: settled in 3.0 s, baseline 2.0 s",
+    ]
+
+
+def test_load_has_not_regressed():
+    args = load.arguments().parse_args(shlex.split(LOAD_ARGS))
+    results = asyncio.run(load.run(args))
+
+    expected = {*args.scenarios, "tracking"} if "bulk" in args.scenarios else set(args.scenarios)
+    assert set(results) == expected
+    assert {name: result["errors"] for name, result in results.items() if result.get("errors")} == {}
+    if LOAD_BASELINE:
+        assert load.regressions(results, json.loads(Path(LOAD_BASELINE).read_text()), args.tolerance) == []
@@ -0,0 +1,140 @@
+import asyncio
+import socket
+import time
+from email.message import EmailMessage
+from typing import List, Tuple
+
+import pytest
+
+from api.notification import NotificationDispatcher, SMTPTransport
+from core.enums import OperationType
+
+
+class RecordingTransport:
+    """A `Transport` keeping what it was asked to send."""
+
+    def __init__(self):
+        self.sent: List[Tuple[float, EmailMessage]] = []
+        self.closed = 0
+
+    def send(self, msg: EmailMessage):
+        self.sent.append((time.monotonic(), msg))
+
+    def close(self):
+        self.closed += 1
+
+
+def dispatch(dispatcher: NotificationDispatcher, notifications, settle: float):
+    async def main():
+        await dispatcher.start()
+        for receiver, operation_type, instance_name in notifications:
+            dispatcher.notify(receiver, operation_type, instance_name, "zone-a")
+        await asyncio.sleep(settle)
+        await dispatcher.stop()
+    asyncio.run(main())
+
+
+def test_notifications_are_batched_per_receiver():
+    transport = RecordingTransport()
+    dispatcher = NotificationDispatcher(transport, "backend@example.com", digest_window=0.2, rate_per_minute=0)
+
+    dispatch(dispatcher, [("a@example.com", OperationType.STOP, "vm-1"),
+                          ("a@example.com", OperationType.STOP, "vm-2"),
+                          ("b@example.com", OperationType.START, "vm-3"),
+                          ("a@example.com", OperationType.START, "vm-4")], settle=0.5)
+
+    messages = {msg["To"]: msg for _, msg in transport.sent}
+    assert len(transport.sent) == 2
+    assert messages["a@example.com"]["Subject"] == "3 server operations completed"
+    assert messages["a@example.com"].get_content().splitlines() == [
+        "Stopped vm-1 (zone-a)", "Stopped vm-2 (zone-a)", "Started vm-4 (zone-a)"]
+    assert messages["b@example.com"]["Subject"] == str(OperationType.START)
+    assert dispatcher.stats() == {"queued": 4, "sent": 2, "failed": 0, "pending": 0}
+    assert transport.closed == 1
+
+
+def test_digests_are_sent_on_stop():
+    transport = RecordingTransport()
+    dispatcher = NotificationDispatcher(transport, "backend@example.com", digest_window=60, rate_per_minute=0)
+
+    dispatch(dispatcher, [("a@example.com", OperationType.STOP, "vm-1"),
+                          ("b@example.com", OperationType.STOP, "vm-2")], settle=0.1)
+
+    assert sorted(msg["To"] for _, msg in transport.sent) == ["a@example.com", "b@example.com"]
+
+
+def test_sending_is_rate_limited():
+    transport = RecordingTransport()
+    # At most one email every 0.1 seconds.
+    dispatcher = NotificationDispatcher(transport, "backend@example.com", digest_window=0, rate_per_minute=600)
+
+    dispatch(dispatcher, [(f"user-{i}@example.com", OperationType.STOP, f"vm-{i}") for i in range(4)], settle=0.6)
+
+    times = [sent_at for sent_at, _ in transport.sent]
+    assert len(times) == 4
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+
+
+def test_stop_waits_for_the_digest_being_sent():
+    transport = RecordingTransport()
+    dispatcher = NotificationDispatcher(transport, "backend@example.com", digest_window=0, rate_per_minute=120)
+
+    # Stopped while the second digest waits out the rate limit, after it was taken out of the pending ones.
+    dispatch(dispatcher, [("a@example.com", OperationType.STOP, "vm-1"),
+                          ("b@example.com", OperationType.STOP, "vm-2")], settle=0.1)
+
+    assert sorted(msg["To"] for _, msg in transport.sent) == ["a@example.com", "b@example.com"]
+    assert dispatcher.stats()["sent"] == 2
+
+
+def test_failed_send_is_counted():
+    class FailingTransport(RecordingTransport):
+        def send(self, msg: EmailMessage):
+            raise OSError("connection refused")
+
+    dispatcher = NotificationDispatcher(FailingTransport(), "backend@example.com", digest_window=0,
+                                        rate_per_minute=0)
+
+    dispatch(dispatcher, [("a@example.com", OperationType.STOP, "vm-1")], settle=0.1)
+
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_smtp_transport_reconnects_after_failed_noop():
+    controller_module = pytest.importorskip("aiosmtpd.controller")
+    from aiosmtpd.handlers import Sink
+
+    class Recorder(Sink):
+        def __init__(self):
+            self.received = []
+
+        async def handle_DATA(self, server, session, envelope):
+            self.received.append(envelope.rcpt_tos)
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    handler = Recorder()
+    controller = controller_module.Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        transport = SMTPTransport(host="127.0.0.1", port=port, use_ssl=False, idle_check=0)
+
+        def message(receiver: str) -> EmailMessage:
+            msg = EmailMessage()
+            msg.set_content("Server has been stopped")
+            msg["From"], msg["To"], msg["Subject"] = "backend@example.com", receiver, "stop"
+            return msg
+
+        transport.send(message("a@example.com"))
+        first = transport._server
+        # The connection dropped while idle: NOOP fails and a new connection is opened.
+        first.sock.shutdown(socket.SHUT_RDWR)
+        transport.send(message("b@example.com"))
+
+        assert transport._server is not first
+        assert handler.received == [["a@example.com"], ["b@example.com"]]
+        transport.close()
+    finally:
+        controller.stop()
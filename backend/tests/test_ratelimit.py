@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from core.async_gcloud import AsyncGCloud
+from core.ratelimit import CircuitBreaker, CircuitOpenError, ComputeLimiter, Family
+
+ZONE = "zone-a"
+INSTANCE = "vm-000000"
+
+
+def client(key, **limits) -> AsyncGCloud:
+    agcloud = AsyncGCloud(credential_path=key)
+    # A limiter of its own, so tests neither share breaker state nor wait on the default backoff.
+    agcloud.limiter = ComputeLimiter(agcloud.credentials.project_id, **{
+        "read_rate": 1000, "read_burst": 1000, "mutate_rate": 1000, "mutate_burst": 1000,
+        "backoff_base": 0.05, "backoff_max": 1.0, **limits})
+    return agcloud
+
+
+def call(agcloud: AsyncGCloud, method: str, *args):
+    async def main():
+        try:
+            return await getattr(agcloud, method)(*args)
+        finally:
+            await agcloud.aclose()
+    return asyncio.run(main())
+
+
+def compute_requests(fake) -> int:
+    return sum(count for kind, count in fake.requests.items() if kind != "token")
+
+
+def test_rate_limited_reads_back_off_and_give_up(fake_compute, fake_key, monkeypatch):
+    # Full jitter drawn at its upper bound: the waits are 0.05, 0.1 and 0.2 seconds.
+    monkeypatch.setattr("core.ratelimit.random.uniform", lambda low, high: high)
+    fake_compute.config.rate_limit_rate = 1.0
+    agcloud = client(fake_key, max_retries=3)
+
+    started = time.monotonic()
+    with pytest.raises(httpx.HTTPStatusError) as raised:
+        call(agcloud, "get_instance_status", ZONE, INSTANCE)
+
+    assert raised.value.response.status_code == 429
+    assert time.monotonic() - started >= 0.35
+    assert fake_compute.requests["rate_limited"] == 4
+    assert agcloud.limiter.stats()["retries"] == 3
+    assert agcloud.limiter.stats()["gave_up"] == 1
+
+
+def test_rate_limited_mutation_is_retried(fake_compute, fake_key):
+    fake_compute.config.rate_limit_rate = 1.0
+    agcloud = client(fake_key, max_retries=2)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        call(agcloud, "stop_instance", ZONE, INSTANCE)
+
+    assert fake_compute.requests["rate_limited"] == 3
+
+
+def test_failed_mutation_is_not_retried(fake_compute, fake_key):
+    fake_compute.config.error_rate = 1.0
+    agcloud = client(fake_key, max_retries=3)
+
+    with pytest.raises(httpx.HTTPStatusError) as raised:
+        call(agcloud, "stop_instance", ZONE, INSTANCE)
+
+    assert raised.value.response.status_code == 503
+    assert fake_compute.requests["error"] == 1
+    assert agcloud.limiter.stats()["retries"] == 0
+
+
+def test_mutation_is_not_retried_after_transport_error():
+    limiter = ComputeLimiter("fake-project", max_retries=3, backoff_base=0.01)
+    attempts = []
+
+    async def send():
+        attempts.append(1)
+        raise httpx.ConnectError("connection reset")
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(limiter.acall(Family.MUTATE, send, AsyncGCloud._retry_info))
+    assert len(attempts) == 1
+
+    attempts.clear()
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(limiter.acall(Family.READ, send, AsyncGCloud._retry_info))
+    assert len(attempts) == 4
+
+
+def test_breaker_opens_per_family_and_half_opens(fake_compute, fake_key):
+    agcloud = client(fake_key, max_retries=0, breaker_threshold=3, breaker_reset=0.3)
+    breakers = agcloud.limiter.breakers
+
+    async def scenario():
+        fake_compute.config.error_rate = 1.0
+        for _ in range(3):
+            with pytest.raises(httpx.HTTPStatusError):
+                await agcloud.get_instance_status(ZONE, INSTANCE)
+        assert breakers[Family.READ].state == CircuitBreaker.OPEN
+
+        # Open: reads fail fast without reaching Compute.
+        served = compute_requests(fake_compute)
+        with pytest.raises(CircuitOpenError):
+            await agcloud.get_instance_status(ZONE, INSTANCE)
+        assert compute_requests(fake_compute) == served
+
+        # Mutations have a breaker of their own.
+        fake_compute.config.error_rate = 0.0
+        await agcloud.stop_instance(ZONE, INSTANCE)
+        assert breakers[Family.MUTATE].state == CircuitBreaker.CLOSED
+
+        # Half-open: one trial goes through, and its failure opens the breaker again.
+        await asyncio.sleep(0.3)
+        fake_compute.config.error_rate = 1.0
+        with pytest.raises(httpx.HTTPStatusError):
+            await agcloud.get_instance_status(ZONE, INSTANCE)
+        assert breakers[Family.READ].state == CircuitBreaker.OPEN
+        assert breakers[Family.READ].opened == 2
+
+        # A successful trial closes it.
+        await asyncio.sleep(0.3)
+        fake_compute.config.error_rate = 0.0
+        await agcloud.get_instance_status(ZONE, INSTANCE)
+        assert breakers[Family.READ].state == CircuitBreaker.CLOSED
+
+    async def main():
+        try:
+            await scenario()
+        finally:
+            await agcloud.aclose()
+
+    asyncio.run(main())
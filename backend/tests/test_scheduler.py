@@ -0,0 +1,97 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlmodel import Session, delete, select
+
+from api.dedup import OperationCoalescer
+from api.inventory import InventoryCache
+from api.scheduler import Scheduler
+from api.schema import ParentJob, Schedule, engine, utcnow
+from api.tracker import OperationTracker
+from core.enums import OperationType
+
+ZONE = "zone-b"
+
+
+@pytest.fixture
+def no_schedules(database):
+    """Deletes the schedules a test stored, which the next scheduler would load."""
+    yield
+    with Session(engine) as session:
+        session.exec(delete(Schedule))
+        session.commit()
+
+
+def add_schedules(project_id: str, instance_names) -> list:
+    """Stores every-minute stop schedules created a while ago, so their first run is already due."""
+    with Session(engine) as session:
+        schedules = [Schedule(project_id=project_id, cron="* * * * *", type=OperationType.STOP, zone=ZONE,
+                              instance_name=name, created_at=utcnow() - timedelta(minutes=5))
+                     for name in instance_names]
+        session.add_all(schedules)
+        session.flush()
+        stored = [Schedule.model_validate(schedule.model_dump()) for schedule in schedules]
+        session.commit()
+        return stored
+
+
+def jobs_of(schedule: Schedule) -> list:
+    with Session(engine) as session:
+        # Schedule ids are reused once deleted, so the instance tells the jobs of earlier tests apart.
+        return session.exec(select(ParentJob).where(ParentJob.schedule_id == schedule.id,
+                                                    ParentJob.name == schedule.instance_name)).all()
+
+
+def run_due(new_tenant, load_tenant: bool, runs: int) -> dict:
+    """Starts a scheduler and waits for `runs` schedules to have run."""
+    async def main():
+        tracker = OperationTracker()
+        await tracker.start()
+        tenant = new_tenant()
+        scheduler = Scheduler(OperationCoalescer(tracker), InventoryCache(), misfire_grace=600)
+
+        async def get_tenant(project_id: str):
+            return tenant if load_tenant else None
+
+        try:
+            await scheduler.start(get_tenant)
+            for _ in range(100):
+                stats = scheduler.stats()
+                if stats["runs"] >= runs and not stats["running"]:
+                    return stats
+                await asyncio.sleep(0.05)
+            raise AssertionError(f"The schedules did not run: {scheduler.stats()}")
+        finally:
+            await scheduler.stop()
+            await tracker.stop()
+            await tenant.agcloud.aclose()
+
+    return asyncio.run(main())
+
+
+def test_due_schedules_skip_settled_instances(fake_compute, no_schedules, new_tenant):
+    fake_compute.instances[ZONE]["vm-000009"]["status"] = "RUNNING"
+    fake_compute.instances[ZONE]["vm-000011"]["status"] = "TERMINATED"
+    running, stopped = add_schedules(fake_compute.config.project_id, ["vm-000009", "vm-000011"])
+
+    stats = run_due(new_tenant, load_tenant=True, runs=2)
+
+    assert (stats["batches"], stats["operations"], stats["skipped"], stats["failures"]) == (1, 1, 1, 0)
+    assert fake_compute.requests["instances.stop"] == 1
+    [job] = jobs_of(running)
+    assert (job.name, job.type) == ("vm-000009", OperationType.STOP)
+    assert jobs_of(stopped) == []
+    with Session(engine) as session:
+        assert all(session.get(Schedule, schedule.id).last_run_at for schedule in (running, stopped))
+
+
+def test_run_without_credentials_is_recorded_as_failed(fake_compute, no_schedules, new_tenant):
+    [schedule] = add_schedules(fake_compute.config.project_id, ["vm-000013"])
+
+    stats = run_due(new_tenant, load_tenant=False, runs=1)
+
+    assert stats["failures"] == 1
+    assert fake_compute.requests["instances.stop"] == 0
+    [job] = jobs_of(schedule)
+    assert (job.name, job.is_successful, job.operation) == ("vm-000013", False, None)
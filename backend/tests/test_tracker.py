@@ -0,0 +1,59 @@
+import asyncio
+
+from sqlmodel import Session
+
+from api.dedup import OperationCoalescer
+from api.schema import ParentJob, engine
+from api.tracker import OperationTracker
+from core.enums import OperationStatus, OperationType
+
+ZONE = "zone-b"
+
+
+def track(new_tenant, tracker: OperationTracker, instance_names) -> tuple:
+    """Stops the instances through a coalescer, waits until their jobs settle and returns the jobs and stats."""
+    async def main():
+        await tracker.start()
+        tenant = new_tenant()
+        try:
+            coalescer = OperationCoalescer(tracker, precheck=False)
+            jobs = [await coalescer.run(tenant, ZONE, name, OperationType.STOP, "") for name in instance_names]
+            tracking = tracker.stats()
+            await asyncio.gather(*(tracker.wait(job.operation, 5) for job in jobs))
+            return jobs, tracking
+        finally:
+            await tracker.stop()
+            await tenant.agcloud.aclose()
+
+    jobs, tracking = asyncio.run(main())
+    with Session(engine) as session:
+        settled = [session.get(ParentJob, job.id) for job in jobs]
+    assert [(job.status, job.is_successful) for job in settled] == [(OperationStatus.DONE, True)] * len(jobs)
+    return tracking, tracker.stats()
+
+
+def test_operations_settle_through_the_wait_long_poll(fake_compute, database, new_tenant):
+    tracking, stats = track(new_tenant, OperationTracker(), ["vm-000015"])
+
+    assert (tracking["waiting"], tracking["polled"]) == (1, 0)
+    assert (stats["waits"], stats["polls"], stats["wait_fallbacks"]) == (1, 0, 0)
+    assert fake_compute.requests["zoneOperations.wait"] >= 1
+    assert fake_compute.requests["zoneOperations.list"] == 0
+
+
+def test_timed_out_wait_falls_back_to_polling(fake_compute, database, new_tenant):
+    tracking, stats = track(new_tenant, OperationTracker(min_interval=0.1, wait_timeout=0.1), ["vm-000017"])
+
+    assert tracking["waiting"] == 1
+    assert (stats["waits"], stats["wait_fallbacks"]) == (0, 1)
+    assert stats["polls"] >= 1
+    assert stats["completed"] == 1
+
+
+def test_operations_beyond_the_wait_slots_are_polled_until_one_frees_up(fake_compute, database, new_tenant):
+    tracking, stats = track(new_tenant, OperationTracker(max_waiters=1), ["vm-000019", "vm-000001"])
+
+    assert (tracking["waiting"], tracking["polled"]) == (1, 1)
+    # The first wait finishes before the second operation's first poll, and hands it its slot.
+    assert (stats["waits"], stats["polls"]) == (2, 0)
+    assert stats["completed"] == 2
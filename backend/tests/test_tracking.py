@@ -0,0 +1,95 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlmodel import Session, delete, select
+
+from api.schema import ParentJob, TrackingTask, engine, utcnow
+from api.tracker import OperationTracker
+from api.tracking import TrackingQueue
+from core.enums import OperationStatus, OperationType
+
+ZONE = "zone-a"
+
+
+@pytest.fixture
+def queue_table(database):
+    """An empty tracking queue table, without the tasks other tests left leased to the app's worker."""
+    def clear():
+        with Session(engine) as session:
+            session.exec(delete(TrackingTask))
+            session.commit()
+
+    clear()
+    yield
+    clear()
+
+
+def enqueue(project_id: str, instance_name: str, operation_name: str, lease_owner: str,
+            lease_expires_at) -> int:
+    """Records a pending stop job and its queue entry, as a worker that issued it would have."""
+    with Session(engine) as session:
+        job = ParentJob(name=instance_name, zone=ZONE, status=OperationStatus.PENDING, type=OperationType.STOP,
+                        project_id=project_id, operation=operation_name)
+        session.add(job)
+        session.flush()
+        session.add(TrackingTask(job_id=job.id, project_id=project_id, zone=ZONE, instance_name=instance_name,
+                                 operation_name=operation_name, job_type=OperationType.STOP,
+                                 lease_owner=lease_owner, lease_expires_at=lease_expires_at))
+        session.commit()
+        return job.id
+
+
+def resume(new_tenant, queue: TrackingQueue, settle=None) -> dict:
+    """Resumes the queued tasks of the fake project, waiting on the operations of `settle` to be done."""
+    async def main():
+        tracker = OperationTracker()
+        await tracker.start()
+        await queue.start(tracker, list)
+        tenant = new_tenant()
+        try:
+            await queue.resume(tenant)
+            if settle is not None:
+                await tracker.wait(settle, 5)
+            return queue.stats()
+        finally:
+            await queue.stop()
+            await tracker.stop()
+            await tenant.agcloud.aclose()
+
+    return asyncio.run(main())
+
+
+def job_and_task(job_id: int) -> tuple:
+    with Session(engine) as session:
+        return (session.get(ParentJob, job_id),
+                session.exec(select(TrackingTask).where(TrackingTask.job_id == job_id)).first())
+
+
+def test_expired_leases_are_claimed_and_tracked(fake_compute, queue_table, new_tenant):
+    project_id = fake_compute.config.project_id
+    abandoned = fake_compute.mutate(ZONE, fake_compute.instances[ZONE]["vm-000006"], "stop")["name"]
+    expired = enqueue(project_id, "vm-000006", abandoned, "dead-worker", utcnow() - timedelta(seconds=1))
+    held = enqueue(project_id, "vm-000008", "operation-held", "live-worker", utcnow() + timedelta(minutes=5))
+
+    stats = resume(new_tenant, TrackingQueue(worker_id="test-worker"), settle=abandoned)
+
+    assert (stats["resumed"], stats["orphans"], stats["deferred"]) == (1, 0, 0)
+    job, task = job_and_task(expired)
+    assert (job.status, job.is_successful, task) == (OperationStatus.DONE, True, None)
+    job, task = job_and_task(held)
+    assert (job.status, task.lease_owner) == (OperationStatus.PENDING, "live-worker")
+
+
+def test_operation_compute_forgot_is_settled_from_the_instance(fake_compute, queue_table, new_tenant):
+    project_id = fake_compute.config.project_id
+    fake_compute.instances[ZONE]["vm-000010"]["status"] = "TERMINATED"
+    fake_compute.instances[ZONE]["vm-000012"]["status"] = "RUNNING"
+    stopped = enqueue(project_id, "vm-000010", "operation-gone-1", None, None)
+    running = enqueue(project_id, "vm-000012", "operation-gone-2", None, None)
+
+    stats = resume(new_tenant, TrackingQueue(worker_id="test-worker"))
+
+    assert (stats["resumed"], stats["orphans"]) == (0, 2)
+    assert [(job.status, job.is_successful, task) for job, task in map(job_and_task, (stopped, running))] == [
+        (OperationStatus.DONE, True, None), (OperationStatus.DONE, False, None)]
@@ -1,6 +1,98 @@
 import streamlit as st
 import requests
-import time, os
+import json, threading, time, os
+
+STATUS_REFRESH_SECONDS = float(os.environ.get("STATUS_REFRESH_SECONDS", 1))
+
+
+class EventSubscription:
+    """Follows the backend's /events stream in a background thread and keeps the latest instance statuses."""
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.statuses = {}
+        self.messages = []
+        self.needs_reload = True
+        self.expired = False
+        self.last_event_id = None
+        self.stopped = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+
+    def _run(self):
+        while not self.stopped:
+            headers = dict(self.headers)
+            if self.last_event_id is not None:
+                headers["Last-Event-ID"] = self.last_event_id
+            try:
+                with requests.get(self.url, headers=headers, stream=True, timeout=(5, 60)) as response:
+                    if tenant_expired(response):
+                        # The page registers the key again and hands over the new headers.
+                        self.expired = True
+                    response.raise_for_status()
+                    event = {}
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self.stopped:
+                            return
+                        if not line:
+                            self._dispatch(event)
+                            event = {}
+                        elif not line.startswith(":"):
+                            field, _, value = line.partition(":")
+                            event[field] = value.lstrip()
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(3)
+
+    def _dispatch(self, event):
+        if "data" not in event:
+            return
+        data = json.loads(event["data"])
+        with self.lock:
+            self.last_event_id = event.get("id", self.last_event_id)
+            kind = event.get("event")
+            if kind == "reset":
+                self.needs_reload = True
+            elif kind == "instance":
+                self.statuses[(data["zone"], data["instance_name"])] = data["status"]
+            elif kind == "job" and data["status"] == "DONE":
+                outcome = "succeeded" if data["is_successful"] else "failed"
+                self.messages.append(f"{data['type'].capitalize()} of {data['name']} {outcome}")
+
+
+def tenant_expired(response):
+    """Whether the backend no longer knows the session's tenant, e.g. after it restarted."""
+    return response.status_code == 401 and response.headers.get("WWW-Authenticate") == "Tenant"
+
+
+def register():
+    name, key = st.session_state.key_file
+    r = requests.post(f"{BACKEND_URL}/load_config", files={"file": (name, key)}, timeout=30)
+    r.raise_for_status()
+    st.session_state.tenant = r.json().get("tenant")
+    if "events" in st.session_state:
+        with st.session_state.events.lock:
+            st.session_state.events.headers = tenant_headers()
+            st.session_state.events.expired = False
+
+
+def tenant_headers():
+    return {"X-Tenant": st.session_state.tenant} if st.session_state.tenant else {}
+
+
+def backend(method, path, **kwargs):
+    """Calls the backend as the session's tenant, uploading the key again once if the backend has forgotten it."""
+    response = requests.request(method, f"{BACKEND_URL}{path}", headers=tenant_headers(), **kwargs)
+    if tenant_expired(response):
+        response.close()
+        register()
+        response = requests.request(method, f"{BACKEND_URL}{path}", headers=tenant_headers(), **kwargs)
+    return response
+
 
 st.title("Google Cloud Server Manager")
 
@@ -8,12 +100,21 @@ if "auth_configured" not in st.session_state:
     st.session_state.auth_configured = False
 if "receiver_email" not in st.session_state:
     st.session_state.receiver_email = ""
+if "tenant" not in st.session_state:
+    st.session_state.tenant = None
+if "key_file" not in st.session_state:
+    st.session_state.key_file = None
 
 st.sidebar.header("Configuration")
 
 if st.sidebar.button("Reset Configuration"):
+    if "events" in st.session_state:
+        st.session_state.events.stop()
+        del st.session_state.events
     st.session_state.auth_configured = False
     st.session_state.receiver_email = ""
+    st.session_state.tenant = None
+    st.session_state.key_file = None
     st.sidebar.success("Configuration reset!")
     st.rerun()
 
@@ -27,8 +128,9 @@ if not st.session_state.auth_configured:
     receiver_email = st.text_input("Receiver Email Address", placeholder="notifications@example.com", help="Email address to receive start/stop notifications")
     
     if uploaded_file is not None and receiver_email:
-        files = {"file": (uploaded_file.name, uploaded_file.getvalue())}
-        r = requests.post(f"{BACKEND_URL}/load_config", files=files, timeout=30)
+        # Kept for the session, so the key can be uploaded again when the backend forgets the tenant.
+        st.session_state.key_file = (uploaded_file.name, uploaded_file.getvalue())
+        register()
         st.session_state.receiver_email = receiver_email
         st.session_state.auth_configured = True
         st.success("Configuration saved!")
@@ -41,60 +143,101 @@ if st.session_state.auth_configured:
     st.sidebar.success("Configuration Active")
     st.sidebar.write(f"**Receiver:** {st.session_state.receiver_email}")
     
+    receiver_email = st.session_state.receiver_email
+
+    if "events" not in st.session_state:
+        st.session_state.events = EventSubscription(f"{BACKEND_URL}/events", tenant_headers())
+    events = st.session_state.events
+
     def fetch_servers():
+        # Streamed as NDJSON, so large fleets show progress while the backend is still listing.
+        servers = []
+        progress = st.empty()
         try:
-            response = requests.get(f"{BACKEND_URL}/list-server")
-            if response.status_code == 200:
-                return response.json()
-            else:
-                error_detail = response.json().get("detail", "Unknown error")
-                st.error(f"Error: {error_detail}")
-                return []
+            with backend("GET", "/list-server", params={"stream": "true"}, stream=True) as response:
+                if response.status_code != 200:
+                    error_detail = response.json().get("detail", "Unknown error")
+                    st.error(f"Error: {error_detail}")
+                    return []
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    row = json.loads(line)
+                    if "error" in row:
+                        st.error(f"Error: {row['error']}")
+                        break
+                    servers.append(row)
+                    if len(servers) % 500 == 0:
+                        progress.caption(f"Loading servers... {len(servers)} so far")
         except requests.exceptions.RequestException as e:
             st.error(f"Connection error: {str(e)}")
-            return []    
+        progress.empty()
+        return servers
+
+    def send(path, instance_name, zone):
+        request_body = {"zone": zone, "instance_name": instance_name, "receiver": receiver_email}
+        return backend("POST", f"/{path}", json=request_body)
+
     st.subheader("Available Servers")
 
-    servers = fetch_servers()
+    # The list is fetched once, then kept current by the event stream. It is reloaded
+    # when the stream asks for it (after a backend restart) or on "Refresh Server List".
+    if st.button("Refresh Server List"):
+        events.needs_reload = True
+
+    @st.fragment(run_every=STATUS_REFRESH_SECONDS)
+    def server_list():
+        with events.lock:
+            reload = events.needs_reload
+            events.needs_reload = False
+            expired = events.expired
+        if expired:
+            register()
+        if reload:
+            servers = fetch_servers()
+            with events.lock:
+                events.statuses.clear()
+            st.session_state.servers = servers
+        servers = st.session_state.get("servers", [])
+
+        with events.lock:
+            statuses = dict(events.statuses)
+            messages, events.messages = events.messages, []
+        for message in messages:
+            st.toast(message)
+
+        if not servers:
+            st.write("No servers found.")
+            return
 
-    if not servers:
-        st.write("No servers found.")
-    else:
         for server in servers:
             instance_name = server["Instance Name"]
             zone = server["Zone"]
-            status = server["Instance Status"]
+            status = statuses.get((zone, instance_name), server["Instance Status"])
 
             col1, col2, col3 = st.columns([3, 2, 2])
 
             with col1:
                 st.write(f"**{instance_name}** ({zone})")
-                
+
             with col2:
                 st.write(f"Status: **{status}**")
 
             with col3:
                 if status.lower() == "terminated":
                     if st.button(f"Start {instance_name}", key=f"start_{instance_name}"):
-                        request_body = {"zone": zone, "instance_name": instance_name,"receiver":receiver_email}
-                        response = requests.post(f"{BACKEND_URL}/start-server", json=request_body)
+                        response = send("start-server", instance_name, zone)
                         if response.status_code == 200:
-                            st.success(f"Started {instance_name}")
-                            time.sleep(3)
-                            st.rerun()
+                            st.success(f"Starting {instance_name}")
                         else:
                             st.error(f"Failed to start {instance_name}")
 
                 elif status.lower() == "running":
                     if st.button(f"Stop {instance_name}", key=f"stop_{instance_name}"):
-                        request_body = {"zone": zone, "instance_name": instance_name, "receiver":receiver_email}
-                        response = requests.post(f"{BACKEND_URL}/end-server", json=request_body)
+                        response = send("end-server", instance_name, zone)
                         if response.status_code == 200:
-                            st.success(f"Stopped {instance_name}")
-                            time.sleep(3) 
-                            st.rerun()
+                            st.success(f"Stopping {instance_name}")
                         else:
                             st.error(f"Failed to stop {instance_name}")
 
-    if st.button("Refresh Server List"):
-        st.rerun()
\ No newline at end of file
+    server_list()